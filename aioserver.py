@@ -0,0 +1,284 @@
+'''
+	An asyncio based HTTP/1.1 server for bottle; python 3.5 and up only.
+
+	Connections are parsed and written on the event loop, while the app
+	itself (routing, rendering, anything touching the Blog) runs on a
+	bounded pool of threads, so an idle connection costs a little memory
+	rather than a thread.
+
+	Written with callbacks rather than async/await, so the rest of the
+	(python 2) tree can still byte-compile it.
+'''
+
+import asyncio
+import concurrent.futures
+import email.utils
+import io
+import sys
+import threading
+import traceback
+from urllib.parse import unquote_to_bytes
+
+from bottle import ServerAdapter
+from utilities import Log
+
+
+class HTTPProtocol(asyncio.Protocol):
+	'''
+		One client connection.  Requests are answered one at a time and in
+		order, so pipelined requests just wait in the buffer; the connection
+		is kept open between them unless the client or the response says not to.
+	'''
+
+	# Requests with more header than this are refused.
+	max_header_bytes = 64 * 1024
+	# Connections with nothing to do for this long are closed, in seconds.
+	idle_timeout = 5.0
+	# Connections are closed after this many requests.
+	max_requests = 100
+
+	def __init__(self, server):
+		'''
+			:param server: The AsyncioServer the connection belongs to.
+		'''
+		self.server = server
+		self.loop = server.loop
+		self.idle_timeout = server.options.get('keep_alive_timeout', HTTPProtocol.idle_timeout)
+		self.max_requests = server.options.get('keep_alive_requests', HTTPProtocol.max_requests)
+		self.requests = 0
+		self.buffer = b''
+		self.busy = False
+		self.closed = False
+		self.timeout = None
+		# Cleared while the transport's buffer is full, so the app's thread waits to write.
+		self.writable = threading.Event()
+		self.writable.set()
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.resetTimeout()
+
+	def connection_lost(self, exc):
+		self.closed = True
+		self.writable.set()
+		if self.timeout:
+			self.timeout.cancel()
+
+	def pause_writing(self):
+		self.writable.clear()
+
+	def resume_writing(self):
+		self.writable.set()
+
+	def data_received(self, data):
+		self.buffer += data
+		self.resetTimeout()
+		self.nextRequest()
+
+	def resetTimeout(self):
+		if self.timeout:
+			self.timeout.cancel()
+		self.timeout = None if self.busy else self.loop.call_later(self.idle_timeout, self.transport.close)
+
+	def nextRequest(self):
+		'''
+			Start on the next complete request in the buffer, if there is one
+			and the last one is finished.
+		'''
+		if self.busy or self.closed:
+			return
+
+		header_end = self.buffer.find(b'\r\n\r\n')
+		if header_end < 0:
+			if len(self.buffer) > self.max_header_bytes:
+				self.refuse(b'431 Request Header Fields Too Large')
+			return
+
+		try:
+			environ = self.parseHeader(self.buffer[:header_end].decode('latin-1'))
+			length = int(environ.get('CONTENT_LENGTH') or 0)
+		except ValueError as e:
+			self.refuse(b'400 Bad Request')
+			return
+		if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+			self.refuse(b'411 Length Required')
+			return
+
+		body_start = header_end + 4
+		if len(self.buffer) < body_start + length:
+			return
+		environ['wsgi.input'] = io.BytesIO(self.buffer[body_start:body_start + length])
+		self.buffer = self.buffer[body_start + length:]
+
+		self.busy = True
+		self.requests += 1
+		self.resetTimeout()
+		future = self.loop.run_in_executor(self.server.executor, self.respond, environ)
+		future.add_done_callback(self.finishRequest)
+
+	def parseHeader(self, header):
+		'''
+			Build the WSGI environ for a request's header.
+
+			:param header: The request line and header lines, decoded as latin-1.
+		'''
+		lines = header.split('\r\n')
+		(method, target, protocol) = lines[0].split(' ', 2)
+		(path, question, query) = target.partition('?')
+		if not protocol.startswith('HTTP/1.'):
+			raise ValueError(protocol)
+
+		environ = {
+			'REQUEST_METHOD': method,
+			'SCRIPT_NAME': '',
+			'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+			'QUERY_STRING': query,
+			'SERVER_NAME': self.server.host,
+			'SERVER_PORT': str(self.server.port),
+			'SERVER_PROTOCOL': protocol,
+			'REMOTE_ADDR': (self.transport.get_extra_info('peername') or ('',))[0],
+			'wsgi.version': (1, 0),
+			'wsgi.url_scheme': 'http',
+			'wsgi.errors': sys.stderr,
+			'wsgi.multithread': True,
+			'wsgi.multiprocess': False,
+			'wsgi.run_once': False,
+		}
+		for line in lines[1:]:
+			(name, colon, value) = line.partition(':')
+			if not colon:
+				raise ValueError(line)
+			key = name.strip().upper().replace('-', '_')
+			if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+				key = 'HTTP_' + key
+			value = value.strip()
+			environ[key] = environ[key] + ',' + value if key in environ else value
+		return environ
+
+	def keepAlive(self, environ):
+		'''
+			Does the client want the connection kept open after this request?
+		'''
+		connection = environ.get('HTTP_CONNECTION', '').lower()
+		if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+			return 'keep-alive' in connection
+		return 'close' not in connection
+
+	def respond(self, environ):
+		'''
+			Run the app for a request and stream its response to the client;
+			runs on the thread pool.
+
+			:param environ: The request's WSGI environ.
+			:return: Whether the connection can be kept open.
+		'''
+		keep_alive = self.keepAlive(environ) and self.requests < self.max_requests
+		started = []
+
+		def start_response(status, headers, exc_info=None):
+			if exc_info and started and started[0] is None:
+				raise exc_info[1].with_traceback(exc_info[2])
+			started[:] = [status, headers]
+			return self.write
+
+		body = self.server.app(environ, start_response)
+		try:
+			(status, headers) = started
+			names = set(name.lower() for (name, value) in headers)
+			bodiless = environ['REQUEST_METHOD'] == 'HEAD' or status[:3] in ('204', '304') or status[0] == '1'
+			# Everything needs framing for the connection to be reused.
+			chunked = not bodiless and 'content-length' not in names and environ['SERVER_PROTOCOL'] != 'HTTP/1.0'
+			if not bodiless and 'content-length' not in names and not chunked:
+				keep_alive = False
+
+			lines = ['%s %s' % (environ['SERVER_PROTOCOL'], status)]
+			lines.extend('%s: %s' % (name, value) for (name, value) in headers)
+			if 'date' not in names:
+				lines.append('Date: ' + email.utils.formatdate(usegmt=True))
+			if chunked:
+				lines.append('Transfer-Encoding: chunked')
+			if environ['SERVER_PROTOCOL'] == 'HTTP/1.0' and keep_alive:
+				lines.append('Connection: keep-alive')
+			elif not keep_alive:
+				lines.append('Connection: close')
+			self.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+			# Nobody else will look at these now.
+			started[:] = [None, None]
+
+			for chunk in body:
+				if bodiless or not chunk:
+					continue
+				if chunked:
+					chunk = b'%x\r\n' % (len(chunk),) + chunk + b'\r\n'
+				self.write(chunk)
+			if chunked:
+				self.write(b'0\r\n\r\n')
+		finally:
+			if hasattr(body, 'close'):
+				body.close()
+		return keep_alive
+
+	def write(self, data):
+		'''
+			Queue bytes on the transport from the app's thread, waiting
+			while the client is not keeping up.
+		'''
+		self.writable.wait()
+		if self.closed:
+			raise IOError('connection closed')
+		self.loop.call_soon_threadsafe(self.transport.write, data)
+
+	def finishRequest(self, future):
+		'''
+			Back on the loop once a response is written: close, or move on to the next request.
+		'''
+		self.busy = False
+		try:
+			keep_alive = future.result()
+		except Exception as e:
+			if not self.closed:
+				Log('Failure serving request.')
+				Log(traceback.format_exc())
+			keep_alive = False
+
+		if not keep_alive or self.closed:
+			self.transport.close()
+			return
+		self.resetTimeout()
+		self.nextRequest()
+
+	def refuse(self, status):
+		'''
+			Answer a request that can't be handled, and hang up.
+
+			:param status: The status line, as bytes.
+		'''
+		self.transport.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+		self.transport.close()
+		self.closed = True
+
+
+class AsyncioServer(ServerAdapter):
+	'''
+		Bottle server adapter running an asyncio event loop.
+
+		Options: threads, the size of the pool the app runs on (default 16),
+		keep_alive_timeout (idle seconds, default 5) and keep_alive_requests
+		(per connection, default 100).  Once running, the listening server is
+		the adapter's server attribute.
+	'''
+
+	def run(self, app):
+		self.app = app
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.executor = concurrent.futures.ThreadPoolExecutor(self.options.get('threads', 16))
+
+		self.server = self.loop.run_until_complete(self.loop.create_server(lambda: HTTPProtocol(self), self.host, self.port, backlog=1024))
+		try:
+			self.loop.run_forever()
+		finally:
+			self.server.close()
+			self.loop.run_until_complete(self.server.wait_closed())
+			self.executor.shutdown(wait=False)
+			self.loop.close()
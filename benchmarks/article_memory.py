@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+	Measure how many bytes of metadata each article costs a Blog, comparing the
+	old per-instance __dict__ layout (every article holding its own category,
+	tag and date objects) against slotted Articles interned through the Blog.
+
+	Bodies and excerpts are the same size either way, so they are left out.
+
+	python benchmarks/article_memory.py [article count]
+'''
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import blog
+from utilities import LoggingOff
+
+
+class DictArticle:
+	'''
+		The Article layout before slots and interning.
+	'''
+
+	def __init__(self, article):
+		self.path = Copy(article.path)
+		self.web_path = Copy(article.web_path)
+		self.body = None
+		self.title = Copy(article.title)
+		self.date = datetime.date(article.date.year, article.date.month, article.date.day)
+		self.category = Copy(article.category)
+		self.tags = [Copy(tag) for tag in article.tags]
+
+
+def Copy(string):
+	'''
+		Make a distinct copy of a string, as parsing each file used to.
+	'''
+	return (string + '.')[:-1]
+
+
+def SizeOf(roots, skip=('_body', '_excerpt', 'body', 'body_cache')):
+	'''
+		Total size of every object reachable from roots, each counted once.
+
+		:param roots: The objects to measure.
+		:param skip: Attributes not to follow.
+	'''
+	seen = set()
+	total = 0
+	pending = list(roots)
+	while pending:
+		obj = pending.pop()
+		if obj is None or id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		total += sys.getsizeof(obj)
+
+		if isinstance(obj, dict):
+			pending.extend(obj.keys())
+			pending.extend(obj.values())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			pending.extend(obj)
+		elif hasattr(obj, '__slots__'):
+			pending.extend(getattr(obj, name, None) for name in obj.__slots__ if name not in skip)
+		elif hasattr(obj, '__dict__'):
+			seen.add(id(obj.__dict__))
+			total += sys.getsizeof(obj.__dict__)
+			pending.extend(value for name, value in obj.__dict__.items() if name not in skip)
+			pending.extend(obj.__dict__.keys())
+	return total
+
+
+def WriteCorpus(directory, count):
+	'''
+		Write count articles spread over a handful of categories and tags.
+	'''
+	start = datetime.date(2014, 1, 1)
+	for number in range(count):
+		date = start + datetime.timedelta(days=number % 730)
+		tags = ', '.join('tag%d' % ((number + offset) % 20,) for offset in range(3))
+		with open(os.path.join(directory, 'article_%d' % (number,)), 'w') as f:
+			f.write('<!--_date=%s;_category=category%d;_tags=%s;-->Article number %d.' % (date, number % 5, tags, number))
+
+
+def Main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	LoggingOff()
+
+	directory = tempfile.mkdtemp()
+	try:
+		WriteCorpus(directory, count)
+
+		blog_instance = blog.Blog(os.path.join(directory, 'no_config'))
+		blog_instance.article_dir = directory
+		blog_instance.lazy_bodies = True
+		blog_instance.parseArticles()
+		articles = list(blog_instance.getArticles())
+	finally:
+		shutil.rmtree(directory)
+
+	before = SizeOf([DictArticle(article) for article in articles]) / float(count)
+	after = SizeOf(articles) / float(count)
+
+	print('Articles:                    %d' % (count,))
+	print('Bytes per article (before):  %.1f' % (before,))
+	print('Bytes per article (after):   %.1f' % (after,))
+	print('Saved:                       %.1f%%' % (100 * (before - after) / before,))
+
+
+if __name__ == '__main__':
+	Main()
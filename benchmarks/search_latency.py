@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+	Measure how long a /search takes at scale: a page of results for a term
+	in about one article in ten, and for a rare one, from a Blog of many
+	articles.  Exits with status 1 if the common search is slower than the
+	target.
+
+	python benchmarks/search_latency.py [article count] [target milliseconds]
+'''
+
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import blog
+from utilities import LoggingOff
+
+
+def BuildBlog(count):
+	'''
+		Index count articles, each a few dozen words from a small vocabulary,
+		plus one word shared by every tenth article and one unique to each.
+	'''
+	blog_instance = blog.Blog(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'no_config'))
+	start = datetime.date(2014, 1, 1)
+	with blog_instance.changes():
+		for number in range(count):
+			words = ' '.join('word%d' % ((number * 7 + offset * 13) % 5000,) for offset in range(40))
+			if number % 10 == 0:
+				words += ' common'
+			body = '<p>Article number %d, unique%d. %s</p>' % (number, number, words)
+			date = start + datetime.timedelta(days=number % 730)
+			blog_instance.indexArticle(blog.Article(title='article_%d' % (number,), body=body, date=date))
+	return blog_instance
+
+
+def Time(function, repeat = 20):
+	'''
+		The best of repeat runs of function, in milliseconds.
+	'''
+	best = None
+	for attempt in range(repeat):
+		started = time.time()
+		function()
+		elapsed = (time.time() - started) * 1000
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def Main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	target = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+	LoggingOff()
+
+	blog_instance = BuildBlog(count)
+	index = blog_instance.snapshot
+	# The first search after a change also works out the length normalizations.
+	first = Time(lambda: index.searchArticles('common'), 1)
+	common = Time(lambda: index.searchArticles('common'))
+	later_page = Time(lambda: index.searchArticles('common', page=5))
+	rare = Time(lambda: index.searchArticles('unique%d' % (count // 2,)))
+
+	print('Articles:                     %d' % (count,))
+	print('First search after a change:  %.1f ms' % (first,))
+	print('Common term (10%%), page 1:    %.1f ms' % (common,))
+	print('Common term (10%%), page 5:    %.1f ms' % (later_page,))
+	print('Rare term:                    %.1f ms' % (rare,))
+	print('Target:                       %.1f ms' % (target,))
+	if common > target:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	Main()
@@ -1,25 +1,146 @@
 # Embedded file name: blog.py
 
 #TODO: probably make most of the imports from style.
-from collections import defaultdict
+import bisect
+import calendar
+import contextlib
 import datetime
 from datetime import date
+import gc
+import multiprocessing
 import os
 import re
-import shutil
+import threading
+import time
 import traceback
-import urllib
+
+try:
+	from urllib import quote
+except ImportError:
+	from urllib.parse import quote
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
 
 from bottle import route, run, template
+from search import SearchIndex
 from transformations import Transform
-from utilities import Log
+from utilities import Log, LRUCache
+
+# os.scandir only exists from python 3.5 on; fall back to os.walk and os.stat otherwise.
+try:
+	from os import scandir
+except ImportError:
+	scandir = None
+
+
+def ParseDate(value):
+	"""
+		Parse a yyyy-mm-dd date, ignoring anything after the first space.
+		Well formed dates skip strptime entirely.
+	
+		:param value: The date string.
+	"""
+	value = value.split(' ')[0]
+	if len(value) == 10 and value[4] == '-' and value[7] == '-':
+		try:
+			return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+		except ValueError as e:
+			pass
+	return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def ParseTags(value):
+	"""
+		Split a comma separated list of tags.
+	
+		:param value: The tags string.
+	"""
+	return [ tag.strip() for tag in value.split(',') ]
+
+
+class MetadataScanner(object):
+	"""
+		Pulls every _key=value; metadata field out of an article body in one pass.
+	"""
+
+	def __init__(self):
+		self.fields = {}
+		self.pattern = None
+
+	def register(self, key, convert = None, attribute = None):
+		"""
+			Add a metadata field to scan for.
+		
+			:param key: The field name, as written after the leading underscore.
+			:param convert: Optional function to turn the raw string into the stored value.
+			:param attribute: The Article attribute to set; without one the value goes in Article.metadata.
+		"""
+		self.fields[key] = (attribute, convert)
+		keys = '|'.join(re.escape(field) for field in sorted(self.fields))
+		# A value ends at its ;, or failing that where the comment or the next field starts, so that it can't swallow the next field.
+		self.pattern = re.compile('_(%s)=((?:(?!-->|_(?:%s)=)[^;])*)(?:;|(?=-->|_(?:%s)=))' % (keys, keys, keys))
+
+	def scan(self, body):
+		"""
+			Find the first value of each registered field.
+			Stops as soon as every field has been seen, which for articles
+			with their metadata in leading comments is right at the top.
+		
+			:param body: The text to scan.
+			:return: A dict of key to raw value.
+		"""
+		found = {}
+		for match in self.pattern.finditer(body):
+			if match.group(1) not in found:
+				found[match.group(1)] = match.group(2)
+				if len(found) == len(self.fields):
+					break
+		return found
+
+	def apply(self, article, body):
+		"""
+			Scan a body and set the fields found on an article.
+		
+			:param article: The Article to update.
+			:param body: The text to scan.
+		"""
+		for key, value in self.scan(body).items():
+			attribute, convert = self.fields[key]
+			if convert:
+				value = convert(value)
+			if attribute:
+				setattr(article, attribute, value)
+			else:
+				if article.metadata is None:
+					article.metadata = {}
+				article.metadata[key] = value
+
+
+metadata_scanner = MetadataScanner()
+metadata_scanner.register('title', attribute='title')
+metadata_scanner.register('date', ParseDate, 'date')
+metadata_scanner.register('category', attribute='category')
+metadata_scanner.register('tags', ParseTags, 'tags')
 
 
-class Article:
+class Article(object):
 	"""
 		This class describes an article object.  Contains all metadata and content.
+
+		The body may be unloaded (see unloadBody), in which case only an excerpt
+		stays in memory and the body is re-read through a shared cache when used.
+
+		Articles are slotted, as a Blog may hold a great many of them.
 	"""
 
+	__slots__ = ('path', 'web_path', '_body', '_excerpt', 'body_cache', 'title', 'date', 'dated', 'category', 'tags', 'metadata')
+
+	# How much of the body list pages show.
+	excerpt_length = 1000
+
 	def __init__(self, path = None, body = None, title = None, date = None, category = None, tags = []):
 		"""
 			Initialize an article.  If a path is given, and a body is not,
@@ -36,11 +157,14 @@ class Article:
 		"""
 		self.path = None
 		self.web_path = None
+		self._excerpt = None
+		self.body_cache = None
 		self.body = None
 		self.title = None
 		self.date = None
 		self.category = None
 		self.tags = []
+		self.metadata = None
 		if path:
 			self.path = path
 			self.title = os.path.basename(path)
@@ -59,15 +183,10 @@ class Article:
 			self.category = category
 		if tags:
 			self.tags = tags
-		date_in_file = self.date
+		# Undated articles default to today; a Blog then swaps in the date it first saw them. (see DateLedger)
+		self.dated = bool(self.date)
 		if not self.date:
 			self.date = datetime.date.today()
-		if self.path and not date_in_file:
-			try:
-				with open(self.path, 'a') as f:
-					f.write('<!--_date=%s;-->' % str(self.date))
-			except IOError as e:
-				self.date = datetime.date.fromtimestamp(os.path.getctime(self.path))
 
 		Log('Created Article: ', self.path, ' : ', self.title, ' : ', self.date, ' : ', self.category, ' : ', self.tags)
 		return
@@ -80,42 +199,703 @@ class Article:
 		
 			:param body: the string to use as the body.
 		"""
-		title_match = re.search('_title=([^;]*);', body)
-		date_match = re.search('_date=([^;]*);', body)
-		category_match = re.search('_category=([^;]*);', body)
-		tags_match = re.search('_tags=([^;]*);', body)
-		if title_match:
-			self.title = title_match.group(1)
-		if date_match:
-			self.date = datetime.datetime.strptime(date_match.group(1).split(' ')[0], '%Y-%m-%d').date()
-		if category_match:
-			self.category = category_match.group(1)
-		if tags_match:
-			self.tags = [ tag.strip() for tag in tags_match.group(1).split(',') ]
+		metadata_scanner.apply(self, body)
 		self.body = Transform(body)
 		return self.body
 
+	@property
+	def body(self):
+		"""
+			The transformed body of the article; loaded through the
+			body cache if it has been unloaded.
+		"""
+		if self._body is None and self.body_cache is not None:
+			body = self.body_cache.get(self.path)
+			if body is None:
+				with open(self.path) as f:
+					body = Transform(f.read())
+				self.body_cache.put(self.path, body)
+			return body
+		return self._body
+
+	@body.setter
+	def body(self, body):
+		self._body = body
+		self._excerpt = None
+		self.body_cache = None
+
+	@property
+	def excerpt(self):
+		"""
+			The start of the body, as shown on list pages.
+		"""
+		if self._excerpt is not None:
+			return self._excerpt
+		if self._body is None:
+			return self._body
+		return self._body[:self.excerpt_length]
+
+	def unloadBody(self, body_cache):
+		"""
+			Drop the body from memory, keeping only the excerpt.
+			Later reads of body re-read and transform the file, through body_cache.
+		
+			:param body_cache: The LRUCache to load the body through.
+		"""
+		if not self.path:
+			return
+		excerpt = self.excerpt
+		self._body = None
+		self._excerpt = excerpt
+		self.body_cache = body_cache
+
+	def toRecord(self):
+		"""
+			Get the parsed state of the article as a compact, picklable tuple.
+		"""
+		return (self.path, self._body, self._excerpt, self.title, self.date, self.dated, self.category, self.tags, self.metadata, self.web_path)
+
+	def __getstate__(self):
+		return self.toRecord()
+
+	def __setstate__(self, record):
+		# Unpickled articles have no body cache until their Blog gives them its own.
+		(self.path, self._body, self._excerpt, self.title, self.date, self.dated, self.category, self.tags, self.metadata, self.web_path) = record
+		self.body_cache = None
+
+	def copy(self):
+		"""
+			Get an article with the same state, to change without changing this one.
+		"""
+		return Article.fromRecord(self.toRecord(), self.body_cache)
+
+	@classmethod
+	def fromRecord(cls, record, body_cache = None):
+		"""
+			Rebuild an article from a record made by toRecord,
+			without re-reading or re-parsing anything.
+		
+			:param record: The record to rebuild from.
+			:param body_cache: The LRUCache to load the body through, if the record has none.
+		"""
+		article = cls.__new__(cls)
+		article.__setstate__(record)
+		article.body_cache = body_cache if article._body is None else None
+		return article
+
 	def setWebPath(self, path):
 		"""
 			Set the URL-valid path to be used to access this article
 		
 			:param path: the un-quoted path to use.
 		"""
-		self.web_path = urllib.quote(path)
+		self.web_path = quote(path)
+
+
+def StatFile(path):
+	"""
+		Get the (inode, mtime, size) signature of a file.
+	
+		:param path: The file to stat.
+	"""
+	stat = os.stat(path)
+	return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def ParseArticleRecord(article_path):
+	"""
+		Parse a single file into an Article record. (see Article.toRecord)
+		This is what ingest worker processes run, so failures are returned rather than raised.
+	
+		:param article_path: The file to parse.
+		:return: (path, signature, record, error)
+	"""
+	try:
+		signature = StatFile(article_path)
+		return (article_path, signature, Article(article_path).toRecord(), None)
+	except Exception as e:
+		return (article_path, None, None, traceback.format_exc())
+
+
+def DateKey(article):
+	"""
+		Sort key putting articles newest first, then by title.
+	
+		:param article: The article to get the key of.
+	"""
+	return (-article.date.toordinal(), article.title)
+
+
+class DateIndex(object):
+	"""
+		All articles, kept sorted newest first (see DateKey) as they are added
+		and removed, so recent and date range queries are a bisect and a slice.
+	"""
+
+	def __init__(self):
+		self.keys = []
+		self.articles = []
+
+	def __len__(self):
+		return len(self.articles)
+
+	def copy(self):
+		"""
+			Get an index of the same articles that can be changed without changing this one.
+		"""
+		clone = DateIndex()
+		clone.keys = list(self.keys)
+		clone.articles = list(self.articles)
+		return clone
+
+	def add(self, article):
+		"""
+			Insert an article in date order.
+		
+			:param article: The article to insert.
+		"""
+		key = DateKey(article)
+		position = bisect.bisect_right(self.keys, key)
+		self.keys.insert(position, key)
+		self.articles.insert(position, article)
+
+	def remove(self, article):
+		"""
+			Remove an article, if it is in the index.
+		
+			:param article: The article to remove.
+		"""
+		key = DateKey(article)
+		position = bisect.bisect_left(self.keys, key)
+		while position < len(self.keys) and self.keys[position] == key:
+			if self.articles[position] is article:
+				del self.keys[position]
+				del self.articles[position]
+				return
+			position += 1
+
+	def recent(self, number_to_get):
+		"""
+			Get the number_to_get newest articles.
+		
+			:param number_to_get: The number of articles to return.
+		"""
+		return self.articles[:number_to_get]
+
+	def isRecent(self, article, number_to_get):
+		"""
+			Is an article among the number_to_get newest?
+		
+			:param article: The article to look for.
+			:param number_to_get: The number of newest articles to look through.
+		"""
+		return any(recent is article for recent in self.articles[:number_to_get])
+
+	def between(self, start, end):
+		"""
+			Get the articles dated from start to end, inclusive, newest first.
+		
+			:param start: The earliest date to include.
+			:param end: The latest date to include.
+		"""
+		first = bisect.bisect_left(self.keys, (-end.toordinal(),))
+		last = bisect.bisect_left(self.keys, (-start.toordinal() + 1,))
+		return self.articles[first:last]
+
+
+class PostingList(object):
+	"""
+		The articles filed under one category or tag.
+
+		Adding, removing and membership are O(1).  The date ordered view
+		(see DateKey) is rebuilt the first time it is asked for after a change,
+		as a new list, so a view already handed out never changes under its reader.
+	"""
+
+	def __init__(self):
+		self.members = set()
+		self.view = []
+		self.stale = False
+
+	def __len__(self):
+		return len(self.members)
+
+	def __contains__(self, article):
+		return article in self.members
+
+	def __iter__(self):
+		return iter(self.sorted())
+
+	def copy(self):
+		"""
+			Get a posting list of the same articles that can be changed without changing this one.
+		"""
+		clone = PostingList()
+		clone.members = set(self.members)
+		# Views are replaced rather than modified, so sharing one is safe.
+		clone.view = self.view
+		clone.stale = self.stale
+		return clone
+
+	def add(self, article):
+		"""
+			File an article here.
+		
+			:param article: The article to add.
+		"""
+		self.members.add(article)
+		self.stale = True
+
+	def remove(self, article):
+		"""
+			Take an article out, if it is here.
+		
+			:param article: The article to remove.
+		"""
+		self.members.discard(article)
+		self.stale = True
+
+	def sorted(self):
+		"""
+			Get the articles, newest first.  Callers must not modify the list.
+		"""
+		if self.stale:
+			self.view = sorted(self.members, key=DateKey)
+			self.stale = False
+		return self.view
+
+
+class FacetIndex(object):
+	"""
+		Bitsets of the articles under each tag, category, year and month,
+		for answering combined AND/OR/NOT facet queries.
+
+		Every article gets a small integer id (reused once freed, to keep the
+		sets dense), and each facet is a python int with those ids' bits set.
+		Facets are keyed ('tag', tag), ('category', category), ('year', year)
+		and ('month', (year, month)).
+	"""
+
+	def __init__(self):
+		self.ids = {}
+		self.articles = []
+		self.free_ids = []
+		self.bitsets = {}
+		self.live = 0
+
+	def copy(self):
+		"""
+			Get an index of the same articles that can be changed without changing this one.
+		"""
+		clone = FacetIndex()
+		clone.ids = dict(self.ids)
+		clone.articles = list(self.articles)
+		clone.free_ids = list(self.free_ids)
+		# Bitsets are ints, so never change in place.
+		clone.bitsets = dict(self.bitsets)
+		clone.live = self.live
+		return clone
+
+	def facetsOf(self, article):
+		"""
+			Get the facet keys an article is filed under.
+		
+			:param article: The article.
+		"""
+		facets = [('tag', tag) for tag in article.tags]
+		if article.category:
+			facets.append(('category', article.category))
+		facets.append(('year', article.date.year))
+		facets.append(('month', (article.date.year, article.date.month)))
+		return facets
+
+	def add(self, article):
+		"""
+			Give an article an id and set its bit in each of its facets.
+		
+			:param article: The article to add.
+		"""
+		if article in self.ids:
+			return
+		if self.free_ids:
+			article_id = self.free_ids.pop()
+			self.articles[article_id] = article
+		else:
+			article_id = len(self.articles)
+			self.articles.append(article)
+		self.ids[article] = article_id
+
+		bit = 1 << article_id
+		self.live |= bit
+		for facet in self.facetsOf(article):
+			self.bitsets[facet] = self.bitsets.get(facet, 0) | bit
+
+	def remove(self, article):
+		"""
+			Clear an article's bits and free its id.
+		
+			:param article: The article to remove.
+		"""
+		article_id = self.ids.pop(article, None)
+		if article_id is None:
+			return
+		self.articles[article_id] = None
+		self.free_ids.append(article_id)
+
+		mask = ~(1 << article_id)
+		self.live &= mask
+		for facet in self.facetsOf(article):
+			bits = self.bitsets.get(facet, 0) & mask
+			if bits:
+				self.bitsets[facet] = bits
+			else:
+				self.bitsets.pop(facet, None)
+
+	def query(self, all_of = (), any_of = (), none_of = ()):
+		"""
+			Get the bitset of articles in every facet of all_of,
+			at least one facet of any_of (if given), and no facet of none_of.
+		
+			:param all_of: Facet keys that must all match.
+			:param any_of: Facet keys of which one must match.
+			:param none_of: Facet keys that must not match.
+		"""
+		bits = self.live
+		for facet in all_of:
+			bits &= self.bitsets.get(facet, 0)
+		if any_of:
+			union = 0
+			for facet in any_of:
+				union |= self.bitsets.get(facet, 0)
+			bits &= union
+		for facet in none_of:
+			bits &= ~self.bitsets.get(facet, 0)
+		return bits
+
+	def count(self, bits):
+		"""
+			Count the articles in a bitset.
+		
+			:param bits: A bitset from query.
+		"""
+		return bin(bits).count('1')
+
+	def articlesOf(self, bits, limit = None, date_order = None):
+		"""
+			Get the articles in a bitset, newest first.
+		
+			:param bits: A bitset from query.
+			:param limit: The most articles to return. (default = all)
+			:param date_order: Every article in the index, newest first (see DateIndex); with a
+				limit, it is walked until enough articles match, when that beats sorting them all.
+		"""
+		# Reversed, so that the character at position n is bit n.
+		digits = bin(bits)[:1:-1]
 
+		if limit is not None and date_order is not None:
+			count = digits.count('1')
+			# About limit * len(date_order) / count articles need looking at, against sorting count.
+			if count and limit * len(date_order) < count * count:
+				articles = []
+				for article in date_order:
+					article_id = self.ids[article]
+					if article_id < len(digits) and digits[article_id] == '1':
+						articles.append(article)
+						if len(articles) == limit:
+							break
+				return articles
 
-class Blog:
+		articles = []
+		position = digits.find('1')
+		while position != -1:
+			articles.append(self.articles[position])
+			position = digits.find('1', position + 1)
+		articles.sort(key=DateKey)
+		return articles if limit is None else articles[:limit]
+
+
+class DateLedger(object):
+	"""
+		An append-only journal of the date each undated article was first seen,
+		so that articles keep their dates without their files being modified.
+
+		Each line is a yyyy-mm-dd date, a tab, and the article title.
+		New dates are held in memory until flush, which appends them all with a single fsync.
+	"""
+
+	def __init__(self, path):
+		"""
+			:param path: The journal file; empty to keep dates in memory only.
+		"""
+		self.path = path
+		self.dates = None
+		self.pending = []
+
+	def load(self):
+		"""
+			Read the journal, if that hasn't been done yet.
+		"""
+		if self.dates is not None:
+			return
+		self.dates = {}
+		if not self.path or not os.path.exists(self.path):
+			return
+		with open(self.path) as f:
+			for line in f:
+				try:
+					date_string, title = line.rstrip('\n').split('\t', 1)
+					self.dates.setdefault(title, ParseDate(date_string))
+				except ValueError as e:
+					Log('Skipping malformed date ledger line: ' + line)
+
+	def get(self, title):
+		"""
+			Get the recorded date for an article, or None.
+		
+			:param title: The title of the article.
+		"""
+		self.load()
+		return self.dates.get(title)
+
+	def record(self, title, date):
+		"""
+			Record the date an article was first seen.  Written out on the next flush.
+		
+			:param title: The title of the article.
+			:param date: The date to record.
+		"""
+		self.load()
+		if title in self.dates or '\n' in title:
+			return
+		self.dates[title] = date
+		self.pending.append('%s\t%s\n' % (str(date), title))
+
+	def flush(self):
+		"""
+			Append every pending record to the journal, and fsync it once.
+		"""
+		if not self.pending or not self.path:
+			self.pending = []
+			return
+		try:
+			with open(self.path, 'a') as f:
+				f.write(''.join(self.pending))
+				f.flush()
+				os.fsync(f.fileno())
+			self.pending = []
+		except (IOError, OSError) as e:
+			Log('Unable to write date ledger: ' + self.path)
+			Log(traceback.format_exc())
+
+
+class IndexReader(object):
+	"""
+		Queries over a set of indexes: the articles and staged articles by
+		title, categories and tags (PostingLists), a DateIndex, a FacetIndex
+		and a SearchIndex.  Shared by a Blog, which reads its indexes as they
+		are being changed, and the IndexSnapshots it publishes for requests.
+	"""
+
+	def getRecentArticles(self, number_to_get = 10):
+		"""
+			Get number_to_get most recent articles.
+		
+			:param number_to_get: The number of articles to return.
+		"""
+		return self.date_index.recent(number_to_get)
+
+	def getArticlesByDate(self, year, month = None, day = None):
+		"""
+			Get all articles from a given year, month or day, newest first.
+		
+			:param year: The year to enumerate.
+			:param month: Optionally, the month within the year.
+			:param day: Optionally, the day within the month.
+		"""
+		try:
+			if day:
+				start = end = datetime.date(year, month, day)
+			elif month:
+				start = datetime.date(year, month, 1)
+				end = datetime.date(year, month, calendar.monthrange(year, month)[1])
+			else:
+				start = datetime.date(year, 1, 1)
+				end = datetime.date(year, 12, 31)
+		except ValueError as e:
+			return []
+
+		return self.date_index.between(start, end)
+
+	def queryArticles(self, tags = (), any_tags = (), exclude_tags = (), categories = (), years = (), months = (), page = 1, per_page = 20):
+		"""
+			Find the articles matching a combination of facets, newest first.
+			Categories, years and months each match any one of those given;
+			a month is a (year, month) pair.
+		
+			:param tags: Tags the articles must all have.
+			:param any_tags: Tags of which the articles must have at least one.
+			:param exclude_tags: Tags the articles must not have.
+			:param categories: Categories the articles may be in.
+			:param years: Years the articles may be from.
+			:param months: (year, month) pairs the articles may be from.
+			:param page: The page of results to return, from 1.
+			:param per_page: The number of articles per page.
+			:return: (number of matching articles, the articles on the page)
+		"""
+		bits = self.facets.query(
+			[('tag', tag) for tag in tags],
+			[('tag', tag) for tag in any_tags],
+			[('tag', tag) for tag in exclude_tags])
+		for name, values in (('category', categories), ('year', years), ('month', months)):
+			if values:
+				bits &= self.facets.query(any_of=[(name, value) for value in values])
+
+		# Only articles dated within both the years and the months asked for can match,
+		# so only they need walking.
+		date_order = self.date_index.articles
+		try:
+			earliest, latest = date.min, date.max
+			if years:
+				earliest = max(earliest, date(min(years), 1, 1))
+				latest = min(latest, date(max(years), 12, 31))
+			if months:
+				first, last = min(months), max(months)
+				earliest = max(earliest, date(first[0], first[1], 1))
+				latest = min(latest, date(last[0], last[1], calendar.monthrange(*last)[1]))
+			if years or months:
+				date_order = self.date_index.between(earliest, latest) if earliest <= latest else []
+		except (ValueError, IndexError, TypeError):
+			# Not a real date or (year, month) pair, so no article is filed under it; walk everything.
+			pass
+
+		start = (max(page, 1) - 1) * per_page
+		articles = self.facets.articlesOf(bits, start + per_page, date_order)
+		return (self.facets.count(bits), articles[start:])
+
+	def searchArticles(self, query, page = 1, per_page = 20):
+		"""
+			Full text search over article titles and bodies, best match first.
+		
+			:param query: The words to search for.
+			:param page: The page of results to return, from 1.
+			:param per_page: The number of articles per page.
+			:return: (number of matching articles, the articles on the page)
+		"""
+		scores = self.search_index.score(query)
+		start = (max(page, 1) - 1) * per_page
+		# Only the pages up to this one need ranking.
+		results = self.search_index.rank(scores, start + per_page)
+		return (len(scores), [self.articles[title] for title, score in results[start:start + per_page]])
+
+	def getArticles(self):
+		"""
+			Get a list of all articles.
+		"""
+		return self.articles.values()
+
+	def getArticle(self, article):
+		"""
+			Get an Article object of a given title,
+			must have been parsed in prior.
+		
+			:param article: The title of the article to get.
+		"""
+		return self.articles[article]
+
+	def getCategories(self):
+		"""
+			Get a list of all categories.
+		"""
+		return self.categories.keys()
+
+	def getArticlesByCategory(self, category):
+		"""
+			Get all articles within a given category, newest first.
+			The list is shared; don't modify it.
+		
+			:param category: The category to enumerate.
+		"""
+		if category in self.categories:
+			return self.categories[category].sorted()
+		return []
+
+	def getTags(self):
+		"""
+			Get a list of all tags.
+		"""
+		return self.tags.keys()
+
+	def getArticlesByTag(self, tag):
+		"""
+			Get all articles within a given tag, newest first.
+			The list is shared; don't modify it.
+			:param tag: The tag to enumerate.
+		"""
+		if tag in self.tags:
+			return self.tags[tag].sorted()
+		return []
+
+	def getStagedArticles(self):
+		"""
+			Get a list of all staged articles.
+		"""
+		return self.staged_articles.values()
+
+	def getStagedArticle(self, article):
+		"""
+			Get a staged Article object of a given title,
+			must have been parsed in prior.
+		
+			:param article: the title of the article to get.
+		"""
+		return self.staged_articles[article]
+
+
+class IndexSnapshot(IndexReader):
+	"""
+		A Blog's indexes as they were when it was published.  Nothing in a
+		snapshot is ever changed; the Blog copies whatever it changes next
+		(see Blog.writable), so any number of readers can share one without
+		locking, and never see half of a change.
+	"""
+
+	def __init__(self, blog_instance):
+		"""
+			:param blog_instance: The Blog whose current indexes to publish.
+		"""
+		self.articles = blog_instance.articles
+		self.staged_articles = blog_instance.staged_articles
+		self.categories = blog_instance.categories
+		self.tags = blog_instance.tags
+		self.date_index = blog_instance.date_index
+		self.facets = blog_instance.facets
+		self.search_index = blog_instance.search_index
+		self.version = blog_instance.version
+		self.sidebar_version = blog_instance.sidebar_version
+
+
+class Blog(IndexReader):
 	"""
 		The primary blog class.
 	
 		Contains all articles and staged_articles, sorted in various ways.
 	"""
 
+	# Rescans with fewer new or changed files than this are parsed in-process even when ingest_workers is set.
+	parallel_threshold = 32
+
+	# Bump whenever the layout saved by saveIndex changes; older caches are then ignored.
+	index_cache_version = 6
+	# How many recent articles the sidebar lists. (see views/sidebar.tpl)
+	sidebar_recent = 10
+
 	def __init__(self, cfg_path = './blog.ini'):
 		"""
 			Initialize a blog object.
 		
-			Reads title, sub_title, article_dir and staging from config file.
+			Reads title, sub_title, article_dir, staging_dir,
+			watcher, watch_interval, ingest_workers, lazy_bodies,
+			body_cache_bytes, index_cache and date_ledger from config file.
 		
 			:param cfg_path: the config file for the blog.
 		"""
@@ -124,11 +904,60 @@ class Blog:
 		self.sub_title = 'I promise, it is.'
 		self.article_dir = './articles/'
 		self.staging_dir = './staging/'
-		self.categories = defaultdict(list)
-		self.tags = defaultdict(list)
+		self.watcher = 'auto'
+		self.watch_interval = 1.0
+		# Up to this many seconds are added to each polling interval, so forked workers don't all rescan at once.
+		self.watch_jitter = 0.25
+		# Processes used to parse articles; 1 parses in-process, 0 uses one per CPU.
+		self.ingest_workers = 1
+		# When set, only article excerpts are kept in memory and bodies are read through body_cache.
+		self.lazy_bodies = False
+		self.body_cache = LRUCache(16 * 1024 * 1024)
+		# Size of the rendered page cache. (see routes.py)
+		self.page_cache_bytes = 32 * 1024 * 1024
+		# Cached pages at least this long are also kept gzipped, at this zlib level.
+		self.gzip_min_size = 1024
+		self.gzip_level = 6
+		# Threaded servers keep connections open for further requests, for this many seconds idle and this many requests.
+		self.keep_alive_timeout = 5.0
+		self.keep_alive_requests = 100
+		# Where the parsed index is saved between runs; empty to disable.
+		self.index_cache = ''
+		# When undated articles were first seen; the path is set from the date_ledger config.
+		self.date_ledger = DateLedger('')
+		# Held by anything that changes the indexes. (see changes)
+		self.lock = threading.RLock()
+		# Shared instances of the categories, tag lists and dates articles use. (see internArticle)
+		self.symbols = {}
+		self.categories = {}
+		self.tags = {}
 		self.articles = {}
 		self.staged_articles = {}
-		self.articles_by_date = defaultdict(lambda : defaultdict(lambda : defaultdict(lambda : {})))
+		# path -> (inode, mtime, size, title) for every file ingested, so rescans can skip unchanged files.
+		self.manifest = {}
+		self.staged_manifest = {}
+		self.date_index = DateIndex()
+		self.facets = FacetIndex()
+		self.search_index = SearchIndex()
+		# Goes up whenever an article or staged article changes.
+		self.version = 0
+		# Goes up only when the recent articles, categories or tags the sidebar lists change.
+		self.sidebar_version = 0
+		# Called with what each change touched. (see changed)
+		self.listeners = []
+		# dependency -> when it last changed, for Last-Modified times. (see lastModified)
+		self.modified = {}
+		# What has changed since the last snapshot was published, and how deeply changes are nested. (see changes)
+		self.pending_changes = []
+		self.change_depth = 0
+		# id -> index made since the last snapshot was published, so only changed by this Blog. (see writable)
+		self.unshared = {}
+		# The indexes as last published, for readers. (see publish)
+		self.snapshot = IndexSnapshot(self)
+		# When the last rescan finished, or None before the first. (see refresh)
+		self.last_refresh = None
+		# The background thread keeping the indexes current. (see startRefresher)
+		self.refresher = None
 		try:
 			self.loadConfig(cfg_path)
 		except IOError as e:
@@ -141,7 +970,10 @@ class Blog:
 	def loadConfig(self, cfg_path):
 		"""
 			Load various metadata from the config file.
-			(title, sub_title, article_dir, staging_dir)
+			(title, sub_title, article_dir, staging_dir, watcher, watch_interval, watch_jitter,
+			ingest_workers, lazy_bodies, body_cache_bytes, page_cache_bytes,
+			gzip_min_size, gzip_level, keep_alive_timeout, keep_alive_requests,
+			index_cache, date_ledger)
 		
 			:param cfg_path: The path to the config file.
 		"""
@@ -157,48 +989,284 @@ class Blog:
 					self.article_dir = value
 				if parameter == 'staging_dir':
 					self.staging_dir = value
+				if parameter == 'watcher':
+					self.watcher = value.lower()
+				if parameter == 'watch_interval':
+					self.watch_interval = float(value)
+				if parameter == 'watch_jitter':
+					self.watch_jitter = float(value)
+				if parameter == 'ingest_workers':
+					self.ingest_workers = int(value)
+				if parameter == 'lazy_bodies':
+					self.lazy_bodies = value.lower() in ('true', 'yes', 'on', '1')
+				if parameter == 'body_cache_bytes':
+					self.body_cache.max_bytes = int(value)
+				if parameter == 'index_cache':
+					self.index_cache = value
+				if parameter == 'page_cache_bytes':
+					self.page_cache_bytes = int(value)
+				if parameter == 'gzip_min_size':
+					self.gzip_min_size = int(value)
+				if parameter == 'gzip_level':
+					self.gzip_level = int(value)
+				if parameter == 'keep_alive_timeout':
+					self.keep_alive_timeout = float(value)
+				if parameter == 'keep_alive_requests':
+					self.keep_alive_requests = int(value)
+				if parameter == 'date_ledger':
+					self.date_ledger = DateLedger(value)
 			except IndexError as e:
 				pass
 
+	def saveIndex(self):
+		"""
+			Save the parsed articles and staged articles, every index built from
+			them and the manifests to index_cache, so the next start can skip
+			parsing and indexing anything that has not changed.
+			The file is replaced atomically.
+		"""
+		if not self.index_cache:
+			return
+
+		temporary_path = self.index_cache + '.tmp'
+		try:
+			# Held so that no index changes part way through; articles are pickled once, however many indexes hold them.
+			with self.lock:
+				cache = {
+					'version': self.index_cache_version,
+					'article_dir': self.article_dir,
+					'staging_dir': self.staging_dir,
+					'articles': self.articles,
+					'staged_articles': self.staged_articles,
+					'categories': self.categories,
+					'tags': self.tags,
+					'date_index': self.date_index,
+					'facets': self.facets,
+					'search_index': self.search_index,
+					'symbols': self.symbols,
+					'manifest': self.manifest,
+					'staged_manifest': self.staged_manifest,
+				}
+				with open(temporary_path, 'wb') as f:
+					pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+			os.rename(temporary_path, self.index_cache)
+		except (IOError, OSError) as e:
+			Log('Unable to save index cache: ' + self.index_cache)
+			Log(traceback.format_exc())
+
+	def loadIndex(self):
+		"""
+			Load the index saved by saveIndex into this (still empty) Blog.
+			Nothing is read from the article files, and nothing is re-indexed;
+			the next parseArticles and parseStagedArticles only re-ingest and
+			re-index files whose stat data changed.
+		
+			:return: Whether a usable cache was loaded.
+		"""
+		if not self.index_cache or not os.path.exists(self.index_cache):
+			return False
+
+		# Unpickling makes a great many objects at once; collecting garbage part way through only slows it down.
+		collecting = gc.isenabled()
+		gc.disable()
+		try:
+			with open(self.index_cache, 'rb') as f:
+				cache = pickle.load(f)
+		except Exception as e:
+			Log('Unable to load index cache: ' + self.index_cache)
+			Log(traceback.format_exc())
+			return False
+		finally:
+			if collecting:
+				gc.enable()
+
+		if not isinstance(cache, dict) or cache.get('version') != self.index_cache_version:
+			Log('Ignoring index cache from another version: ' + self.index_cache)
+			return False
+		if cache['article_dir'] != self.article_dir or cache['staging_dir'] != self.staging_dir:
+			Log('Ignoring index cache for other directories: ' + self.index_cache)
+			return False
+
+		with self.changes():
+			for name in ('articles', 'staged_articles', 'categories', 'tags', 'date_index', 'facets', 'search_index', 'symbols', 'manifest', 'staged_manifest'):
+				setattr(self, name, cache[name])
+			for article in list(self.articles.values()) + list(self.staged_articles.values()):
+				if article._body is None:
+					article.body_cache = self.body_cache
+				elif self.lazy_bodies:
+					article.unloadBody(self.body_cache)
+			self.changed([('articles',), ('staged',), ('sidebar',)])
+
+		Log('Loaded %d articles from index cache: %s' % (len(self.articles), self.index_cache))
+		return True
+
 	def deploy(self, staged_article = None):
 		"""
 			Deply from staging to prod.
 			If no article is specified, deploys all.
+			Either every article asked for is deployed, or none are. (see deployArticles)
 		
 			:param staged_article: The title or article instance of the article to deploy.
+			:return: The number of articles deployed.
 		"""
-		deploy_count = 0
-		for title, article in self.staged_articles.iteritems():
-			if not staged_article or staged_article == title or staged_article == article:
-				if 'TODO:' in article.body:
-					Log('Deploy gate failed, TODO found.  (Article: %s)' % (title,))
-					break
-				try:
-					os.makedirs(self.article_dir)
-				except OSError as e:
-					pass
+		if staged_article is None:
+			titles = None
+		elif isinstance(staged_article, Article):
+			titles = [staged_article.title]
+		else:
+			titles = [staged_article]
 
-				shutil.move(article.path, self.article_dir)
-				article.path = os.path.join(self.article_dir, os.path.basename(article.path))
-				article.setWebPath('/articles/' + title)
-				self.indexArticle(article)
-				deploy_count += 1
+		results = self.deployArticles(titles)
+		return len([title for (title, error) in results if error is None])
 
-		return deploy_count
+	def deployArticles(self, titles = None):
+		"""
+			Deploy a batch of staged articles all together, or not at all.
+			Every article is checked before any is moved: it has to be staged,
+			have no TODO: in its body, not replace an existing file and be on
+			the same filesystem as article_dir, so that each move is a single
+			os.rename.  The index changes are then published as one snapshot,
+			with a single notification to the listeners.
+		
+			:param titles: The titles of the staged articles to deploy; all of them if None.
+			:return: A list of (title, error) for each article, in order; error is None for those deployed.
+		"""
+		with self.changes():
+			if titles is None:
+				titles = sorted(self.staged_articles)
+			unique_titles = []
+			for title in titles:
+				if title not in unique_titles:
+					unique_titles.append(title)
+
+			try:
+				os.makedirs(self.article_dir)
+			except OSError as e:
+				pass
+
+			errors = {}
+			moves = []
+			destinations = set()
+			for title in unique_titles:
+				article = self.staged_articles.get(title)
+				if not article:
+					errors[title] = 'Not a staged article.'
+					continue
+				destination = os.path.join(self.article_dir, os.path.basename(article.path))
+				error = self.deployError(article, destination)
+				if not error and destination in destinations:
+					error = 'Another article in the batch has the same file name.'
+				if error:
+					Log('Deploy gate failed: %s  (Article: %s)' % (error, title))
+					errors[title] = error
+					continue
+				moves.append((article, destination))
+				destinations.add(destination)
+
+			if not errors:
+				errors = self.moveAll(moves)
+
+			if errors:
+				return [(title, errors.get(title, 'Not deployed, since others in the batch could not be.')) for title in unique_titles]
+
+			for article, destination in moves:
+				self.removeStagedArticle(article.path)
+				# The staged article may still be in a published snapshot, so it's left as it is.
+				deployed = article.copy()
+				deployed.path = destination
+				deployed.setWebPath('/articles/' + article.title)
+				self.indexArticle(deployed)
+				self.manifest[destination] = StatFile(destination) + (article.title,)
+
+		Log('Deployed %d articles.' % (len(moves),))
+		return [(title, None) for title in unique_titles]
+
+	def deployError(self, article, destination):
+		"""
+			Check that a staged article can be deployed.
+		
+			:param article: The staged Article.
+			:param destination: Where its file would be moved to.
+			:return: Why it can't be, or None if it can.
+		"""
+		if 'TODO:' in article.body:
+			return 'TODO found.'
+		if os.path.exists(destination):
+			return 'Would replace ' + destination
+		try:
+			# os.rename can't move files across filesystems.
+			if os.stat(article.path).st_dev != os.stat(os.path.dirname(destination) or '.').st_dev:
+				return 'Not on the same filesystem as ' + self.article_dir
+		except OSError as e:
+			return 'Unable to stat: %s' % (e.strerror,)
+		return None
+
+	def moveAll(self, moves):
+		"""
+			Rename every staged article's file into place, putting back any
+			already moved if one of them fails.
+		
+			:param moves: A list of (article, destination).
+			:return: A dict of title -> error for the article that couldn't be moved; empty if all were.
+		"""
+		moved = []
+		for article, destination in moves:
+			try:
+				os.rename(article.path, destination)
+			except OSError as e:
+				Log('Unable to deploy %s: %s' % (article.path, e))
+				for moved_article, moved_destination in reversed(moved):
+					try:
+						os.rename(moved_destination, moved_article.path)
+					except OSError as rollback_error:
+						# Carry on putting back the rest; the original failure is what gets reported.
+						Log('Unable to put back %s: %s' % (moved_destination, rollback_error))
+				return {article.title: 'Unable to move %s: %s' % (article.path, e.strerror)}
+			moved.append((article, destination))
+		return {}
+
+	def refresh(self):
+		"""
+			Rescan the article and staging directories, publishing everything
+			found as one snapshot, so requests see all of the rescan or none of it.
+		
+			:return: The time the rescan finished.
+		"""
+		with self.changes():
+			self.parseArticles()
+			self.parseStagedArticles()
+			self.last_refresh = time.time()
+		return self.last_refresh
+
+	def startRefresher(self):
+		"""
+			Start the background thread that keeps the indexes current, as
+			configured by watcher, watch_interval and watch_jitter, so that
+			requests never have to rescan.  Does nothing if one is running.
+		
+			:return: The watcher thread, or None if watching is off.
+		"""
+		# watcher.py builds on this module.
+		from watcher import StartWatcher
+		if not self.refresher:
+			self.refresher = StartWatcher(self, self.watcher, self.watch_interval, self.watch_jitter)
+		return self.refresher
+
+	def stopRefresher(self):
+		"""
+			Stop the background refresher, if there is one.
+		"""
+		if self.refresher:
+			self.refresher.stop()
+			self.refresher = None
 
 	#TODO: should possibly condense these into a single ParseArticles/ParseArticle/Index chain? less clear though...
 	def parseStagedArticles(self):
 		"""
-			Ingest all files in the staging directory as Articles.
+			Ingest all new or changed files in the staging directory as Articles,
+			and drop any whose files have gone away.
 		"""
-		for dirpath, dirnames, filenames in os.walk(self.staging_dir):
-			for filename in filenames:
-				try:
-					self.parseStagedArticle(os.path.join(dirpath, filename))
-				except Exception as e:
-					Log('Failure parsing staged article: ' + filename)
-					Log(traceback.format_exc())
-					continue
+		self.rescanDirectory(self.staging_dir, self.staged_manifest, self.parseStagedArticle, self.addStagedArticle, self.removeStagedArticle)
 
 		return self.staged_articles
 
@@ -210,22 +1278,52 @@ class Blog:
 			:param article_file: The article filename to ingest.
 		"""
 		Log('Parsing staged article: ' + article_path)
-		article = Article(article_path)
+		signature = StatFile(article_path)
+		return self.addStagedArticle(article_path, signature, Article(article_path))
+
+	def addStagedArticle(self, article_path, signature, article):
+		"""
+			Take in a freshly parsed staged article, replacing
+			whatever was previously parsed from its file.
+		
+			:param article_path: The path the article was read from.
+			:param signature: The (inode, mtime, size) of the file before it was read.
+			:param article: The parsed Article.
+		"""
+		self.dateArticle(article)
+		self.internArticle(article)
 		article.setWebPath('/staging/' + article.title)
-		self.staged_articles[article.title] = article
+		with self.changes():
+			self.removeStagedArticle(article_path, article.title)
+			self.writable('staged_articles')[article.title] = article
+			self.staged_manifest[article_path] = signature + (article.title,)
+			self.changed([('staged',)])
+			if self.lazy_bodies:
+				article.unloadBody(self.body_cache)
+		return article
+
+	def removeStagedArticle(self, article_path, new_title = None):
+		"""
+			Forget the staged article that was ingested from a given file.
+		
+			:param article_path: The path the staged article was read from.
+			:param new_title: If the file is being re-ingested under this title, leave it be.
+		"""
+		entry = self.staged_manifest.pop(article_path, None)
+		self.body_cache.pop(article_path)
+		if not entry or entry[3] == new_title:
+			return
+		article = self.staged_articles.get(entry[3])
+		if article and article.path == article_path:
+			del self.writable('staged_articles')[entry[3]]
+			self.changed([('staged',)])
 
 	def parseArticles(self):
 		"""
-			Ingest all files in the articles directory as Articles.
+			Ingest all new or changed files in the articles directory as Articles,
+			and drop any whose files have gone away.
 		"""
-		for dirpath, dirnames, filenames in os.walk(self.article_dir):
-			for filename in filenames:
-				try:
-					self.parseArticle(os.path.join(dirpath, filename))
-				except Exception as e:
-					Log('Failure parsing article: ' + filename)
-					Log(traceback.format_exc())
-					continue
+		self.rescanDirectory(self.article_dir, self.manifest, self.parseArticle, self.addArticle, self.removeArticle)
 
 		return self.articles
 
@@ -237,115 +1335,384 @@ class Blog:
 			:param article_file: the article filename to ingest.
 		"""
 		Log('Parsing article: ' + article_path)
-		article = Article(article_path)
+		signature = StatFile(article_path)
+		return self.addArticle(article_path, signature, Article(article_path))
+
+	def addArticle(self, article_path, signature, article):
+		"""
+			Index a freshly parsed article, replacing
+			whatever was previously parsed from its file.
+		
+			:param article_path: The path the article was read from.
+			:param signature: The (inode, mtime, size) of the file before it was read.
+			:param article: The parsed Article.
+		"""
+		self.dateArticle(article)
+		self.internArticle(article)
 		article.setWebPath('/articles/' + article.title)
-		self.indexArticle(article)
+		with self.changes():
+			self.removeArticle(article_path, article.title)
+			self.indexArticle(article)
+			self.manifest[article_path] = signature + (article.title,)
+			# Still inside the changes, so before anything a reader can see is changed.
+			if self.lazy_bodies:
+				article.unloadBody(self.body_cache)
 		return article
 
-	def indexArticle(self, article):
+	def removeArticle(self, article_path, new_title = None):
+		"""
+			Forget the article that was ingested from a given file,
+			clearing it out of all indexes.
+		
+			:param article_path: The path the article was read from.
+			:param new_title: If the file is being re-ingested under this title, leave it be.
+		"""
+		entry = self.manifest.pop(article_path, None)
+		self.body_cache.pop(article_path)
+		if not entry or entry[3] == new_title:
+			return
+		article = self.articles.get(entry[3])
+		if article and article.path == article_path:
+			del self.writable('articles')[entry[3]]
+			self.unindexArticle(article)
+
+			# Another file with the same title lost out to this one, so takes its place,
+			# as the last of them in a full scan would.
+			shadowed = sorted(path for (path, other) in self.manifest.items() if other[3] == entry[3] and os.path.exists(path))
+			if shadowed:
+				self.parseArticle(shadowed[-1])
+
+	def intern(self, value):
+		"""
+			Get the shared instance of an (immutable) value from the symbol table.
+		
+			:param value: The value to look up, and add if it is new.
+		"""
+		return self.symbols.setdefault(value, value)
+
+	def internArticle(self, article):
+		"""
+			Swap an article's category, tags and date for the shared instances,
+			so that articles filed the same way don't each hold their own copies.
+			Tags become a tuple, shared by every article with the same tags.
+		
+			:param article: The Article to intern.
+		"""
+		if article.category:
+			article.category = self.intern(article.category)
+		article.tags = self.intern(tuple(self.intern(tag) for tag in article.tags))
+		article.date = self.intern(article.date)
+
+	def dateArticle(self, article):
+		"""
+			Give an article without a _date the date it was first seen,
+			recording today in the date ledger if it is new.
+		
+			:param article: The freshly parsed Article.
+		"""
+		if article.dated:
+			return
+		first_seen = self.date_ledger.get(article.title)
+		if first_seen:
+			article.date = first_seen
+		else:
+			self.date_ledger.record(article.title, article.date)
+
+	def rescanDirectory(self, directory, manifest, parse, add, remove):
+		"""
+			Bring a manifest up to date with a directory, publishing the changes together.
+			Only files whose inode, mtime or size changed are parsed again,
+			fanned out over ingest_workers processes when there are enough of them.
+		
+			:param directory: The directory to scan.
+			:param manifest: The manifest of previously ingested files.
+			:param parse: Called with the path of each new or changed file, when parsing in-process.
+			:param add: Called with (path, signature, article) for each file parsed in a worker.
+			:param remove: Called with the path of each file that is gone.
+		"""
+		signatures = self.scanDirectory(directory)
+		with self.changes():
+			for path in sorted(set(manifest) - set(signatures)):
+				remove(path)
+
+			changed = [path for path in sorted(signatures) if path not in manifest or manifest[path][:3] != signatures[path]]
+
+			if self.ingest_workers != 1 and len(changed) >= self.parallel_threshold:
+				for path, signature, record, error in self.parseInParallel(changed):
+					if error:
+						Log('Failure parsing article: ' + path)
+						Log(error)
+						continue
+					add(path, signature, Article.fromRecord(record))
+			else:
+				for path in changed:
+					try:
+						parse(path)
+					except Exception as e:
+						Log('Failure parsing article: ' + path)
+						Log(traceback.format_exc())
+						continue
+
+		self.date_ledger.flush()
+
+	def parseInParallel(self, paths):
+		"""
+			Parse files across a pool of ingest_workers processes.
+		
+			:param paths: The files to parse.
+			:return: A list of (path, signature, record, error) in the same order as paths.
+		"""
+		workers = self.ingest_workers or multiprocessing.cpu_count()
+		Log('Parsing %d articles across %d processes.' % (len(paths), workers))
+		pool = multiprocessing.Pool(workers)
+		try:
+			return pool.map(ParseArticleRecord, paths, max(1, len(paths) // (workers * 4)))
+		finally:
+			pool.close()
+			pool.join()
+
+	def scanDirectory(self, directory):
+		"""
+			Stat every file under a directory, without opening any of them.
+		
+			:param directory: The directory to scan.
+			:return: A dict of path to (inode, mtime, size).
+		"""
+		signatures = {}
+		if scandir:
+			pending = [directory]
+			while pending:
+				try:
+					entries = list(scandir(pending.pop()))
+				except OSError as e:
+					continue
+				for entry in entries:
+					try:
+						if entry.is_dir(follow_symlinks=False):
+							pending.append(entry.path)
+						else:
+							stat = entry.stat()
+							signatures[entry.path] = (stat.st_ino, stat.st_mtime, stat.st_size)
+					except OSError as e:
+						continue
+		else:
+			for dirpath, dirnames, filenames in os.walk(directory):
+				for filename in filenames:
+					path = os.path.join(dirpath, filename)
+					try:
+						signatures[path] = StatFile(path)
+					except OSError as e:
+						continue
+
+		return signatures
+
+	def indexArticle(self, article, index_text = True):
 		"""
 			Refresh the indexes for a given article, clearing out any
 			stale data.  Original article creation date is preserved.
 		
 			:param article: The article object to index.
+			:param index_text: Whether to add the title and body to the search index.
 		"""
-		if article.title in self.articles:
-			old_article = self.articles[article.title]
+		# A category or tag the sidebar doesn't list yet, before the old version's are dropped.
+		changes_sidebar = not self.hasFacetsOf(article)
+		dependencies = []
+
+		old_article = self.articles.get(article.title)
+		if old_article:
 			article.date = old_article.date
-			if old_article.category:
-				self.categories[old_article.category].remove(old_article)
-			for tag in old_article.tags:
-				self.tags[tag].remove(old_article)
+			changes_sidebar = changes_sidebar or self.date_index.isRecent(old_article, self.sidebar_recent)
+			dependencies = self.dependenciesOf(old_article)
+			self.dropFromIndexes(old_article)
 
-		self.articles[article.title] = article
+		self.writable('articles')[article.title] = article
 		if article.category:
-			self.categories[article.category].append(article)
+			self.writablePostingList('categories', article.category).add(article)
 		for tag in article.tags:
-			self.tags[tag].append(article)
+			self.writablePostingList('tags', tag).add(article)
 
-		self.articles_by_date[article.date.year][article.date.month][article.date.day][article.title] = article
+		self.writable('date_index').add(article)
+		self.writable('facets').add(article)
+		if index_text:
+			self.writable('search_index').add(article.title, article.title + ' ' + (article.body or ''))
 
-	def getRecentArticles(self, number_to_get = 10):
+		if old_article and not self.hasFacetsOf(old_article):
+			changes_sidebar = True
+		if self.date_index.isRecent(article, self.sidebar_recent):
+			changes_sidebar = True
+		dependencies += self.dependenciesOf(article)
+		if changes_sidebar:
+			dependencies.append(('sidebar',))
+		self.changed(dependencies)
+
+	def unindexArticle(self, article):
 		"""
-			Get number_to_get most recent articles.
+			Clear an article out of the category, tag, date and search
+			indexes, dropping any category or tag left empty.
 		
-			:param number_to_get: The number of articles to return.
+			:param article: The article object to unindex.
 		"""
-		recent_articles = []
-		years = list(self.articles_by_date.keys())
-		years.reverse()
-		for year in years:
-			months = list(self.articles_by_date[year].keys())
-			months.reverse()
-			for month in months:
-				days = list(self.articles_by_date[year][month].keys())
-				days.reverse()
-				for day in days:
-					articles = sorted(self.articles_by_date[year][month][day].values(), key=lambda article: article.date)
-					for article in articles:
-						recent_articles.append(article)
-						if len(recent_articles) > number_to_get:
-							return recent_articles
-
-		return recent_articles
+		changes_sidebar = self.date_index.isRecent(article, self.sidebar_recent)
+		self.dropFromIndexes(article)
 
-	def getArticles(self):
+		dependencies = self.dependenciesOf(article)
+		if changes_sidebar or not self.hasFacetsOf(article):
+			dependencies.append(('sidebar',))
+		self.changed(dependencies)
+
+	def dropFromIndexes(self, article):
 		"""
-			Get a list of all articles.
+			unindexArticle, without telling anyone.
+		
+			:param article: The article object to unindex.
 		"""
-		return self.articles.values()
+		if article.category in self.categories:
+			posting_list = self.writablePostingList('categories', article.category)
+			posting_list.remove(article)
+			if not posting_list:
+				del self.categories[article.category]
+		for tag in article.tags:
+			if tag in self.tags:
+				posting_list = self.writablePostingList('tags', tag)
+				posting_list.remove(article)
+				if not posting_list:
+					del self.tags[tag]
 
-	def getArticle(self, article):
+		self.writable('date_index').remove(article)
+		self.writable('facets').remove(article)
+		self.writable('search_index').remove(article.title)
+
+	def hasFacetsOf(self, article):
 		"""
-			Get an Article object of a given title,
-			must have been parsed in prior.
+			Are an article's category and tags all in the indexes?
 		
-			:param article: The title of the article to get.
+			:param article: The article to check.
 		"""
-		return self.articles[article]
+		if article.category and article.category not in self.categories:
+			return False
+		return all(tag in self.tags for tag in article.tags)
 
-	def getCategories(self):
+	def dependenciesOf(self, article):
 		"""
-			Get a list of all categories.
+			Name the things a page could have shown that change along with
+			an article: the article itself, its category, its tags and its
+			year, month and day.  ('articles',) stands for any article.
+		
+			:param article: The article that changed.
 		"""
-		return self.categories.keys()
+		dependencies = [('article', article.title), ('articles',)]
+		if article.category:
+			dependencies.append(('category', article.category))
+		for tag in article.tags:
+			dependencies.append(('tag', tag))
+		if article.date:
+			dependencies.append(('year', article.date.year))
+			dependencies.append(('month', article.date.year, article.date.month))
+			dependencies.append(('day', article.date.year, article.date.month, article.date.day))
+		return dependencies
 
-	def getArticlesByCategory(self, category):
+	def changed(self, dependencies):
 		"""
-			Get all articles within a given category.
+			Note a change to the blog's content, to be published (and passed
+			on to the listeners, so they can drop anything built from it) as
+			soon as the changes it is part of are done.
 		
-			:param category: The category to enumerate.
+			:param dependencies: What changed, as named by dependenciesOf,
+				('sidebar',) for the sidebar or ('staged',) for staged articles.
 		"""
-		if category in self.categories:
-			return self.categories[category]
-		return []
+		self.pending_changes.extend(dependencies)
+		if not self.change_depth:
+			self.publish()
 
-	def getTags(self):
+	@contextlib.contextmanager
+	def changes(self):
 		"""
-			Get a list of all tags.
+			Hold the lock over a group of changes to the indexes, and publish
+			them as one snapshot when the outermost group ends.  Changes made
+			outside of any group are published one at a time.
 		"""
-		return self.tags.keys()
+		with self.lock:
+			self.change_depth += 1
+			try:
+				yield
+			finally:
+				self.change_depth -= 1
+				if not self.change_depth:
+					self.publish()
 
-	def getArticlesByTag(self, tag):
+	def writable(self, name):
 		"""
-			Get all articles within a given tag.
-			:param tag: The tag to enumerate.
+			Get one of the indexes to change, first swapping in a copy of it
+			if the published snapshot has it.
+		
+			:param name: The attribute the index is kept in, e.g. 'articles' or 'date_index'.
 		"""
-		if tag in self.tags:
-			return self.tags[tag]
-		return []
+		index = getattr(self, name)
+		if id(index) not in self.unshared:
+			index = index.copy()
+			setattr(self, name, index)
+			self.unshared[id(index)] = index
+		return index
 
-	def getStagedArticles(self):
+	def writablePostingList(self, name, key):
 		"""
-			Get a list of all staged articles.
+			Get the posting list of a category or tag to change, copying it
+			(or creating it) as writable does.
+		
+			:param name: 'categories' or 'tags'.
+			:param key: The category or tag.
 		"""
-		return self.staged_articles.values()
+		posting_lists = self.writable(name)
+		posting_list = posting_lists.get(key)
+		if posting_list is None:
+			posting_list = PostingList()
+		elif id(posting_list) not in self.unshared:
+			posting_list = posting_list.copy()
+		else:
+			return posting_list
+		posting_lists[key] = posting_list
+		self.unshared[id(posting_list)] = posting_list
+		return posting_list
 
-	def getStagedArticle(self, article):
+	def publish(self):
 		"""
-			Get a staged Article object of a given title,
-			must have been parsed in prior.
+			Swap in a snapshot of the indexes as they are now, with a single
+			assignment, then tell the listeners what changed since the last one.
+			Anything changed after this is copied first. (see writable)
+		"""
+		dependencies = self.pending_changes
+		self.pending_changes = []
+		if dependencies:
+			self.version += 1
+			if ('sidebar',) in dependencies:
+				self.sidebar_version += 1
+
+		self.snapshot = IndexSnapshot(self)
+		self.unshared = {}
+
+		if not dependencies:
+			return
+		now = time.time()
+		for dependency in dependencies:
+			self.modified[dependency] = now
+		for listener in self.listeners:
+			listener(dependencies)
+
+	def lastModified(self, dependencies, articles):
+		"""
+			When a page last changed: the newest of its articles' file
+			modification times (or dates, for articles without a file) and
+			the last changes to anything else it depends on.
 		
-			:param article: the title of the article to get.
+			:param dependencies: What the page shows, as named by dependenciesOf.
+			:param articles: The articles on the page.
+			:return: A unix timestamp, or None if nothing is known.
 		"""
-		return self.staged_articles[article]
+		times = [self.modified[dependency] for dependency in dependencies if dependency in self.modified]
+		for article in articles:
+			entry = self.manifest.get(article.path) or self.staged_manifest.get(article.path)
+			if entry:
+				times.append(entry[1])
+			elif article.date:
+				times.append(calendar.timegm(article.date.timetuple()))
+		return max(times) if times else None
@@ -0,0 +1,237 @@
+import hashlib
+import multiprocessing
+import os
+import sys
+import traceback
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import routes
+from utilities import Log
+
+
+# Kept in the export directory: a "sha1\tgz\tpath" line for each page written,
+# with the middle field empty when the page has no .gz sibling.
+MANIFEST_NAME = '.export_manifest'
+
+
+def ExportPaths(index):
+	'''
+		Every public page of a blog: the home page, each article, the tag
+		and category indexes and lists, and the year, month and day
+		archives that have articles.  Staging is left out.
+
+		:param index: The snapshot of the blog's indexes to list the pages of.
+	'''
+	paths = set(['/', '/tag', '/category'])
+	for article in index.getArticles():
+		paths.add('/articles/' + article.title)
+		if article.date:
+			paths.add('/%d' % (article.date.year,))
+			paths.add('/%d/%d' % (article.date.year, article.date.month))
+			paths.add('/%d/%d/%d' % (article.date.year, article.date.month, article.date.day))
+	for tag in index.getTags():
+		paths.add('/tag/' + tag)
+	for category in index.getCategories():
+		paths.add('/category/' + category)
+	return sorted(paths)
+
+
+def OutputPath(outdir, path):
+	'''
+		Where a page goes in the export, as an index.html so that pages
+		and the pages below them (/tag and /tag/foo) can both exist.
+
+		:param outdir: The export directory.
+		:param path: The page's path.
+	'''
+	return os.path.join(outdir, *(path.strip('/').split('/') + ['index.html']))
+
+
+def RenderPage(path):
+	'''
+		Render a page through the bottle app, exactly as a GET for it would.
+
+		:param path: The page's path.
+		:return: (status line, body bytes)
+	'''
+	if not isinstance(path, bytes) and sys.version_info[0] > 2:
+		# WSGI wants paths as latin-1 decoded bytes.
+		path = path.encode('utf-8').decode('latin-1')
+	environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': ''}
+	setup_testing_defaults(environ)
+
+	status = []
+	def start_response(status_line, headers, exc_info=None):
+		status.append(status_line)
+
+	body = b''.join(bottle.default_app()(environ, start_response))
+	return (status[0], body)
+
+
+def WriteAtomically(file_path, data):
+	'''
+		Replace a file's contents all at once, so a file server never sees a half written page.
+
+		:param file_path: The file to write.
+		:param data: The bytes to write.
+	'''
+	directory = os.path.dirname(file_path)
+	if not os.path.isdir(directory):
+		try:
+			os.makedirs(directory)
+		except OSError as e:
+			# Another worker got there first.
+			if not os.path.isdir(directory):
+				raise
+
+	temporary_path = '%s.%d.tmp' % (file_path, os.getpid())
+	with open(temporary_path, 'wb') as f:
+		f.write(data)
+	os.rename(temporary_path, file_path)
+
+
+def LoadManifest(outdir):
+	'''
+		Read the page hashes recorded by the last export to a directory.
+
+		:param outdir: The export directory.
+		:return: A dict of path -> (sha1 hex digest, whether a .gz was written);
+			empty if there was no export.
+	'''
+	manifest = {}
+	try:
+		with open(os.path.join(outdir, MANIFEST_NAME)) as f:
+			for line in f:
+				fields = line.rstrip('\n').split('\t', 2)
+				# Lines from before the gzip field are dropped, so those pages are rewritten.
+				if len(fields) == 3:
+					(digest, gzipped, path) = fields
+					manifest[path] = (digest, gzipped == 'gz')
+	except IOError as e:
+		pass
+	return manifest
+
+
+def SaveManifest(outdir, manifest):
+	'''
+		Record the page hashes of an export.
+
+		:param outdir: The export directory.
+		:param manifest: A dict of path -> (sha1 hex digest, whether a .gz was written).
+	'''
+	data = ''.join('%s\t%s\t%s\n' % (manifest[path][0], 'gz' if manifest[path][1] else '', path)
+		for path in sorted(manifest))
+	if not isinstance(data, bytes):
+		data = data.encode('utf-8')
+	WriteAtomically(os.path.join(outdir, MANIFEST_NAME), data)
+
+
+def RemovePage(outdir, path):
+	'''
+		Delete an exported page, and any directories it leaves empty.
+
+		:param outdir: The export directory.
+		:param path: The page's path.
+	'''
+	file_path = OutputPath(outdir, path)
+	for stale_path in (file_path, file_path + '.gz'):
+		try:
+			os.remove(stale_path)
+		except OSError as e:
+			pass
+
+	directory = os.path.dirname(file_path)
+	while os.path.abspath(directory) != os.path.abspath(outdir):
+		try:
+			os.rmdir(directory)
+		except OSError as e:
+			break
+		directory = os.path.dirname(directory)
+
+
+def ExportPage(task):
+	'''
+		Render one page and write it out if it differs from the last export;
+		the unit of work for the export pool.
+
+		:param task: (outdir, path, compress, manifest entry from the last export or None)
+		:return: (path, manifest entry, whether it was written, error or None)
+	'''
+	(outdir, path, compress, old_entry) = task
+	try:
+		(status, body) = RenderPage(path)
+		if not status.startswith('200'):
+			return (path, old_entry, False, status)
+
+		file_path = OutputPath(outdir, path)
+		gzipped = bool(compress and len(body) >= routes.blog_instance.gzip_min_size)
+		entry = (hashlib.sha1(body).hexdigest(), gzipped)
+		if entry == old_entry and os.path.exists(file_path) and (not gzipped or os.path.exists(file_path + '.gz')):
+			return (path, entry, False, None)
+
+		WriteAtomically(file_path, body)
+		if gzipped:
+			WriteAtomically(file_path + '.gz', routes.gzip(body))
+		else:
+			# A .gz left by an earlier export would be served in place of the new page.
+			try:
+				os.remove(file_path + '.gz')
+			except OSError as e:
+				pass
+		return (path, entry, True, None)
+	except Exception as e:
+		return (path, old_entry, False, traceback.format_exc())
+
+
+def Export(outdir, workers = 0, compress = False):
+	'''
+		Render every public page of the blog into a directory tree that
+		a plain file server can serve.  Only pages whose rendered bytes
+		changed since the last export to the directory are rewritten, and
+		pages that no longer exist are deleted.
+
+		:param outdir: The directory to export to.
+		:param workers: Processes to render with; 0 uses one per CPU.
+		:param compress: Also write a .gz sibling of each page big enough to gzip.
+		:return: (pages written, pages unchanged, pages deleted)
+	'''
+	old_manifest = LoadManifest(outdir)
+	paths = ExportPaths(routes.blog_instance.snapshot)
+	tasks = [(outdir, path, compress, old_manifest.get(path)) for path in paths]
+	workers = workers or multiprocessing.cpu_count()
+	Log('Exporting %d pages to %s across %d processes.' % (len(paths), outdir, workers))
+
+	if workers == 1:
+		results = [ExportPage(task) for task in tasks]
+	else:
+		# Forked workers inherit the parsed blog, so there is nothing to reparse.
+		pool = multiprocessing.Pool(workers)
+		try:
+			results = pool.map(ExportPage, tasks, max(1, len(tasks) // (workers * 4)))
+		finally:
+			pool.close()
+			pool.join()
+
+	manifest = {}
+	written = 0
+	unchanged = 0
+	for (path, entry, was_written, error) in results:
+		if entry:
+			# A page that failed to render keeps whatever the last export left.
+			manifest[path] = entry
+		if error:
+			Log('Failure exporting page: ' + path)
+			Log(error)
+		elif was_written:
+			written += 1
+		else:
+			unchanged += 1
+
+	removed = [path for path in old_manifest if path not in manifest]
+	for path in removed:
+		RemovePage(outdir, path)
+
+	SaveManifest(outdir, manifest)
+	Log('Exported %d pages: %d written, %d unchanged, %d deleted.' % (len(paths), written, unchanged, len(removed)))
+	return (written, unchanged, len(removed))
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 
 import functools
+import hashlib
+import multiprocessing
 import os
 import string
-import urllib
+import threading
+import zlib
+
+try:
+	from urllib import unquote
+except ImportError:
+	from urllib.parse import unquote
 
 from blog import Blog
-from bottle import route, run, template, jinja2_view, url, Jinja2Template, response
-from utilities import Log
+from server import PreforkServer, ThreadedServer
+from bottle import hook, route, run, template, jinja2_view, url, Jinja2Template, request, response, http_date, parse_date, html_escape
+from utilities import Log, DependencyCache
 
 
 
@@ -16,14 +25,82 @@ from utilities import Log
 
 # I'm not sure I'm happy with this; but making it all static doesn't seem much better.
 blog_instance = Blog()
-blog_instance.parseArticles()
-blog_instance.parseStagedArticles()
+blog_instance.loadIndex()
+# Loading isn't a change; only what the rescan finds should move Last-Modified times.
+blog_instance.modified.clear()
+blog_instance.refresh()
+blog_instance.saveIndex()
+Log("Search index: %d articles, %d terms, about %d bytes" % (len(blog_instance.search_index), len(blog_instance.search_index.postings), blog_instance.search_index.memoryUsage()))
+
+# Rendered pages, keyed on path and query string, dropped when what they show changes. (see cached)
+page_cache = DependencyCache(blog_instance.page_cache_bytes)
+blog_instance.listeners.append(page_cache.invalidate)
+# The headers and validators of pages rendered, for 304s without the pages. (see cached)
+validator_cache = DependencyCache(blog_instance.page_cache_bytes // 16)
+blog_instance.listeners.append(validator_cache.invalidate)
+# Roughly what a validator_cache record takes up.
+validator_size = 512
+# What the page being rendered on this thread depends on (see depends), and the index snapshot it reads. (see snapshot)
+rendering = threading.local()
 
 # ----- SET UP THE TEMPLATE ENGINE ----- #
 
+@hook('before_request')
+def takeSnapshot():
+	rendering.index = blog_instance.snapshot
+
+
+def snapshot():
+	'''
+		The blog's indexes as they were when the request being handled began.
+		Everything a request reads comes from this one snapshot, so a page
+		never mixes what it shows from before and after a change.
+	'''
+	return rendering.index
+
+
+# (IndexSnapshot.sidebar_version, html, its utf-8 encoding, a digest of that) for the newest sidebar rendered.
+sidebar_cache = (None, u"", b"", "")
+# Stands in for the sidebar in pages kept in page_cache, which splices the current one in. (see assemble)
+sidebar_placeholder = u"<!--sidebar-->"
+
+def renderedSidebar(index):
+	'''
+		The Recent, Categories and Tags index for basePage.tpl, only
+		re-rendered when the blog says what it lists has changed.
+
+		:param index: The snapshot the page is being rendered from.
+		:return: (sidebar_version, html, its utf-8 encoding, a digest of that)
+	'''
+	global sidebar_cache
+
+	rendered = sidebar_cache
+	if rendered[0] != index.sidebar_version:
+		html = template("sidebar.tpl", template_adapter=Jinja2Template, template_lookup=['views'], index=index)
+		encoded = html.encode('utf-8')
+		rendered = (index.sidebar_version, html, encoded, hashlib.sha1(encoded).hexdigest())
+		# A request still on an older snapshot mustn't replace a newer sidebar.
+		if sidebar_cache[0] is None or index.sidebar_version > sidebar_cache[0]:
+			sidebar_cache = rendered
+	return rendered
+
+
+def sidebar(index):
+	'''
+		The sidebar's html, for basePage.tpl.  A page being rendered for
+		page_cache just gets sidebar_placeholder.
+
+		:param index: The snapshot the page is being rendered from.
+	'''
+	if getattr(rendering, 'splicing', False):
+		return sidebar_placeholder
+	return renderedSidebar(index)[1]
+
 Jinja2Template.defaults = {
     'url': url,
     'blog': blog_instance,
+    'snapshot': snapshot,
+    'sidebar': sidebar,
 }
 
 # ----- SET UP HELPER FUNCTIONS ----- #
@@ -47,7 +124,7 @@ def sanitize(callback):
 
 		for arg in args:
 			if arg.__class__.__name__ == "str":
-				sanitized_args.append(urllib.unquote(arg))
+				sanitized_args.append(unquote(arg))
 				for char in arg:
 					if char not in whitelist:
 						response.status = 303
@@ -57,7 +134,7 @@ def sanitize(callback):
 
 		for (key, value) in kwargs.items():
 			if value.__class__.__name__ == "str":
-				sanitized_kwargs[key] = urllib.unquote(value)
+				sanitized_kwargs[key] = unquote(value)
 				for char in value:
 					if char not in whitelist:
 						response.status = 303
@@ -70,6 +147,231 @@ def sanitize(callback):
 	return sanitized_callback
 
 
+def depends(*dependencies):
+	'''
+		Record that the page being rendered shows the given things,
+		as named by Blog.dependenciesOf.
+
+		:param dependencies: The things the page shows.
+	'''
+	rendering.dependencies.extend(dependencies)
+
+
+def shows(articles):
+	'''
+		Record the articles on the page being rendered, for its Last-Modified time.
+
+		:param articles: The articles on the page.
+	'''
+	rendering.articles.extend(articles)
+
+
+def notModified(etag, last_modified):
+	'''
+		Does the request's If-None-Match (or, failing that, If-Modified-Since)
+		say the client already has this version of the page?
+
+		:param etag: The page's ETag.
+		:param last_modified: The page's Last-Modified time, or None.
+	'''
+	if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+	if if_none_match is not None:
+		# Weak comparison, as If-None-Match calls for.
+		tags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+		return '*' in tags or etag in tags
+
+	if_modified_since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+	if if_modified_since and last_modified is not None:
+		since = parse_date(if_modified_since.split(';')[0].strip())
+		return since is not None and since >= int(last_modified)
+
+	return False
+
+
+def acceptsGzip():
+	'''
+		Does the request's Accept-Encoding allow gzip?
+	'''
+	for coding in request.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+		parameters = coding.split(';')
+		if parameters[0].strip().lower() not in ('gzip', 'x-gzip', '*'):
+			continue
+		for parameter in parameters[1:]:
+			(name, equals, value) = parameter.partition('=')
+			if name.strip().lower() == 'q':
+				try:
+					return float(value) > 0
+				except ValueError:
+					return False
+		return True
+	return False
+
+
+def gzip(body):
+	'''
+		Compress a page, gzip framed, at the configured level.
+
+		:param body: The encoded page.
+	'''
+	compressor = zlib.compressobj(blog_instance.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(body) + compressor.flush()
+
+
+def validators(record):
+	'''
+		Work out how a cached page is sent now, without needing the page
+		itself: its ETag and Last-Modified time follow the current sidebar,
+		and it's gzipped if it's big enough and the client accepts gzip.
+
+		:param record: (headers, digest of the body, its length, whether the sidebar is spliced in, last_modified) as kept in validator_cache.
+		:return: (etag, last_modified, whether to gzip)
+	'''
+	(headers, digest, length, spliced, last_modified) = record
+	if spliced:
+		(version, html, encoded, sidebar_digest) = renderedSidebar(snapshot())
+		digest = hashlib.sha1((digest + sidebar_digest).encode('ascii')).hexdigest()
+		length += len(encoded)
+		# The page changed when its sidebar last did, too.
+		times = [when for when in (last_modified, blog_instance.lastModified([('sidebar',)], [])) if when is not None]
+		last_modified = max(times) if times else None
+
+	compress = length >= blog_instance.gzip_min_size and acceptsGzip()
+	if compress:
+		# A different representation, so it needs its own (still strong) ETag.
+		digest += '-gzip'
+	return ('"%s"' % (digest,), last_modified, compress)
+
+
+def sendValidators(record):
+	'''
+		Set a cached page's headers, and a 304 status if the client already
+		has it.
+
+		:param record: As kept in validator_cache. (see validators)
+		:return: Whether to gzip the page.
+	'''
+	(etag, last_modified, compress) = validators(record)
+	for (name, value) in record[0]:
+		response.set_header(name, value)
+	response.set_header('ETag', etag)
+	if last_modified is not None:
+		response.set_header('Last-Modified', http_date(last_modified))
+	if compress:
+		response.set_header('Content-Encoding', 'gzip')
+
+	if notModified(etag, last_modified):
+		response.status = 304
+	return compress
+
+
+def assemble(entry, compress):
+	'''
+		A cached page as it is now, with the current sidebar spliced in.  The
+		result and its gzipped copy are kept with the entry until the sidebar
+		next changes.
+
+		:param entry: (validator_cache record, body before the sidebar, body after it or None, [assembled]) as kept in page_cache.
+		:param compress: Whether to return the page gzipped.
+	'''
+	(record, before, after, assembled) = entry
+	(version, html, encoded, digest) = renderedSidebar(snapshot())
+	if assembled[0] is None or assembled[0][0] != version:
+		body = before
+		if after is not None:
+			body = before + encoded + after
+		# One assignment, so a request serving the entry at the same time sees all of the old or all of the new.
+		assembled[0] = (version, body, None)
+
+	(version, body, gzipped) = assembled[0]
+	if not compress:
+		return body
+	if gzipped is None:
+		gzipped = gzip(body)
+		assembled[0] = (version, body, gzipped)
+	return gzipped
+
+
+def serve(entry):
+	'''
+		Send a cached page, gzipped if it can be, or just a 304 if the
+		client already has it.
+
+		:param entry: As kept in page_cache. (see assemble)
+	'''
+	compress = sendValidators(entry[0])
+	if response.status_code == 304:
+		return ''
+	return assemble(entry, compress)
+
+
+def cached(callback):
+	'''
+		Serve a page from page_cache while nothing it shows has changed;
+		otherwise render it and keep the encoded bytes and headers, along
+		with what it depends on.  Only successful responses are kept.
+
+		The sidebar isn't kept in the page, but spliced in when it's served
+		(see assemble), so a change to the sidebar alone doesn't drop every
+		page; only pages listing what changed are rendered again.
+
+		Pages carry an ETag (a hash of the body and sidebar) and a
+		Last-Modified time (see Blog.lastModified).  These are also kept
+		apart from the page, in validator_cache, which holds far more pages'
+		worth, so a conditional GET gets a 304 without any rendering for as
+		long as nothing the page shows has changed, even once the page
+		itself has been evicted.  Pages of at least gzip_min_size bytes are
+		compressed once per sidebar, and sent to clients accepting gzip.
+
+		:param callback: The (view decorated) function to cache.
+	'''
+	def cached_callback(*args, **kwargs):
+		key = (request.path, request.query_string)
+		entry = page_cache.get(key)
+		if entry:
+			return serve(entry)
+
+		# Evicted, or never rendered in this process, but the client may well have it already.
+		record = validator_cache.get(key)
+		if record and notModified(*validators(record)[:2]):
+			sendValidators(record)
+			return ''
+
+		generations = (page_cache.invalidations, validator_cache.invalidations)
+		# Taken again after the generations, so a page rendered from a snapshot that's since been replaced is never kept.
+		rendering.index = blog_instance.snapshot
+		rendering.dependencies = []
+		rendering.articles = []
+		rendering.splicing = True
+		try:
+			body = callback(*args, **kwargs)
+		finally:
+			rendering.splicing = False
+		if response.status_code != 200:
+			if not isinstance(body, bytes):
+				body = body.replace(sidebar_placeholder, sidebar(snapshot()))
+			return body
+
+		if not isinstance(body, bytes):
+			body = body.encode(response.charset)
+		(before, placeholder, after) = body.partition(sidebar_placeholder.encode(response.charset))
+		if not placeholder:
+			after = None
+		last_modified = blog_instance.lastModified(rendering.dependencies, rendering.articles)
+
+		# Caches may keep pages, but must check back with the validators before using them.
+		response.set_header('Cache-Control', 'no-cache')
+		response.set_header('Vary', 'Accept-Encoding')
+
+		record = (response.headerlist, hashlib.sha1(before + placeholder + (after or b'')).hexdigest(), len(before) + len(after or b''), after is not None, last_modified)
+		validator_cache.put(key, record, validator_size, rendering.dependencies, generations[1])
+		entry = (record, before, after, [None])
+		# Room for the assembled page and its gzipped copy, too.
+		page_cache.put(key, entry, 2 * len(body), rendering.dependencies, generations[0])
+		return serve(entry)
+
+	return cached_callback
+
+
 def make_link(destination, text=None):
 	'''
 		Convenience function, generate the HTML for a link.
@@ -85,37 +387,48 @@ def make_link(destination, text=None):
 # ----- ROUTES ----- #
 
 @route("/")
+@cached
 @sanitize
 @view("articleList.tpl")
 def root():
-	blog_instance.parseArticles()
-	recent_articles = blog_instance.getRecentArticles()
+	# The same recent articles as the sidebar, so they change along with it.
+	depends(('sidebar',))
+	recent_articles = snapshot().getRecentArticles(blog_instance.sidebar_recent)
+	shows(recent_articles)
 	return {'article_list': recent_articles}
 
 
 @route("/articles/<post>")
+@cached
 @sanitize
 @view("basePage.tpl")
 def article(post):
-	article = blog_instance.getArticle(post)
+	depends(('article', post))
+	article = snapshot().getArticle(post)
+	shows([article])
 
 	return {'content': article.body}
 
 
 @route("/staging")
+@cached
 @sanitize
 @view("articleList.tpl")
 def searchStagedArticles(post=None):
-	blog_instance.parseStagedArticles()
-
-	return {'article_list': blog_instance.getStagedArticles()}
+	depends(('staged',))
+	staged_articles = snapshot().getStagedArticles()
+	shows(staged_articles)
+	return {'article_list': staged_articles}
 
 
 @route("/staging/<post>")
+@cached
 @sanitize
 @view("basePage.tpl")
 def viewStagedArticle(post):
-	staged_article = blog_instance.getStagedArticle(post)
+	depends(('staged',))
+	staged_article = snapshot().getStagedArticle(post)
+	shows([staged_article])
 
 	return {'content': staged_article.body}
 
@@ -136,62 +449,164 @@ def viewStagedArticle(post):
 	return {}
 
 
+@route("/deploy")
+@sanitize
+@view("basePage.tpl")
+def deployStagedArticles():
+	'''
+		Deploy several staged articles at once, e.g. /deploy?title=a&title=b.
+		At least one has to be named, so that nothing follows a bare link
+		into deploying all of staging.  Either all of them are deployed or
+		none are; the page says how each one fared.
+	'''
+	titles = request.query.getall("title")
+	if not titles:
+		response.status = 400
+		return {"content": "Name the staged articles to deploy, as /deploy?title=a&title=b"}
+
+	results = blog_instance.deployArticles(titles)
+
+	if any(error for (title, error) in results):
+		response.status = 409
+	content = []
+	for (title, error) in results:
+		title = html_escape(title)
+		if error:
+			content.append("%s: %s<br>" % (title, html_escape(error)))
+		else:
+			content.append(make_link("/articles/" + title, title) + ": deployed<br>")
+	return {"content": "".join(content)}
+
+
 @route("/<year:int>")
 @route("/<year:int>/<month:int>")
 @route("/<year:int>/<month:int>/<day:int>")
+@cached
 @sanitize
 @view("articleList.tpl")
 def searchByDate(year, month=None, day=None):
-	# Do the right thing no matter which parts of the date are given.
 	if day:
-		articles = blog_instance.articles_by_date[year][month][day].values()
+		depends(('day', year, month, day))
 	elif month:
-		articles = []
-		for day in blog_instance.articles_by_date[year][month]:
-			articles += blog_instance.articles_by_date[year][month][day].values()
+		depends(('month', year, month))
 	else:
-		articles = []
-		for month in blog_instance.articles_by_date[year]:
-			for day in blog_instance.articles_by_date[year][month]:
-				articles += blog_instance.articles_by_date[year][month][day].values()
+		depends(('year', year))
+	articles = snapshot().getArticlesByDate(year, month, day)
+	shows(articles)
 
 	return {"article_list": articles}
 
 
 @route("/category/<category>")
+@cached
 @sanitize
 @view("articleList.tpl")
 def searchByCategory(category):
-	articles = blog_instance.getArticlesByCategory(category)
+	depends(('category', category))
+	articles = snapshot().getArticlesByCategory(category)
+	shows(articles)
 
 	return {"article_list": articles}
 
 
 @route("/category")
+@cached
 @sanitize
 @view("basePage.tpl")
 def searchtags():
-	content = [make_link("/category/" + tag, tag) + "<br>" for tag in blog_instance.getCategories()]
+	# The categories the sidebar lists.
+	depends(('sidebar',))
+	content = [make_link("/category/" + tag, tag) + "<br>" for tag in snapshot().getCategories()]
 	return {"content": "".join(content)}
 
 
 @route("/tag/<tag>")
+@cached
 @sanitize
 @view("articleList.tpl")
 def searchByTag(tag):
-	articles = blog_instance.getArticlesByTag(tag)
+	depends(('tag', tag))
+	articles = snapshot().getArticlesByTag(tag)
+	shows(articles)
 
 	return {"article_list": articles}
 
 
 @route("/tag")
+@cached
 @sanitize
 @view("basePage.tpl")
 def searchTags():
-	content = [make_link("/tag/" + tag, tag) + "<br>" for tag in blog_instance.getTags()]
+	# The tags the sidebar lists.
+	depends(('sidebar',))
+	content = [make_link("/tag/" + tag, tag) + "<br>" for tag in snapshot().getTags()]
 	return {"content": "".join(content)}
 
 
+@route("/query")
+@cached
+@view("articleList.tpl")
+def queryArticles():
+	'''
+		Faceted search over tags, categories and dates, e.g.
+		/query?tag=a&tag=b&category=c&year=2015&page=2
+
+		tag: all must match.  any_tag: one must match.  not_tag: none may match.
+		category, year and month (yyyy-mm): any one must match.
+	'''
+	query = request.query
+	try:
+		years = [int(year) for year in query.getall("year")]
+		months = []
+		for month in query.getall("month"):
+			# Exactly yyyy-mm; anything else fails to unpack.
+			(year, number) = month.split("-")
+			months.append((int(year), int(number)))
+		page = int(query.get("page", 1))
+	except ValueError as e:
+		response.status = 303
+		response.set_header('Location', '/error')
+		Log("Invalid query: %s" % (request.query_string,))
+		return {"article_list": []}
+
+	depends(('articles',))
+	(count, articles) = snapshot().queryArticles(
+		tags=query.getall("tag"),
+		any_tags=query.getall("any_tag"),
+		exclude_tags=query.getall("not_tag"),
+		categories=query.getall("category"),
+		years=years,
+		months=months,
+		page=page)
+	shows(articles)
+
+	return {"article_list": articles, "heading": "%d matching articles, page %d" % (count, max(page, 1))}
+
+
+@route("/search")
+@cached
+@view("articleList.tpl")
+def searchArticles():
+	'''
+		Full text search over article titles and bodies, ranked by relevance, e.g.
+		/search?q=some+words&page=2
+	'''
+	query = request.query
+	try:
+		page = int(query.get("page", 1))
+	except ValueError as e:
+		response.status = 303
+		response.set_header('Location', '/error')
+		Log("Invalid search: %s" % (request.query_string,))
+		return {"article_list": []}
+
+	depends(('articles',))
+	(count, articles) = snapshot().searchArticles(query.getunicode("q", default=u""), page=page)
+	shows(articles)
+
+	return {"article_list": articles, "heading": "%d matching articles, page %d" % (count, max(page, 1))}
+
+
 @route("/error")
 @sanitize
 @view("basePage.tpl")
@@ -199,15 +614,64 @@ def searchTags():
 	return {"content": "Something happened.  See server logs to find out what."}
 
 
-def Run(host="localhost", port="80", config_path=None):
+def Configure(config_path=None):
 	'''
-		Run the web server for the site specified by the routes in this module.
+		Apply an additional or alternate configuration file to the blog.
 
-		:param config_path: Optional additional or alternate configuration file.
+		:param config_path: The configuration file; nothing is done without one.
 	'''
 	if config_path:
 		blog_instance.loadConfig(config_path)
-	run(host=host, port=port)
+		page_cache.max_bytes = blog_instance.page_cache_bytes
+		validator_cache.max_bytes = blog_instance.page_cache_bytes // 16
+		# Picks up the configured directories; only new or changed files get parsed.
+		blog_instance.refresh()
+		blog_instance.saveIndex()
+
+
+def StartWorker():
+	'''
+		Catch a freshly forked server process up with anything changed
+		since the blog was parsed, and keep it up to date.
+	'''
+	blog_instance.refresh()
+	blog_instance.startRefresher()
+
+
+def Run(host="localhost", port="80", config_path=None, workers=1, threads=1, server="wsgiref"):
+	'''
+		Run the web server for the site specified by the routes in this module.
+
+		:param config_path: Optional additional or alternate configuration file.
+		:param workers: Processes to serve from; more than 1 pre-forks. (0 uses one per CPU)
+		:param threads: Threads to serve on, in each process.
+		:param server: "wsgiref", or "asyncio" (python 3 only) for many mostly idle connections.
+	'''
+	Configure(config_path)
+
+	if server == "asyncio":
+		# Imported here since python 2 has no asyncio.
+		from aioserver import AsyncioServer
+		blog_instance.startRefresher()
+		# The pool only runs handlers; connections don't hold on to its threads.
+		run(server=AsyncioServer, host=host, port=port, threads=threads if threads > 1 else 16,
+			keep_alive_timeout=blog_instance.keep_alive_timeout, keep_alive_requests=blog_instance.keep_alive_requests)
+		return
+
+	workers = workers or multiprocessing.cpu_count()
+	if workers > 1:
+		# The blog is parsed once, here; each worker starts its own watcher.
+		run(server=PreforkServer, host=host, port=port, workers=workers, threads=threads, child_init=StartWorker,
+			keep_alive_timeout=blog_instance.keep_alive_timeout, keep_alive_requests=blog_instance.keep_alive_requests)
+		return
+
+	# Keeps the indexes current so that requests never have to rescan.
+	blog_instance.startRefresher()
+	if threads > 1:
+		run(server=ThreadedServer, host=host, port=port, threads=threads,
+			keep_alive_timeout=blog_instance.keep_alive_timeout, keep_alive_requests=blog_instance.keep_alive_requests)
+	else:
+		run(host=host, port=port)
 
 
 if __name__=="__main__":
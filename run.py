@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import export
 import routes
 import runpy
 import sys
@@ -22,6 +23,10 @@ def ParseArgs():
 	add_argument("-c", "--config", dest="config", default="blog.ini", help="Blog configuration file.")
 	add_argument("--host", dest="host", default="localhost", help="Host to run the blog as.")
 	add_argument("--port", dest="port", default="80", help="Port to run the blog on.")
+	add_argument("--workers", dest="workers", default=None, type=int, help="Processes to serve (default 1) or export (default one per CPU) with; 0 uses one per CPU.")
+	add_argument("--threads", dest="threads", default=1, type=int, help="Threads to serve on in each process.")
+	add_argument("--server", dest="server", default="wsgiref", help="wsgiref, or asyncio (python 3 only) for many idle connections.")
+	add_argument("--gzip", dest="gzip", default=False, action="store_true", help="Also export gzipped copies of pages.")
 
 	kwargs = argparser.parse_args()
 	args = []
@@ -43,8 +48,17 @@ if __name__ == "__main__":
 		#Man this is a hack.  Makes it so that the test runner doesn't think "tests" is a request.
 		sys.argv.remove("tests")
 		runpy.run_module("tests/tests", None,  "__main__", True)
-		print "\n"
+		print("\n")
+	elif "export" in args:
+		# run.py export <outdir>
+		outdirs = args[args.index("export") + 1:]
+		if not outdirs:
+			print("usage: run.py export <outdir> [--gzip] [--workers N] [-c CONFIG]")
+			sys.exit(2)
+
+		routes.Configure(kwargs.config)
+		export.Export(outdirs[0], workers=kwargs.workers or 0, compress=kwargs.gzip)
 	else:
-		routes.Run(host=kwargs.host, port=kwargs.port, config_path=kwargs.config)
+		routes.Run(host=kwargs.host, port=kwargs.port, config_path=kwargs.config, workers=1 if kwargs.workers is None else kwargs.workers, threads=kwargs.threads, server=kwargs.server)
 
 
@@ -0,0 +1,226 @@
+import heapq
+import math
+import re
+import sys
+
+try:
+	from itertools import izip as zip
+except ImportError:
+	pass
+
+# Markup and entities (including the &nbsp runs transformations.py adds) aren't worth indexing.
+markup = re.compile(r'<!--.*?-->|<[^>]*>|&\w+;?', re.DOTALL)
+word = re.compile(r'\w+', re.UNICODE)
+
+
+def Tokenize(text):
+	'''
+		Split text (HTML) into lowercase search terms.
+
+		:param text: the string to tokenize.
+	'''
+	if isinstance(text, bytes):
+		text = text.decode('utf-8', 'replace')
+	return word.findall(markup.sub(' ', text).lower())
+
+
+class SearchIndex(object):
+	'''
+		An inverted index over article text, ranked with BM25.
+
+		Documents are keyed by article title.  Every term maps to a dict of
+		title -> term frequency, and each document remembers its terms so it
+		can be taken out again without its text.  Term strings are shared
+		through the vocabulary, so each is only held once.
+
+		A copy shares its postings with the original until either changes
+		them, at which point only the postings of the terms changed are copied.
+	'''
+
+	# Standard BM25 tuning.
+	k1 = 1.2
+	b = 0.75
+	# (average length, title -> length normalization) as of the last search. (see normalizations)
+	normalization = None
+
+	def __init__(self):
+		self.postings = {}
+		self.vocabulary = {}
+		self.document_terms = {}
+		self.document_lengths = {}
+		self.total_length = 0
+		# Terms whose postings are shared with a copy, so must be copied before changing.
+		self.shared = set()
+
+	def __len__(self):
+		return len(self.document_lengths)
+
+	def __getstate__(self):
+		# An unpickled index shares nothing, and works its normalizations out again when searched.
+		state = dict(self.__dict__)
+		state.pop('normalization', None)
+		state['shared'] = set()
+		return state
+
+	def copy(self):
+		'''
+			Get an index of the same documents that can be changed without changing this one.
+		'''
+		clone = SearchIndex()
+		clone.postings = dict(self.postings)
+		clone.vocabulary = dict(self.vocabulary)
+		# Term tuples are never changed in place.
+		clone.document_terms = dict(self.document_terms)
+		clone.document_lengths = dict(self.document_lengths)
+		clone.total_length = self.total_length
+		self.shared = set(self.postings)
+		clone.shared = set(self.postings)
+		return clone
+
+	def posting(self, term):
+		'''
+			Get a term's postings to change, copying them first if they are shared.
+
+			:param term: The (interned) term.
+		'''
+		posting = self.postings.get(term)
+		if posting is None:
+			posting = self.postings[term] = {}
+		elif term in self.shared:
+			posting = self.postings[term] = dict(posting)
+		self.shared.discard(term)
+		return posting
+
+	def add(self, title, text):
+		'''
+			Index a document, replacing any previous version of it.
+
+			:param title: The title of the article.
+			:param text: The text to index.
+		'''
+		self.remove(title)
+		self.normalization = None
+
+		counts = {}
+		for term in Tokenize(text):
+			counts[term] = counts.get(term, 0) + 1
+
+		terms = []
+		for term, count in counts.items():
+			term = self.vocabulary.setdefault(term, term)
+			posting = self.posting(term)
+			posting[title] = count
+			terms.append(term)
+
+		length = sum(counts.values())
+		self.document_terms[title] = tuple(terms)
+		self.document_lengths[title] = length
+		self.total_length += length
+
+	def remove(self, title):
+		'''
+			Take a document out of the index, if it is there.
+
+			:param title: The title of the article.
+		'''
+		terms = self.document_terms.pop(title, None)
+		if terms is None:
+			return
+		self.normalization = None
+
+		for term in terms:
+			posting = self.posting(term)
+			del posting[title]
+			if not posting:
+				del self.postings[term]
+				del self.vocabulary[term]
+		self.total_length -= self.document_lengths.pop(title)
+
+	def normalizations(self):
+		'''
+			Get the table of BM25 length normalizations (title -> value) the
+			documents searched so far have, which is kept between searches until
+			a document is added or removed.
+		'''
+		average_length = float(self.total_length) / len(self.document_lengths) or 1.0
+		normalization = self.normalization
+		if normalization is None or normalization[0] != average_length:
+			normalization = (average_length, {})
+			# One assignment, so concurrent searches never see a table for another average.
+			self.normalization = normalization
+		return normalization[1]
+
+	def score(self, query):
+		'''
+			Score the documents containing any of the query's terms.
+
+			:param query: The query text.
+			:return: A dict of title -> score.
+		'''
+		if not self.document_lengths:
+			return {}
+
+		count = len(self.document_lengths)
+		normalizations = self.normalizations()
+		base = self.k1 * (1.0 - self.b)
+		scale = self.k1 * self.b * count / float(self.total_length or count)
+		boost = self.k1 + 1.0
+		# Local names, as the loop below runs once per matching document per term.
+		normalization_of = normalizations.get
+		lengths = self.document_lengths
+		scores = {}
+		for term in set(Tokenize(query)):
+			posting = self.postings.get(term)
+			if not posting:
+				continue
+			idf = math.log(1.0 + (count - len(posting) + 0.5) / (len(posting) + 0.5)) * boost
+			weights = {}
+			for title, frequency in posting.items():
+				normalization = normalization_of(title)
+				if normalization is None:
+					normalization = normalizations[title] = base + scale * lengths[title]
+				weights[title] = idf * frequency / (frequency + normalization)
+			# Most queries are a single term, whose weights are the scores as they are.
+			if not scores:
+				scores = weights
+				continue
+			score_of = scores.get
+			for title, weight in weights.items():
+				scores[title] = score_of(title, 0.0) + weight
+		return scores
+
+	def rank(self, scores, limit = None):
+		'''
+			Order scored documents best first.
+
+			:param scores: A dict of title -> score, from score.
+			:param limit: The most results to return. (default = all)
+			:return: A list of (title, score).
+		'''
+		# (score, title) pairs order themselves, which is much quicker than a key function.
+		if limit is None:
+			ranked = sorted(zip(scores.values(), scores.keys()), reverse=True)
+		else:
+			ranked = heapq.nlargest(limit, zip(scores.values(), scores.keys()))
+		return [(title, score) for (score, title) in ranked]
+
+	def search(self, query, limit = None):
+		'''
+			Rank the documents containing any of the query's terms.
+
+			:param query: The query text.
+			:param limit: The most results to return. (default = all)
+			:return: A list of (title, score), best first.
+		'''
+		return self.rank(self.score(query), limit)
+
+	def memoryUsage(self):
+		'''
+			Roughly how many bytes the index takes up, counting each object once.
+		'''
+		total = sys.getsizeof(self.postings) + sys.getsizeof(self.vocabulary) + sys.getsizeof(self.document_terms) + sys.getsizeof(self.document_lengths)
+		for term, posting in self.postings.items():
+			total += sys.getsizeof(term) + sys.getsizeof(posting)
+		for terms in self.document_terms.values():
+			total += sys.getsizeof(terms)
+		return total
@@ -0,0 +1,531 @@
+import errno
+import io
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer, make_server
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+from bottle import ServerAdapter
+from utilities import Log
+
+
+class KeepAliveServerHandler(ServerHandler):
+	'''
+		Writes one response on a persistent connection, framing the body
+		with its Content-Length or, failing that, chunked encoding, and
+		telling the request handler whether the connection can stay open.
+	'''
+	http_version = '1.1'
+	chunked = False
+
+	def cleanup_headers(self):
+		ServerHandler.cleanup_headers(self)
+
+		bodiless = self.environ['REQUEST_METHOD'] == 'HEAD' or self.status[:3] in ('204', '304') or self.status[0] == '1'
+		if 'Content-Length' not in self.headers and not bodiless:
+			if self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+				self.headers['Transfer-Encoding'] = 'chunked'
+				self.chunked = True
+			else:
+				# Only closing the connection can mark the end of the body.
+				self.request_handler.close_connection = 1
+
+		if self.request_handler.close_connection:
+			self.headers['Connection'] = 'close'
+		elif self.environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+			self.headers['Connection'] = 'keep-alive'
+
+	def write(self, data):
+		if not self.status:
+			raise AssertionError("write() before start_response()")
+		elif not self.headers_sent:
+			# Framing is decided along with the headers, on the first write.
+			self.bytes_sent = len(data)
+			self.send_headers()
+		else:
+			self.bytes_sent += len(data)
+
+		if self.chunked:
+			if not data:
+				# An empty chunk would end the body.
+				return
+			data = ('%x\r\n' % (len(data),)).encode('ascii') + data + b'\r\n'
+		self._write(data)
+		self._flush()
+
+	def finish_content(self):
+		ServerHandler.finish_content(self)
+		if self.chunked:
+			self._write(b'0\r\n\r\n')
+			self._flush()
+
+	def handle_error(self):
+		# Whatever was half sent leaves the connection unusable.
+		self.request_handler.close_connection = 1
+		# Nobody is left to tell when the client has gone, as Python 3's wsgiref also has it.
+		if not ClientWentAway(sys.exc_info()[1]):
+			ServerHandler.handle_error(self)
+
+
+def ClientWentAway(error):
+	'''
+		Is an exception just the client having closed its end of the connection?
+
+		:param error: The exception.
+	'''
+	return isinstance(error, socket.error) and bool(error.args) and error.args[0] in (errno.EPIPE, errno.ECONNRESET)
+
+
+def SocketPair():
+	'''
+		A pair of connected sockets, made over the loopback interface where
+		socket.socketpair is unavailable (Windows before Python 3.5).
+	'''
+	if hasattr(socket, 'socketpair'):
+		return socket.socketpair()
+	listener = socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1)
+	try:
+		writer = socket.create_connection(listener.getsockname())
+		(reader, address) = listener.accept()
+	finally:
+		listener.close()
+	return (reader, writer)
+
+
+def Readable(sockets, timeout):
+	'''
+		Wait for some of sockets to have something to read, or to be closed.
+
+		:param sockets: The sockets to wait on.
+		:param timeout: Seconds to wait at most; None waits until one is ready.
+		:return: The sockets that are ready; empty after a timeout.
+	'''
+	if not hasattr(select, 'poll'):
+		return select.select(sockets, [], [], timeout)[0]
+
+	# Unlike select, poll isn't limited to the first 1024 file descriptors.
+	poller = select.poll()
+	by_descriptor = {}
+	for connection in sockets:
+		by_descriptor[connection.fileno()] = connection
+		poller.register(connection, select.POLLIN)
+	events = poller.poll(None if timeout is None else int(timeout * 1000) + 1)
+	return [by_descriptor[descriptor] for (descriptor, event) in events]
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+	'''
+		Serves requests from one connection until the client closes it,
+		asks for it to be closed, sits idle for timeout seconds or has
+		made max_requests requests.  Pipelined requests are answered in order.
+
+		On a server with a park method (see ThreadPoolMixIn), handle returns
+		with parked set once no further request has arrived, leaving the
+		connection open; resume carries on when the next one does.
+	'''
+	protocol_version = 'HTTP/1.1'
+	# Applied to the socket by StreamRequestHandler.setup.
+	timeout = 5.0
+	max_requests = 100
+
+	def setup(self):
+		WSGIRequestHandler.setup(self)
+		self.requests = 0
+		self.parked = False
+
+	def handle(self):
+		self.parked = False
+		self.close_connection = 1
+		try:
+			self.serveRequests()
+		except socket.error as e:
+			if not ClientWentAway(e):
+				raise
+			self.close_connection = 1
+			self.parked = False
+
+	def serveRequests(self):
+		while True:
+			try:
+				self.raw_requestline = self.rfile.readline(65537)
+			except socket.timeout as e:
+				return
+			if not self.raw_requestline:
+				return
+			if len(self.raw_requestline) > 65536:
+				self.requestline = ''
+				self.request_version = ''
+				self.command = ''
+				self.send_error(414)
+				return
+
+			# Sets close_connection from the request's version and Connection header.
+			if not self.parse_request():
+				return
+			self.requests += 1
+			if self.requests >= self.max_requests:
+				self.close_connection = 1
+
+			# Read the body up front, so that whatever the app leaves unread isn't taken for the next request.
+			environ = self.get_environ()
+			length = int(environ.get('CONTENT_LENGTH') or 0)
+			if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+				self.close_connection = 1
+				stdin = self.rfile
+			else:
+				stdin = io.BytesIO(self.rfile.read(length))
+
+			handler = KeepAliveServerHandler(stdin, self.wfile, self.get_stderr(), environ)
+			handler.request_handler = self      # backpointer for logging
+			handler.run(self.server.get_app())
+			if self.close_connection:
+				return
+			if hasattr(self.server, 'park') and not self.pending():
+				# Wait for the next request without holding a thread.
+				self.parked = True
+				return
+
+	def pending(self):
+		'''
+			Has more of the next request already arrived, whether read into
+			rfile's buffer or waiting on the socket?
+		'''
+		buffered = getattr(self.rfile, '_rbuf', None)
+		if buffered is not None:
+			# Python 2's socket._fileobject; its buffer holds only unread bytes.
+			return bool(buffered.getvalue()) or bool(select.select([self.connection], [], [], 0)[0])
+
+		# Without a timeout, peek takes only what is buffered or already waiting.
+		self.connection.settimeout(0)
+		try:
+			return bool(self.rfile.peek(1))
+		finally:
+			self.connection.settimeout(self.timeout)
+
+	def resume(self):
+		'''
+			Serve a parked connection whose next request has arrived.
+		'''
+		try:
+			self.handle()
+		finally:
+			self.finish()
+
+	def finish(self):
+		if self.parked:
+			return
+		try:
+			WSGIRequestHandler.finish(self)
+		except socket.error as e:
+			# Flushing what's left of a response the client didn't wait for.
+			if not ClientWentAway(e):
+				raise
+
+
+class IdleConnections(threading.Thread):
+	'''
+		Watches the connections of a ThreadPoolMixIn server that are waiting
+		for their client's next request, so that they don't each hold a
+		thread meanwhile.  A connection is queued for the pool once it has
+		something to read, or closed once it has been idle for its timeout.
+	'''
+
+	def __init__(self, server):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.server = server
+		self.running = True
+		self.lock = threading.Lock()
+		# (request, client_address, handler or None, deadline or None) to start watching.
+		self.added = []
+		(self.wakeup, self.waker) = SocketPair()
+
+	def add(self, request, client_address, handler, timeout):
+		'''
+			Watch a connection until its next request arrives.
+
+			:param request: The connection's socket.
+			:param client_address: The client's address.
+			:param handler: The parked request handler, or None for a new connection.
+			:param timeout: Seconds to wait before closing the connection; None waits indefinitely.
+		'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self.lock:
+			self.added.append((request, client_address, handler, deadline))
+		self.wake()
+
+	def stop(self):
+		'''
+			Stop watching, closing every connection still idle.
+		'''
+		self.running = False
+		self.wake()
+
+	def wake(self):
+		try:
+			self.waker.send(b'x')
+		except socket.error as e:
+			# The wakeup socket is full, so a wakeup is pending anyway.
+			pass
+
+	def run(self):
+		# request -> (request, client_address, handler, deadline)
+		watched = {}
+		try:
+			while self.running:
+				with self.lock:
+					(added, self.added) = (self.added, [])
+				for entry in added:
+					watched[entry[0]] = entry
+
+				deadlines = [entry[3] for entry in watched.values() if entry[3] is not None]
+				timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+				try:
+					readable = Readable([self.wakeup] + list(watched), timeout)
+				except (select.error, socket.error) as e:
+					if e.args and e.args[0] == errno.EINTR:
+						continue
+					raise
+
+				for request in readable:
+					if request is self.wakeup:
+						self.wakeup.recv(4096)
+					else:
+						self.server.connections.put(watched.pop(request))
+
+				now = time.time()
+				for (request, entry) in list(watched.items()):
+					if entry[3] is not None and entry[3] <= now:
+						del watched[request]
+						self.close(entry)
+		finally:
+			with self.lock:
+				(added, self.added) = (self.added, [])
+			for entry in list(watched.values()) + added:
+				self.close(entry)
+			self.wakeup.close()
+			self.waker.close()
+
+	def close(self, entry):
+		(request, client_address, handler, deadline) = entry
+		try:
+			if handler:
+				handler.parked = False
+				handler.finish()
+		except Exception as e:
+			pass
+		self.server.shutdown_request(request)
+
+
+class ThreadPoolMixIn:
+	'''
+		Hand each connection to one of a fixed set of threads when it has
+		a request to read, instead of handling it on the accepting thread.
+		Connections queue up (to a limit) while every thread is busy, and
+		kept-alive connections wait for their next request without a
+		thread (see IdleConnections).
+	'''
+	threads = 8
+
+	def serve_forever(self, *args, **kwargs):
+		# Started here rather than on construction so they exist in whichever process serves.
+		self.connections = queue.Queue(self.threads * 4)
+		self.idle = IdleConnections(self)
+		self.idle.start()
+		for i in range(self.threads):
+			thread = threading.Thread(target=self.serveConnections)
+			thread.daemon = True
+			thread.start()
+		WSGIServer.serve_forever(self, *args, **kwargs)
+
+	def server_close(self):
+		WSGIServer.server_close(self)
+		if getattr(self, 'idle', None):
+			self.idle.stop()
+			self.idle.join(5)
+
+	def process_request(self, request, client_address):
+		self.idle.add(request, client_address, None, getattr(self.RequestHandlerClass, 'timeout', None))
+
+	def finish_request(self, request, client_address):
+		return self.RequestHandlerClass(request, client_address, self)
+
+	def park(self, request, client_address, handler):
+		'''
+			Have a kept-alive connection wait for its next request without a thread.
+
+			:param request: The connection's socket.
+			:param client_address: The client's address.
+			:param handler: The request handler, parked between requests.
+		'''
+		self.idle.add(request, client_address, handler, handler.timeout)
+
+	def serveConnections(self):
+		while True:
+			(request, client_address, handler, deadline) = self.connections.get()
+			try:
+				if handler:
+					handler.resume()
+				else:
+					handler = self.finish_request(request, client_address)
+				if getattr(handler, 'parked', False):
+					self.park(request, client_address, handler)
+					continue
+			except Exception as e:
+				self.handle_error(request, client_address)
+			self.shutdown_request(request)
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+	pass
+
+
+def MakeServer(adapter, app, threads = 1):
+	'''
+		Bind a wsgiref server for a ServerAdapter, as bottle's WSGIRefServer
+		would, optionally serving on a pool of threads.  With more than one
+		thread, connections are kept alive between requests; the adapter's
+		keep_alive_timeout and keep_alive_requests options limit for how long.
+
+		:param adapter: The ServerAdapter, for its host, port and other options.
+		:param app: The WSGI application to serve.
+		:param threads: Threads to handle connections on; 1 handles them as they are accepted.
+	'''
+	# A single thread handles connections as they're accepted, with nowhere to park idle ones.
+	request_handler = KeepAliveRequestHandler if threads > 1 else WSGIRequestHandler
+
+	class FixedHandler(request_handler):
+		timeout = adapter.options.get('keep_alive_timeout', KeepAliveRequestHandler.timeout) if threads > 1 else None
+		max_requests = adapter.options.get('keep_alive_requests', KeepAliveRequestHandler.max_requests)
+
+		def address_string(self): # Prevent reverse DNS lookups please.
+			return self.client_address[0]
+		def log_request(*args, **kw):
+			if not adapter.quiet:
+				return request_handler.log_request(*args, **kw)
+
+	server_class = ThreadPoolWSGIServer if threads > 1 else WSGIServer
+	if ':' in adapter.host: # Fix wsgiref for IPv6 addresses.
+		class server_class(server_class):
+			address_family = socket.AF_INET6
+
+	server = make_server(adapter.host, adapter.port, app, server_class, FixedHandler)
+	server.threads = threads
+	return server
+
+
+class ThreadedServer(ServerAdapter):
+	'''
+		Stdlib only server that handles requests on a pool of threads,
+		so one slow client doesn't hold up the rest.
+
+		Options: threads (default 8), keep_alive_timeout (idle seconds, default 5)
+		and keep_alive_requests (per connection, default 100).  Once running,
+		the bound server is the adapter's server attribute.
+	'''
+
+	def run(self, app):
+		self.server = MakeServer(self, app, self.options.get('threads', 8))
+		self.server.serve_forever()
+
+
+class PreforkServer(ServerAdapter):
+	'''
+		Stdlib only server that binds its socket once, then forks worker
+		processes that all accept connections from it.  The parent only
+		supervises, replacing any worker that exits.  Unix only.
+
+		Options: workers (default 4), threads per worker (default 1), the
+		keep alive options of ThreadedServer, and child_init, called in each
+		new worker before it starts serving.
+	'''
+
+	# A worker that dies sooner than this after starting is restarted only after this long.
+	restart_delay = 1.0
+
+	def run(self, app):
+		server = MakeServer(self, app, self.options.get('threads', 1))
+		self.child_init = self.options.get('child_init')
+		self.running = True
+		# pid -> when it was started
+		self.children = {}
+
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+		for i in range(self.options.get('workers', 4)):
+			self.spawn(server)
+
+		try:
+			while self.running:
+				try:
+					(pid, status) = os.wait()
+				except OSError as e:
+					if e.errno == errno.EINTR:
+						continue
+					raise
+
+				started = self.children.pop(pid, None)
+				if started is None or not self.running:
+					continue
+				Log('Worker %d exited with status %d; restarting it.' % (pid, status))
+				if time.time() - started < self.restart_delay:
+					time.sleep(self.restart_delay)
+				self.spawn(server)
+		finally:
+			for pid in self.children:
+				try:
+					os.kill(pid, signal.SIGTERM)
+				except OSError as e:
+					pass
+			server.server_close()
+
+	def spawn(self, server):
+		'''
+			Fork a worker to serve from the shared socket.
+
+			:param server: The bound server for the worker to run.
+		'''
+		pid = os.fork()
+		if pid:
+			self.children[pid] = time.time()
+			return
+
+		status = 1
+		try:
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+			if self.child_init:
+				self.child_init()
+			server.serve_forever()
+			status = 0
+		except Exception as e:
+			Log('Worker %d failed.' % (os.getpid(),))
+			Log(traceback.format_exc())
+		finally:
+			# Never fall back into the parent's code.
+			os._exit(status)
+
+	def stop(self, signum, frame):
+		'''
+			Signal handler; stop supervising, and take the workers down with us.
+		'''
+		self.running = False
+		# Python 3 resumes the interrupted wait, so it has to have a worker exit to return for.
+		for pid in self.children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError as e:
+				pass
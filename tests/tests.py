@@ -1,9 +1,32 @@
 import datetime
+import errno
 import unittest
 import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from wsgiref.util import setup_testing_defaults
+
+# Everything the tests write goes under a scratch directory, and Blog() finds no blog.ini
+# there, so the site's own config, log, date ledger and index cache are never touched.
+# The modules are imported from the repository, after the move so log.log lands in scratch.
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+scratch = tempfile.mkdtemp()
+os.makedirs(os.path.join(scratch, "tests", "articles"))
+shutil.copytree(os.path.join(repository, "views"), os.path.join(scratch, "views"))
+os.chdir(scratch)
 
 import blog
-from utilities import LoggingOff
+import bottle
+import server
+import watcher
+from utilities import LoggingOff, LRUCache, DependencyCache
 
 
 class ArticleInitializationTests(unittest.TestCase):
@@ -148,14 +171,14 @@ class ArticleInitializationTests(unittest.TestCase):
 		test_path = "tests/articles/test_article_without_date"
 
 		try:
-			os.chmod(test_path, 0666)
+			os.chmod(test_path, 0o666)
 		except:
 			pass
 
 		with open(test_path, 'w') as f:
 			f.write(test_body)
 
-		os.chmod(test_path, 0444)
+		os.chmod(test_path, 0o444)
 
 		article = blog.Article(path=test_path)
 
@@ -209,6 +232,49 @@ class ArticleInitializationTests(unittest.TestCase):
 		self.assertEqual(article.date, test_date)
 
 
+class MetadataScannerTests(unittest.TestCase):
+	def test_scan_leading_comments(self):
+		with open(os.path.join(repository, "Example_Article.html")) as f:
+			found = blog.metadata_scanner.scan(f.read())
+
+		self.assertEqual(found["title"], "This is a sample article")
+		self.assertEqual(found["date"], "2014-12-26")
+		self.assertEqual(found["category"], "Programming")
+		self.assertEqual(found["tags"], "Programming,Blog,HTML,CSS,Python")
+
+
+	def test_first_value_wins(self):
+		found = blog.metadata_scanner.scan("<!--_title=FIRST;-->TESTBODY<!--_title=SECOND;_tags=TESTTAG;-->")
+
+		self.assertEqual(found, {"title": "FIRST", "tags": "TESTTAG"})
+
+
+	def test_unterminated_value(self):
+		found = blog.metadata_scanner.scan("<!--_title=Foo-->\n<!--_date=2014-01-01;_category=C;-->")
+
+		self.assertEqual(found, {"title": "Foo", "date": "2014-01-01", "category": "C"})
+
+
+	def test_parse_date(self):
+		self.assertEqual(blog.ParseDate("2014-12-26"), datetime.date(2014, 12, 26))
+		self.assertEqual(blog.ParseDate("2014-12-26 10:30:00"), datetime.date(2014, 12, 26))
+		self.assertEqual(blog.ParseDate("2014-1-5"), datetime.date(2014, 1, 5))
+		self.assertRaises(ValueError, blog.ParseDate, "2014-13-45")
+
+
+	def test_register_new_key(self):
+		scanner = blog.MetadataScanner()
+		scanner.register("title", attribute="title")
+		scanner.register("draft", lambda value: value == "yes")
+
+		article = blog.Article()
+		scanner.apply(article, "<!--_draft=yes;_title=TESTTITLE;-->")
+
+		self.assertEqual(article.title, "TESTTITLE")
+		self.assertEqual(article.metadata, {"draft": True})
+
+
+
 class BlogInitializationTests(unittest.TestCase):
 	def test_empty_initialization(self):
 		blog_instance = blog.Blog()
@@ -533,10 +599,1541 @@ class BlogInitializationTests(unittest.TestCase):
 		self.assertEqual(blog_instance.getArticlesByCategory(article3.category), [article3])
 
 
+	def test_interned_metadata_is_shared(self):
+		blog_instance = blog.Blog()
+
+		article = blog.Article(body="<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG, TESTTAG2;-->")
+		article2 = blog.Article(body="<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG, TESTTAG2;-->")
+
+		blog_instance.internArticle(article)
+		blog_instance.internArticle(article2)
+
+		self.assertTrue(article.category is article2.category)
+		self.assertTrue(article.tags is article2.tags)
+		self.assertTrue(article.date is article2.date)
+		self.assertEqual(article.tags, ("TESTTAG", "TESTTAG2"))
+
+
+	def test_version_changes_with_content(self):
+		blog_instance = blog.Blog()
+		versions = [blog_instance.version]
+
+		article = blog.Article(title="TESTTITLE", body="TESTBODY", date=datetime.date(2014, 1, 1))
+		blog_instance.indexArticle(article)
+		versions.append(blog_instance.version)
+
+		blog_instance.getRecentArticles()
+		blog_instance.searchArticles("TESTBODY")
+		versions.append(blog_instance.version)
+
+		blog_instance.unindexArticle(article)
+		versions.append(blog_instance.version)
+
+		self.assertTrue(versions[0] < versions[1] == versions[2] < versions[3])
+
+
+
+class DateIndexTests(unittest.TestCase):
+	def setUp(self):
+		self.blog_instance = blog.Blog()
+
+		self.articles = []
+		for (title, date) in [("A", datetime.date(2014, 2, 28)), ("B", datetime.date(2014, 3, 1)), ("C", datetime.date(2014, 3, 1)), ("D", datetime.date(2015, 1, 1)), ("E", datetime.date(2013, 12, 31))]:
+			article = blog.Article(title=title, date=date)
+			self.blog_instance.indexArticle(article)
+			self.articles.append(article)
+
+
+	def titles(self, articles):
+		return [article.title for article in articles]
+
+
+	def test_recent_is_newest_first(self):
+		self.assertEqual(self.titles(self.blog_instance.getRecentArticles()), ["D", "B", "C", "A", "E"])
+		self.assertEqual(self.titles(self.blog_instance.getRecentArticles(2)), ["D", "B"])
+
+
+	def test_by_year_month_and_day(self):
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByDate(2014)), ["B", "C", "A"])
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByDate(2014, 2)), ["A"])
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByDate(2014, 3, 1)), ["B", "C"])
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByDate(2012)), [])
+
+
+	def test_invalid_dates_are_empty(self):
+		self.assertEqual(self.blog_instance.getArticlesByDate(2014, 13), [])
+		self.assertEqual(self.blog_instance.getArticlesByDate(2014, 2, 30), [])
+
+
+	def test_reindex_keeps_one_entry(self):
+		article = blog.Article(title="B", date=datetime.date(2016, 1, 1))
+
+		self.blog_instance.indexArticle(article)
+
+		self.assertEqual(self.titles(self.blog_instance.getRecentArticles()), ["D", "B", "C", "A", "E"])
+		self.assertTrue(self.blog_instance.getArticlesByDate(2014, 3, 1)[0] is article)
+
+
+	def test_posting_lists_are_newest_first(self):
+		self.blog_instance.indexArticle(blog.Article(title="F", date=datetime.date(2014, 6, 1), category="TESTCATEGORY", tags=["TESTTAG"]))
+		self.blog_instance.indexArticle(blog.Article(title="G", date=datetime.date(2016, 6, 1), category="TESTCATEGORY", tags=["TESTTAG"]))
+		self.blog_instance.indexArticle(blog.Article(title="H", date=datetime.date(2015, 6, 1), category="TESTCATEGORY", tags=["TESTTAG"]))
+
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByCategory("TESTCATEGORY")), ["G", "H", "F"])
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByTag("TESTTAG")), ["G", "H", "F"])
+
+
+	def test_posting_list_views_are_stable(self):
+		self.blog_instance.indexArticle(blog.Article(title="F", date=datetime.date(2014, 6, 1), tags=["TESTTAG"]))
+
+		view = self.blog_instance.getArticlesByTag("TESTTAG")
+
+		self.assertTrue(self.blog_instance.getArticlesByTag("TESTTAG") is view)
+
+		self.blog_instance.indexArticle(blog.Article(title="G", date=datetime.date(2016, 6, 1), tags=["TESTTAG"]))
+
+		self.assertEqual(self.titles(view), ["F"])
+		self.assertEqual(self.titles(self.blog_instance.getArticlesByTag("TESTTAG")), ["G", "F"])
+
+
+	def test_sidebar_version_only_changes_with_the_sidebar(self):
+		self.blog_instance.sidebar_recent = 2
+		version = self.blog_instance.sidebar_version
+
+		# Too old to be listed, with nothing but existing categories and tags.
+		self.blog_instance.indexArticle(blog.Article(title="F", date=datetime.date(2012, 1, 1)))
+		self.blog_instance.indexArticle(blog.Article(title="G", date=datetime.date(2012, 1, 1), tags=["TESTTAG"]))
+		self.blog_instance.indexArticle(blog.Article(title="H", date=datetime.date(2012, 1, 1), tags=["TESTTAG"]))
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("H"))
+		self.assertEqual(self.blog_instance.sidebar_version, version + 1)
+
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("G"))
+		self.assertEqual(self.blog_instance.sidebar_version, version + 2)
+
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("B"))
+		self.assertEqual(self.blog_instance.sidebar_version, version + 3)
+
+		self.blog_instance.indexArticle(blog.Article(title="I", date=datetime.date(2016, 1, 1)))
+		self.assertEqual(self.blog_instance.sidebar_version, version + 4)
+
+
+
+class FacetQueryTests(unittest.TestCase):
+	def setUp(self):
+		self.blog_instance = blog.Blog()
+
+		for (title, date, category, tags) in [
+				("A", datetime.date(2015, 1, 5), "CATEGORY1", ["TAG1", "TAG2"]),
+				("B", datetime.date(2015, 3, 5), "CATEGORY1", ["TAG1"]),
+				("C", datetime.date(2015, 3, 9), "CATEGORY2", ["TAG1", "TAG2", "TAG3"]),
+				("D", datetime.date(2014, 3, 5), "CATEGORY1", ["TAG1", "TAG2"]),
+				("E", datetime.date(2015, 6, 1), None, ["TAG3"])]:
+			self.blog_instance.indexArticle(blog.Article(title=title, date=date, category=category, tags=tags))
+
+
+	def query(self, **kwargs):
+		(count, articles) = self.blog_instance.queryArticles(**kwargs)
+		self.assertEqual(count >= len(articles), True)
+		return (count, [article.title for article in articles])
+
+
+	def test_and_across_facets(self):
+		self.assertEqual(self.query(tags=["TAG1", "TAG2"], categories=["CATEGORY1"], years=[2015]), (1, ["A"]))
+
+
+	def test_or_and_not(self):
+		self.assertEqual(self.query(any_tags=["TAG2", "TAG3"], exclude_tags=["TAG1"]), (1, ["E"]))
+		self.assertEqual(self.query(categories=["CATEGORY1", "CATEGORY2"], months=[(2015, 3)]), (2, ["C", "B"]))
+
+
+	def test_pagination(self):
+		self.assertEqual(self.query(tags=["TAG1"], per_page=2), (4, ["C", "B"]))
+		self.assertEqual(self.query(tags=["TAG1"], per_page=2, page=2), (4, ["A", "D"]))
+		self.assertEqual(self.query(tags=["TAG1"], per_page=2, page=3), (4, []))
+
+
+	def test_unknown_facets_match_nothing(self):
+		self.assertEqual(self.query(tags=["NOTREAL"]), (0, []))
+		self.assertEqual(self.query(exclude_tags=["NOTREAL"])[0], 5)
+
+
+	def test_malformed_months_match_nothing(self):
+		self.assertEqual(self.query(months=[(2015,)]), (0, []))
+		self.assertEqual(self.query(months=[(2015, 3, 1)]), (0, []))
+		self.assertEqual(self.query(months=[(2015, 13)]), (0, []))
+
+
+	def test_date_order_walk_matches_sorting(self):
+		for number in range(300):
+			tags = ["EVEN"] if number % 2 == 0 else ["ODD"]
+			if number % 7 == 0:
+				tags.append("SEVENTH")
+			self.blog_instance.indexArticle(blog.Article(title="N%d" % (number,), date=datetime.date(2013, 1, 1) + datetime.timedelta(days=number * 5 % 700), tags=tags))
+		facets = self.blog_instance.facets
+
+		for bits in (facets.query([("tag", "EVEN")]), facets.query([("tag", "SEVENTH")]), facets.query([("tag", "TAG1")])):
+			for limit in (1, 10, 45, 400):
+				self.assertEqual(
+					facets.articlesOf(bits, limit, self.blog_instance.date_index.articles),
+					facets.articlesOf(bits)[:limit])
+
+		(count, titles) = self.query(tags=["EVEN"], years=[2014], page=3, per_page=10)
+		expected = [article.title for article in self.blog_instance.date_index.articles
+			if article.date.year == 2014 and "EVEN" in article.tags]
+		self.assertEqual((count, titles), (len(expected), expected[20:30]))
+		self.assertEqual(self.query(months=[(2014, 13)]), (0, []))
+
+
+	def test_reindex_and_remove(self):
+		self.blog_instance.indexArticle(blog.Article(title="A", date=datetime.date(2015, 1, 5), category="CATEGORY2", tags=["TAG3"]))
+
+		self.assertEqual(self.query(categories=["CATEGORY2"]), (2, ["C", "A"]))
+		self.assertEqual(self.query(tags=["TAG2"]), (2, ["C", "D"]))
+
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("C"))
+
+		self.assertEqual(self.query(tags=["TAG3"]), (2, ["E", "A"]))
+		self.assertEqual(self.blog_instance.facets.free_ids, [2])
+
+
+	def test_changes_name_what_they_touch(self):
+		changes = []
+		self.blog_instance.listeners.append(changes.append)
+		self.blog_instance.sidebar_recent = 1
+
+		self.blog_instance.indexArticle(blog.Article(title="D", date=datetime.date(2000, 1, 1), category="CATEGORY1", tags=["TAG2"]))
+
+		self.assertEqual(len(changes), 1)
+		self.assertEqual(set(changes[0]), set([
+			("article", "D"), ("articles",), ("category", "CATEGORY1"), ("tag", "TAG1"), ("tag", "TAG2"),
+			("year", 2014), ("month", 2014, 3), ("day", 2014, 3, 5)]))
+
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("E"))
+
+		self.assertEqual(("sidebar",) in changes[1], True)
+
+
+	def test_last_modified(self):
+		self.blog_instance.modified.clear()
+		article = self.blog_instance.getArticle("A")
+		self.blog_instance.manifest["A_PATH"] = (1, 1500000000.5, 10, "A")
+		article.path = "A_PATH"
+
+		self.assertEqual(self.blog_instance.lastModified([], []), None)
+		self.assertEqual(self.blog_instance.lastModified([("tag", "TAG1")], [article]), 1500000000.5)
+		self.assertEqual(self.blog_instance.lastModified([], [self.blog_instance.getArticle("B")]), 1425513600)
+
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("B"))
+
+		self.assertTrue(self.blog_instance.lastModified([("tag", "TAG1")], [article]) > 1500000000.5)
+
+
+
+class SearchIndexTests(unittest.TestCase):
+	def setUp(self):
+		self.blog_instance = blog.Blog()
+
+		for (title, body) in [
+				("Bread", "<p>Sourdough bread needs a starter, flour and water.</p>"),
+				("Starter", "<p>Feed the starter flour and water every day; a starter is a pet.</p>"),
+				("Bikes", "<p>Oil the chain &amp; check the tyres.</p>")]:
+			self.blog_instance.indexArticle(blog.Article(title=title, body=body, date=datetime.date(2015, 1, 1)))
+
+
+	def search(self, query, **kwargs):
+		(count, articles) = self.blog_instance.searchArticles(query, **kwargs)
+		return (count, [article.title for article in articles])
+
+
+	def test_ranking(self):
+		self.assertEqual(self.search("starter"), (2, ["Starter", "Bread"]))
+		self.assertEqual(sorted(self.search("SOURDOUGH chain")[1]), ["Bikes", "Bread"])
+		self.assertEqual(self.search("bikes")[1], ["Bikes"])
+
+
+	def test_markup_is_not_indexed(self):
+		self.assertEqual(self.search("p"), (0, []))
+		self.assertEqual(self.search("amp"), (0, []))
+		self.assertEqual(self.search("nothing here"), (0, []))
+
+
+	def test_pagination(self):
+		# Equal term counts, so the shorter article ranks first.
+		self.assertEqual(self.search("flour water", per_page=1), (2, ["Bread"]))
+		self.assertEqual(self.search("flour water", per_page=1, page=2), (2, ["Starter"]))
+
+
+	def test_reindex_and_remove(self):
+		self.blog_instance.indexArticle(blog.Article(title="Bikes", body="Bread on a bike.", date=datetime.date(2015, 1, 1)))
+		self.assertEqual(self.search("chain"), (0, []))
+		self.assertEqual(self.search("bread")[0], 2)
+
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("Bread"))
+		self.assertEqual(self.search("sourdough"), (0, []))
+		self.assertEqual("sourdough" in self.blog_instance.search_index.vocabulary, False)
+		self.assertEqual(len(self.blog_instance.search_index), 2)
+
+
+	def test_normalizations_follow_the_average_length(self):
+		search_index = self.blog_instance.search_index
+		self.assertEqual(self.search("starter", per_page=1), (2, ["Starter"]))
+		normalizations = search_index.normalizations()
+		self.assertEqual(sorted(normalizations), ["Bread", "Starter"])
+
+		search_index.add("Long", "bread " * 200)
+		self.assertTrue(search_index.normalizations() is not normalizations)
+		self.assertEqual(sorted(title for (title, score) in search_index.search("bread")), ["Bread", "Long"])
+		self.assertEqual(search_index.search("bread", limit=1), search_index.search("bread")[:1])
+
+
+	def test_normalizations_follow_document_lengths(self):
+		search_index = blog.SearchIndex()
+		search_index.add("Short", "rye")
+		search_index.add("Long", "rye rye spelt")
+		search_index.search("rye")
+
+		# Swapping the lengths leaves the average as it was.
+		search_index.add("Short", "rye spelt spelt")
+		search_index.add("Long", "rye")
+
+		fresh = blog.SearchIndex()
+		fresh.add("Short", "rye spelt spelt")
+		fresh.add("Long", "rye")
+		self.assertEqual(search_index.search("rye"), fresh.search("rye"))
+
+
+	def test_copies_are_independent(self):
+		search_index = self.blog_instance.search_index
+		copy = search_index.copy()
+
+		copy.remove("Bread")
+		copy.add("Bikes", "Bread on a bike.")
+
+		self.assertEqual(sorted(title for (title, score) in search_index.search("sourdough chain")), ["Bikes", "Bread"])
+		self.assertEqual(search_index.search("bike"), [])
+		self.assertEqual([title for (title, score) in copy.search("bread sourdough chain")], ["Bikes"])
+
+
+
+class SnapshotTests(unittest.TestCase):
+	def setUp(self):
+		self.blog_instance = blog.Blog()
+		self.blog_instance.indexArticle(blog.Article(title="A", body="apple", date=datetime.date(2014, 1, 1), category="TESTCATEGORY", tags=["TESTTAG"]))
+		self.notified = []
+		self.blog_instance.listeners.append(self.notified.append)
+
+
+	def titles(self, articles):
+		return sorted(article.title for article in articles)
+
+
+	def test_snapshots_never_change(self):
+		snapshot = self.blog_instance.snapshot
+		self.blog_instance.indexArticle(blog.Article(title="B", body="banana", date=datetime.date(2015, 1, 1), category="TESTCATEGORY", tags=["TESTTAG", "TESTTAG2"]))
+		self.blog_instance.unindexArticle(self.blog_instance.getArticle("A"))
+
+		self.assertEqual(self.titles(snapshot.getArticles()), ["A"])
+		self.assertEqual(self.titles(snapshot.getRecentArticles()), ["A"])
+		self.assertEqual(self.titles(snapshot.getArticlesByTag("TESTTAG")), ["A"])
+		self.assertEqual(sorted(snapshot.getTags()), ["TESTTAG"])
+		self.assertEqual(snapshot.queryArticles(categories=["TESTCATEGORY"])[0], 1)
+		self.assertEqual(snapshot.searchArticles("banana")[0], 0)
+
+		current = self.blog_instance.snapshot
+		self.assertTrue(current is not snapshot)
+		self.assertTrue(current.version > snapshot.version)
+		self.assertEqual(self.titles(current.getArticlesByTag("TESTTAG")), ["B"])
+		self.assertEqual(sorted(current.getTags()), ["TESTTAG", "TESTTAG2"])
+		self.assertEqual(current.searchArticles("apple")[0], 0)
+
+
+	def test_changes_are_published_together(self):
+		snapshot = self.blog_instance.snapshot
+		with self.blog_instance.changes():
+			self.blog_instance.indexArticle(blog.Article(title="B", date=datetime.date(2015, 1, 1)))
+			self.blog_instance.indexArticle(blog.Article(title="C", date=datetime.date(2016, 1, 1)))
+			self.assertTrue(self.blog_instance.snapshot is snapshot)
+			self.assertEqual(self.notified, [])
+
+		self.assertEqual(self.titles(self.blog_instance.snapshot.getArticles()), ["A", "B", "C"])
+		self.assertEqual(self.blog_instance.snapshot.version, snapshot.version + 1)
+		self.assertEqual(len(self.notified), 1)
+		self.assertTrue(('article', "B") in self.notified[0] and ('article', "C") in self.notified[0])
+
+
+	def test_unchanged_indexes_are_shared(self):
+		snapshot = self.blog_instance.snapshot
+		self.blog_instance.indexArticle(blog.Article(title="B", date=datetime.date(2015, 1, 1), tags=["TESTTAG2"]))
+
+		current = self.blog_instance.snapshot
+		self.assertTrue(current.categories["TESTCATEGORY"] is snapshot.categories["TESTCATEGORY"])
+		self.assertTrue(current.tags["TESTTAG"] is snapshot.tags["TESTTAG"])
+		self.assertTrue(current.date_index is not snapshot.date_index)
+
+
+
+class IncrementalParseTests(unittest.TestCase):
+	def setUp(self):
+		self.article_dir = "./tests/incremental_dir"
+
+		try:
+			os.makedirs(self.article_dir)
+		except OSError as e:
+			pass
+
+		for filename in os.listdir(self.article_dir):
+			os.remove(os.path.join(self.article_dir, filename))
+
+		self.blog_instance = blog.Blog()
+		self.blog_instance.article_dir = self.article_dir
+
+
+	def write_article(self, filename, body):
+		with open(os.path.join(self.article_dir, filename), "w") as f:
+			f.write(body)
+
+
+	def test_unchanged_files_are_not_reparsed(self):
+		self.write_article("test_article_1", "<!--_date=2014-01-01;-->")
+		self.write_article("test_article_2", "<!--_date=2014-01-02;-->")
+
+		self.blog_instance.parseArticles()
+		article = self.blog_instance.getArticle("test_article_1")
+
+		self.blog_instance.parseArticles()
+
+		self.assertTrue(self.blog_instance.getArticle("test_article_1") is article)
+		self.assertEqual(len(self.blog_instance.getArticles()), 2)
+
+
+	def test_changed_file_is_reparsed(self):
+		self.write_article("test_article", "<!--_date=2014-01-01;_category=OLD;-->")
+
+		self.blog_instance.parseArticles()
+
+		self.write_article("test_article", "<!--_date=2014-01-01;_category=NEWCATEGORY;-->")
+
+		self.blog_instance.parseArticles()
+
+		self.assertEqual(self.blog_instance.getArticle("test_article").category, "NEWCATEGORY")
+		self.assertEqual(set(self.blog_instance.getCategories()), set(["NEWCATEGORY"]))
+
+
+	def test_removed_file_is_unindexed(self):
+		self.write_article("test_article_1", "<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG;-->")
+		self.write_article("test_article_2", "<!--_date=2014-01-02;-->")
+
+		self.blog_instance.parseArticles()
+
+		os.remove(os.path.join(self.article_dir, "test_article_1"))
+
+		self.blog_instance.parseArticles()
+
+		self.assertEqual([article.title for article in self.blog_instance.getArticles()], ["test_article_2"])
+		self.assertEqual(list(self.blog_instance.getCategories()), [])
+		self.assertEqual(list(self.blog_instance.getTags()), [])
+		self.assertEqual(self.blog_instance.getRecentArticles(), [self.blog_instance.getArticle("test_article_2")])
+
+
+	def test_retitled_file_replaces_old_title(self):
+		self.write_article("test_article", "<!--_title=OLDTITLE;_date=2014-01-01;-->")
+
+		self.blog_instance.parseArticles()
+
+		self.write_article("test_article", "<!--_title=NEWTITLE;_date=2014-01-01;-->")
+
+		self.blog_instance.parseArticles()
+
+		self.assertEqual([article.title for article in self.blog_instance.getArticles()], ["NEWTITLE"])
+
+
+	def test_removed_file_uncovers_one_with_the_same_title(self):
+		self.write_article("test_article_1", "<!--_title=SHARED;_date=2014-01-01;_tags=FIRST;-->")
+		self.write_article("test_article_2", "<!--_title=SHARED;_date=2014-01-01;_tags=SECOND;-->")
+
+		self.blog_instance.parseArticles()
+		self.assertEqual(self.blog_instance.getArticle("SHARED").path, os.path.join(self.article_dir, "test_article_2"))
+
+		os.remove(os.path.join(self.article_dir, "test_article_2"))
+
+		self.blog_instance.parseArticles()
+
+		full_scan = blog.Blog()
+		full_scan.article_dir = self.article_dir
+		full_scan.parseArticles()
+		for blog_instance in (self.blog_instance, full_scan):
+			self.assertEqual(blog_instance.getArticle("SHARED").path, os.path.join(self.article_dir, "test_article_1"))
+			self.assertEqual(list(blog_instance.getTags()), ["FIRST"])
+			self.assertEqual(blog_instance.searchArticles("shared")[0], 1)
+
+
+	def test_parallel_ingest_matches_serial_ingest(self):
+		for number in range(10):
+			self.write_article("test_article_%d" % (number,), "<!--_date=2014-01-%02d;_category=CATEGORY%d;_tags=TAG%d, TAG;-->" % (number + 1, number % 3, number % 2))
+
+		self.blog_instance.parseArticles()
+
+		parallel_blog_instance = blog.Blog()
+		parallel_blog_instance.article_dir = self.article_dir
+		parallel_blog_instance.ingest_workers = 2
+		parallel_blog_instance.parallel_threshold = 0
+
+		parallel_blog_instance.parseArticles()
+
+		self.assertEqual(sorted(parallel_blog_instance.articles), sorted(self.blog_instance.articles))
+		self.assertEqual(parallel_blog_instance.manifest, self.blog_instance.manifest)
+		for title, article in self.blog_instance.articles.items():
+			parallel_article = parallel_blog_instance.getArticle(title)
+			self.assertEqual(parallel_article.body, article.body)
+			self.assertEqual(parallel_article.date, article.date)
+			self.assertEqual(parallel_article.web_path, article.web_path)
+		for tag in self.blog_instance.getTags():
+			self.assertEqual([article.title for article in parallel_blog_instance.getArticlesByTag(tag)], [article.title for article in self.blog_instance.getArticlesByTag(tag)])
+
+
+
+class LRUCacheTests(unittest.TestCase):
+	def test_evicts_least_recently_used_by_size(self):
+		cache = LRUCache(10)
+
+		cache.put("a", "aaaa")
+		cache.put("b", "bbbb")
+		cache.get("a")
+		cache.put("c", "cccc")
+
+		self.assertEqual(cache.get("a"), "aaaa")
+		self.assertEqual(cache.get("b"), None)
+		self.assertEqual(cache.get("c"), "cccc")
+
+		stats = cache.stats()
+		self.assertEqual(stats["bytes"], 8)
+		self.assertEqual(stats["evictions"], 1)
+		self.assertEqual(stats["hits"], 3)
+		self.assertEqual(stats["misses"], 1)
+		self.assertEqual(stats["hit_rate"], 0.75)
+
+
+	def test_oversized_values_are_not_stored(self):
+		cache = LRUCache(3)
+
+		cache.put("a", "aaaa")
+
+		self.assertEqual(cache.get("a"), None)
+		self.assertEqual(cache.stats()["bytes"], 0)
+
+
+	def test_dependency_invalidation(self):
+		cache = DependencyCache(100)
+
+		cache.put("a", "aa", dependencies=["x", "y"])
+		cache.put("b", "bb", dependencies=["y"])
+		cache.put("c", "cc", dependencies=["z"])
+		cache.invalidate(["y"])
+
+		self.assertEqual(cache.get("a"), None)
+		self.assertEqual(cache.get("b"), None)
+		self.assertEqual(cache.get("c"), "cc")
+		self.assertEqual(cache.stats()["bytes"], 2)
+		self.assertEqual(sorted(cache.dependents.keys()), ["z"])
+
+
+	def test_stale_values_are_not_stored(self):
+		cache = DependencyCache(100)
+
+		generation = cache.invalidations
+		cache.invalidate(["x"])
+		cache.put("a", "aa", dependencies=["y"], generation=generation)
+
+		self.assertEqual(cache.get("a"), None)
+		self.assertEqual(cache.dependencies, {})
+
+
+	def test_evicted_values_forget_dependencies(self):
+		cache = DependencyCache(4)
+
+		cache.put("a", "aaa", dependencies=["x"])
+		cache.put("b", "bbb", dependencies=["x"])
+
+		self.assertEqual(cache.dependents, {"x": set(["b"])})
+
+
+
+class LazyBodyTests(unittest.TestCase):
+	def setUp(self):
+		self.article_dir = "./tests/lazy_dir"
+
+		try:
+			os.makedirs(self.article_dir)
+		except OSError as e:
+			pass
+
+		self.article_path = os.path.join(self.article_dir, "test_article")
+		with open(self.article_path, "w") as f:
+			f.write("<!--_date=2014-01-01;-->" + "x" * 2000)
+
+		self.blog_instance = blog.Blog()
+		self.blog_instance.article_dir = self.article_dir
+		self.blog_instance.lazy_bodies = True
+
+
+	def test_body_is_unloaded_after_ingest(self):
+		self.blog_instance.parseArticles()
+
+		article = self.blog_instance.getArticle("test_article")
+
+		self.assertEqual(article._body, None)
+		self.assertEqual(len(article.excerpt), blog.Article.excerpt_length)
+		self.assertEqual(self.blog_instance.body_cache.stats()["entries"], 0)
+
+
+	def test_body_is_loaded_through_cache(self):
+		self.blog_instance.parseArticles()
+
+		article = self.blog_instance.getArticle("test_article")
+
+		self.assertEqual(article.body, "<!--_date=2014-01-01;-->" + "x" * 2000)
+		self.assertEqual(article.body, "<!--_date=2014-01-01;-->" + "x" * 2000)
+
+		stats = self.blog_instance.body_cache.stats()
+		self.assertEqual(stats["misses"], 1)
+		self.assertEqual(stats["hits"], 1)
+
+
+	def test_changed_file_drops_cached_body(self):
+		self.blog_instance.parseArticles()
+		self.blog_instance.getArticle("test_article").body
+
+		with open(self.article_path, "w") as f:
+			f.write("<!--_date=2014-01-01;-->CHANGED")
+
+		self.blog_instance.parseArticles()
+
+		self.assertEqual(self.blog_instance.getArticle("test_article").body, "<!--_date=2014-01-01;-->CHANGED")
+
+
+
+class IndexCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.article_dir = os.path.join(self.directory, "articles")
+		self.index_cache = os.path.join(self.directory, "index_cache")
+		os.makedirs(self.article_dir)
+
+		self.article_path = os.path.join(self.article_dir, "test_article")
+		with open(self.article_path, "w") as f:
+			f.write("<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG;-->ORIGINAL")
+		with open(os.path.join(self.article_dir, "test_article_2"), "w") as f:
+			f.write("<!--_date=2014-01-02;-->")
+
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+
+	def make_blog(self):
+		blog_instance = blog.Blog()
+		blog_instance.article_dir = self.article_dir
+		blog_instance.staging_dir = self.article_dir
+		blog_instance.index_cache = self.index_cache
+		blog_instance.date_ledger = blog.DateLedger(os.path.join(self.directory, "date_ledger"))
+		return blog_instance
+
+
+	def test_unchanged_files_are_loaded_from_cache(self):
+		os.utime(self.article_path, (1000000000, 1000000000))
+
+		blog_instance = self.make_blog()
+		blog_instance.parseArticles()
+		blog_instance.saveIndex()
+
+		# Same size and mtime, so only a re-read could notice the change.
+		with open(self.article_path, "w") as f:
+			f.write("<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG;-->REWRITE!")
+		os.utime(self.article_path, (1000000000, 1000000000))
+
+		loaded_blog_instance = self.make_blog()
+
+		self.assertTrue(loaded_blog_instance.loadIndex())
+
+		loaded_blog_instance.parseArticles()
+
+		article = loaded_blog_instance.getArticle("test_article")
+		self.assertEqual(article.body, "<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG;-->ORIGINAL")
+		self.assertEqual(article.web_path, "/articles/test_article")
+		self.assertEqual(loaded_blog_instance.getArticlesByCategory("TESTCATEGORY"), [article])
+		self.assertEqual(loaded_blog_instance.getArticlesByTag("TESTTAG"), [article])
+		self.assertEqual(len(loaded_blog_instance.getArticles()), 2)
+		self.assertEqual(loaded_blog_instance.manifest, blog_instance.manifest)
+
+
+	def test_indexes_are_loaded_not_rebuilt(self):
+		blog_instance = self.make_blog()
+		blog_instance.parseArticles()
+		blog_instance.saveIndex()
+
+		loaded_blog_instance = self.make_blog()
+		indexed = []
+		index_article = loaded_blog_instance.indexArticle
+		def recording_index_article(article, *args, **kwargs):
+			indexed.append(article.title)
+			return index_article(article, *args, **kwargs)
+		loaded_blog_instance.indexArticle = recording_index_article
+
+		self.assertTrue(loaded_blog_instance.loadIndex())
+		self.assertEqual(indexed, [])
+
+		article = loaded_blog_instance.getArticle("test_article")
+		self.assertTrue(loaded_blog_instance.getArticlesByTag("TESTTAG")[0] is article)
+		self.assertEqual(loaded_blog_instance.queryArticles(categories=["TESTCATEGORY"]), (1, [article]))
+		self.assertEqual([recent.title for recent in loaded_blog_instance.getRecentArticles(2)], ["test_article_2", "test_article"])
+		self.assertEqual(loaded_blog_instance.searchArticles("original"), (1, [article]))
+
+		with open(os.path.join(self.article_dir, "test_article_2"), "w") as f:
+			f.write("<!--_date=2014-01-02;_tags=TESTTAG;-->CHANGED")
+		loaded_blog_instance.parseArticles()
+
+		# Only the changed file is indexed again, and the loaded indexes take it in.
+		self.assertEqual(indexed, ["test_article_2"])
+		self.assertEqual([tagged.title for tagged in loaded_blog_instance.getArticlesByTag("TESTTAG")], ["test_article_2", "test_article"])
+		self.assertEqual(loaded_blog_instance.queryArticles(tags=["TESTTAG"])[0], 2)
+
+
+	def test_changed_files_are_reparsed(self):
+		blog_instance = self.make_blog()
+		blog_instance.parseArticles()
+		blog_instance.saveIndex()
+
+		with open(self.article_path, "w") as f:
+			f.write("<!--_date=2014-01-01;_category=NEWCATEGORY;-->CHANGED")
+		os.remove(os.path.join(self.article_dir, "test_article_2"))
+
+		loaded_blog_instance = self.make_blog()
+		loaded_blog_instance.loadIndex()
+		loaded_blog_instance.parseArticles()
+
+		self.assertEqual(loaded_blog_instance.getArticle("test_article").category, "NEWCATEGORY")
+		self.assertEqual(list(loaded_blog_instance.getCategories()), ["NEWCATEGORY"])
+		self.assertEqual(len(loaded_blog_instance.getArticles()), 1)
+
+
+	def test_lazy_bodies_from_cache(self):
+		blog_instance = self.make_blog()
+		blog_instance.lazy_bodies = True
+		blog_instance.parseArticles()
+		blog_instance.saveIndex()
+
+		loaded_blog_instance = self.make_blog()
+		loaded_blog_instance.lazy_bodies = True
+		loaded_blog_instance.loadIndex()
+
+		article = loaded_blog_instance.getArticle("test_article")
+		self.assertEqual(article.excerpt, "<!--_date=2014-01-01;_category=TESTCATEGORY;_tags=TESTTAG;-->ORIGINAL")
+		self.assertEqual(article.body, article.excerpt)
+
+
+	def test_other_version_is_ignored(self):
+		blog_instance = self.make_blog()
+		blog_instance.parseArticles()
+		blog_instance.index_cache_version = -1
+		blog_instance.saveIndex()
+
+		self.assertFalse(self.make_blog().loadIndex())
+
+
+	def test_missing_cache(self):
+		self.assertFalse(self.make_blog().loadIndex())
+
+
+
+class DateLedgerTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.article_dir = os.path.join(self.directory, "articles")
+		self.ledger_path = os.path.join(self.directory, "date_ledger")
+		os.makedirs(self.article_dir)
+
+		self.body = "<!--_category=TESTCATEGORY;-->TESTBODY"
+		for filename in ("test_article_1", "test_article_2"):
+			with open(os.path.join(self.article_dir, filename), "w") as f:
+				f.write(self.body)
+
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+
+	def make_blog(self):
+		blog_instance = blog.Blog()
+		blog_instance.article_dir = self.article_dir
+		blog_instance.date_ledger = blog.DateLedger(self.ledger_path)
+		return blog_instance
+
+
+	def test_undated_files_are_not_modified(self):
+		self.make_blog().parseArticles()
+
+		for filename in ("test_article_1", "test_article_2"):
+			with open(os.path.join(self.article_dir, filename)) as f:
+				self.assertEqual(f.read(), self.body)
+
+
+	def test_first_seen_dates_are_recorded(self):
+		blog_instance = self.make_blog()
+		blog_instance.parseArticles()
+
+		with open(self.ledger_path) as f:
+			lines = sorted(f.readlines())
+
+		today = str(datetime.date.today())
+		self.assertEqual(lines, [today + "\ttest_article_1\n", today + "\ttest_article_2\n"])
+		self.assertEqual(blog_instance.getArticle("test_article_1").date, datetime.date.today())
+
+
+	def test_recorded_dates_are_reused(self):
+		with open(self.ledger_path, "w") as f:
+			f.write("2013-05-06\ttest_article_1\n")
+
+		blog_instance = self.make_blog()
+		blog_instance.parseArticles()
+
+		self.assertEqual(blog_instance.getArticle("test_article_1").date, datetime.date(2013, 5, 6))
+		self.assertEqual(blog_instance.getArticle("test_article_2").date, datetime.date.today())
+
+		with open(self.ledger_path) as f:
+			self.assertEqual(len(f.readlines()), 2)
+
+
+
+class DeployTests(unittest.TestCase):
+	def setUp(self):
+		self.article_dir = "./tests/deploy_dir"
+		self.staging_dir = "./tests/deploy_staging_dir"
+
+		for directory in (self.article_dir, self.staging_dir):
+			try:
+				os.makedirs(directory)
+			except OSError as e:
+				pass
+
+			for filename in os.listdir(directory):
+				os.remove(os.path.join(directory, filename))
+
+		for (filename, body) in [("first", "<!--_title=First;-->First."), ("second", "<!--_title=Second;-->Second."), ("unfinished", "<!--_title=Unfinished;-->TODO: finish")]:
+			with open(os.path.join(self.staging_dir, filename), "w") as f:
+				f.write(body)
+
+		self.blog_instance = blog.Blog()
+		self.blog_instance.article_dir = self.article_dir
+		self.blog_instance.staging_dir = self.staging_dir
+		self.blog_instance.parseArticles()
+		self.blog_instance.parseStagedArticles()
+		self.notified = []
+		self.blog_instance.listeners.append(self.notified.append)
+
+
+	def test_batch_deploy(self):
+		staged = self.blog_instance.snapshot.getStagedArticle("First")
+		results = self.blog_instance.deployArticles(["First", "Second", "First"])
+
+		self.assertEqual(results, [("First", None), ("Second", None)])
+		self.assertEqual(sorted(self.blog_instance.snapshot.articles), ["First", "Second"])
+		self.assertEqual(sorted(self.blog_instance.snapshot.staged_articles), ["Unfinished"])
+		self.assertEqual(sorted(os.listdir(self.article_dir)), ["first", "second"])
+		self.assertEqual(self.blog_instance.getArticle("First").web_path, "/articles/First")
+		# What older snapshots hold is left alone.
+		self.assertTrue(self.blog_instance.getArticle("First") is not staged)
+		self.assertEqual(staged.web_path, "/staging/First")
+		self.assertEqual(staged.path, os.path.join(self.staging_dir, "first"))
+		self.assertEqual(len(self.notified), 1)
+
+		# Already in place, so a rescan has nothing to do.
+		self.blog_instance.refresh()
+		self.assertEqual(len(self.notified), 1)
+
+
+	def test_all_or_nothing(self):
+		results = self.blog_instance.deployArticles()
+
+		self.assertEqual([title for (title, error) in results], ["First", "Second", "Unfinished"])
+		self.assertEqual(results[2], ("Unfinished", "TODO found."))
+		self.assertTrue(results[0][1] and results[1][1])
+		self.assertEqual(os.listdir(self.article_dir), [])
+		self.assertEqual(len(self.blog_instance.staged_articles), 3)
+		self.assertEqual(self.notified, [])
+
+
+	def test_refuses_to_replace_files(self):
+		with open(os.path.join(self.article_dir, "first"), "w") as f:
+			f.write("<!--_title=Other;-->Other.")
+
+		self.assertEqual(self.blog_instance.deploy("First"), 0)
+		self.assertEqual(self.blog_instance.deployArticles(["Missing"]), [("Missing", "Not a staged article.")])
+		self.assertEqual(self.blog_instance.deploy("Second"), 1)
+		self.assertTrue("Second" in self.blog_instance.articles)
+
+
+	def test_failed_move_is_rolled_back(self):
+		first = self.blog_instance.getStagedArticle("First")
+		second = self.blog_instance.getStagedArticle("Second")
+		moves = [(first, os.path.join(self.article_dir, "first")), (second, os.path.join(self.article_dir, "missing", "second"))]
+
+		errors = self.blog_instance.moveAll(moves)
+
+		self.assertEqual(list(errors), ["Second"])
+		self.assertEqual(os.listdir(self.article_dir), [])
+		self.assertTrue(os.path.exists(first.path))
+
+
+
+class WatcherTests(unittest.TestCase):
+	def setUp(self):
+		self.article_dir = "./tests/watched_dir"
+		self.staging_dir = "./tests/watched_staging_dir"
+
+		for directory in (self.article_dir, self.staging_dir):
+			try:
+				os.makedirs(directory)
+			except OSError as e:
+				pass
+
+			for filename in os.listdir(directory):
+				os.remove(os.path.join(directory, filename))
+
+		self.blog_instance = blog.Blog()
+		self.blog_instance.article_dir = self.article_dir
+		self.blog_instance.staging_dir = self.staging_dir
+		self.blog_instance.parseArticles()
+		self.blog_instance.parseStagedArticles()
+
+
+	def wait_for(self, condition):
+		deadline = time.time() + 5
+		while not condition() and time.time() < deadline:
+			time.sleep(0.05)
+		return condition()
+
+
+	def check_watcher(self, watcher_instance):
+		watcher_instance.start()
+		try:
+			with open(os.path.join(self.article_dir, "test_article"), "w") as f:
+				f.write("<!--_date=2014-01-01;-->")
+			with open(os.path.join(self.staging_dir, "test_staged_article"), "w") as f:
+				f.write("<!--_date=2014-01-01;-->")
+
+			self.assertTrue(self.wait_for(lambda: "test_article" in self.blog_instance.articles))
+			self.assertTrue(self.wait_for(lambda: "test_staged_article" in self.blog_instance.staged_articles))
+
+			os.remove(os.path.join(self.article_dir, "test_article"))
+
+			self.assertTrue(self.wait_for(lambda: not self.blog_instance.articles))
+		finally:
+			watcher_instance.stop()
+
+
+	def test_polling_watcher(self):
+		self.check_watcher(watcher.PollingWatcher(self.blog_instance, 0.1))
+
+
+	def test_inotify_watcher(self):
+		try:
+			watcher_instance = watcher.InotifyWatcher(self.blog_instance, 0.1)
+		except OSError as e:
+			self.skipTest("inotify unavailable: %s" % (e,))
+
+		self.check_watcher(watcher_instance)
+
+
+	def test_start_watcher_off(self):
+		self.assertEqual(watcher.StartWatcher(self.blog_instance, 'off'), None)
+
+
+	def test_refresh(self):
+		self.assertEqual(self.blog_instance.last_refresh, None)
+		with open(os.path.join(self.article_dir, "test_article"), "w") as f:
+			f.write("<!--_date=2014-01-01;-->")
+
+		refreshed = self.blog_instance.refresh()
+		self.assertTrue("test_article" in self.blog_instance.articles)
+		self.assertEqual(self.blog_instance.last_refresh, refreshed)
+
+
+	def test_refresher(self):
+		self.blog_instance.watcher = 'poll'
+		self.blog_instance.watch_interval = 0.05
+		self.blog_instance.watch_jitter = 0.05
+		refresher = self.blog_instance.startRefresher()
+		try:
+			self.assertTrue(isinstance(refresher, watcher.PollingWatcher))
+			# Only ever one.
+			self.assertTrue(self.blog_instance.startRefresher() is refresher)
+			self.assertTrue(self.wait_for(lambda: self.blog_instance.last_refresh is not None))
+
+			with open(os.path.join(self.article_dir, "test_article"), "w") as f:
+				f.write("<!--_date=2014-01-01;-->")
+			self.assertTrue(self.wait_for(lambda: "test_article" in self.blog_instance.articles))
+		finally:
+			self.blog_instance.stopRefresher()
+		self.assertEqual(self.blog_instance.refresher, None)
+
+
+
+class KeepAliveServerTests(unittest.TestCase):
+	def setUp(self):
+		def app(environ, start_response):
+			start_response('200 OK', [('Content-Type', 'text/plain')])
+			if environ['PATH_INFO'] == '/stream':
+				# No Content-Length, so the body has to be chunked.
+				return iter([b'abc', b'', b'defgh'])
+			return [environ['wsgi.input'].read() or b'empty']
+
+		self.app = app
+		self.servers = []
+		self.server = self.serve(keep_alive_timeout=0.5, keep_alive_requests=3)
+
+
+	def tearDown(self):
+		for running in self.servers:
+			running.shutdown()
+			running.server_close()
+
+
+	def serve(self, **options):
+		adapter = server.ThreadedServer(host='127.0.0.1', port=0, **options)
+		adapter.quiet = True
+		running = server.MakeServer(adapter, self.app, threads=2)
+		thread = threading.Thread(target=running.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.servers.append(running)
+		return running
+
+
+	def exchange(self, data):
+		connection = socket.create_connection(self.server.server_address)
+		connection.settimeout(5)
+		connection.sendall(data)
+		received = b''
+		while True:
+			chunk = connection.recv(4096)
+			if not chunk:
+				break
+			received += chunk
+		connection.close()
+		return received
+
+
+	def test_pipelined_requests(self):
+		received = self.exchange(
+			b'POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 4\r\n\r\nbody'
+			b'GET /stream HTTP/1.1\r\nHost: x\r\n\r\n'
+			b'GET / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+
+		responses = received.split(b'HTTP/1.1 200 OK\r\n')[1:]
+		self.assertEqual(len(responses), 3)
+		self.assertTrue(responses[0].endswith(b'Content-Length: 4\r\n\r\nbody'))
+		self.assertTrue(b'Connection: close' not in responses[0])
+		self.assertTrue(b'Transfer-Encoding: chunked\r\n' in responses[1])
+		self.assertTrue(responses[1].endswith(b'\r\n\r\n3\r\nabc\r\n5\r\ndefgh\r\n0\r\n\r\n'))
+		self.assertTrue(b'Connection: close\r\n' in responses[2])
+		self.assertTrue(responses[2].endswith(b'empty'))
+
+
+	def test_request_limit(self):
+		received = self.exchange(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n' * 4)
+		self.assertEqual(received.count(b'HTTP/1.1 200 OK'), 3)
+		self.assertEqual(received.count(b'Connection: close'), 1)
+
+
+	def test_http_1_0(self):
+		received = self.exchange(
+			b'GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n'
+			b'GET /stream HTTP/1.0\r\nConnection: keep-alive\r\n\r\n'
+			b'GET / HTTP/1.0\r\n\r\n')
+
+		# Without a length, the end of the body is the end of the connection.
+		self.assertEqual(received.count(b'HTTP/1.1 200 OK'), 2)
+		self.assertTrue(b'Connection: keep-alive' in received)
+		self.assertTrue(received.endswith(b'Connection: close\r\n\r\nabcdefgh'))
+
+
+	def test_idle_timeout(self):
+		started = time.time()
+		received = self.exchange(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+		self.assertEqual(received.count(b'HTTP/1.1 200 OK'), 1)
+		self.assertTrue(time.time() - started < 4)
+
+
+	def test_idle_connections_dont_hold_threads(self):
+		running = self.serve(keep_alive_timeout=5)
+		# One more client than there are threads, each kept alive between requests.
+		clients = [socket.create_connection(running.server_address, 5) for i in range(3)]
+		started = time.time()
+		for attempt in range(3):
+			for client in clients:
+				client.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+				received = b''
+				while not received.endswith(b'empty'):
+					chunk = client.recv(4096)
+					self.assertTrue(chunk)
+					received += chunk
+				self.assertTrue(received.startswith(b'HTTP/1.1 200 OK'))
+		self.assertTrue(time.time() - started < 2)
+		for client in clients:
+			client.close()
+
+
+	def test_client_went_away(self):
+		self.assertTrue(server.ClientWentAway(socket.error(errno.EPIPE, 'Broken pipe')))
+		self.assertTrue(server.ClientWentAway(socket.error(errno.ECONNRESET, 'Connection reset by peer')))
+		self.assertFalse(server.ClientWentAway(socket.timeout('timed out')))
+		self.assertFalse(server.ClientWentAway(ValueError(errno.EPIPE)))
+
+
+
+class AsyncioServerTests(unittest.TestCase):
+	def setUp(self):
+		try:
+			import aioserver
+		except (ImportError, SyntaxError) as e:
+			self.skipTest('asyncio is unavailable')
+
+		def app(environ, start_response):
+			start_response('200 OK', [('Content-Type', 'text/plain')])
+			if environ['PATH_INFO'] == '/stream':
+				return iter([b'abc', b'', b'defgh'])
+			body = environ['wsgi.input'].read() or b'empty'
+			return [body]
+
+		self.adapter = aioserver.AsyncioServer(host='127.0.0.1', port=0, threads=2, keep_alive_timeout=0.5, keep_alive_requests=3)
+		self.adapter.quiet = True
+		self.thread = threading.Thread(target=self.adapter.run, args=(app,))
+		self.thread.daemon = True
+		self.thread.start()
+		while not hasattr(self.adapter, 'server'):
+			time.sleep(0.01)
+		self.address = self.adapter.server.sockets[0].getsockname()[:2]
+
+
+	def tearDown(self):
+		self.adapter.loop.call_soon_threadsafe(self.adapter.loop.stop)
+		self.thread.join(5)
+
+
+	def exchange(self, data):
+		connection = socket.create_connection(self.address, 5)
+		connection.sendall(data)
+		received = b''
+		while True:
+			chunk = connection.recv(4096)
+			if not chunk:
+				break
+			received += chunk
+		connection.close()
+		return received
+
+
+	def test_pipelined_requests(self):
+		received = self.exchange(
+			b'POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 4\r\n\r\nbody'
+			b'GET /stream HTTP/1.1\r\nHost: x\r\n\r\n'
+			b'GET / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+
+		responses = received.split(b'HTTP/1.1 200 OK\r\n')[1:]
+		self.assertEqual(len(responses), 3)
+		self.assertTrue(responses[0].endswith(b'\r\n\r\n4\r\nbody\r\n0\r\n\r\n'))
+		self.assertTrue(b'Connection: close' not in responses[0])
+		self.assertTrue(responses[1].endswith(b'\r\n\r\n3\r\nabc\r\n5\r\ndefgh\r\n0\r\n\r\n'))
+		self.assertTrue(b'Connection: close\r\n' in responses[2])
+
+
+	def test_request_limit(self):
+		received = self.exchange(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n' * 4)
+		self.assertEqual(received.count(b'HTTP/1.1 200 OK'), 3)
+		self.assertEqual(received.count(b'Connection: close'), 1)
+
+
+	def test_idle_timeout(self):
+		started = time.time()
+		received = self.exchange(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+		self.assertEqual(received.count(b'HTTP/1.1 200 OK'), 1)
+		self.assertTrue(time.time() - started < 4)
+
+
+
+def PidApp(environ, start_response):
+	if environ['PATH_INFO'] == '/slow':
+		time.sleep(0.5)
+	body = str(os.getpid()).encode('ascii')
+	start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+	return [body]
+
+
+class ServerAdapterTests(unittest.TestCase):
+	def request(self, port, path):
+		connection = socket.create_connection(('127.0.0.1', port), 5)
+		connection.sendall(('GET %s HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n' % (path,)).encode('ascii'))
+		received = b''
+		while True:
+			chunk = connection.recv(4096)
+			if not chunk:
+				break
+			received += chunk
+		connection.close()
+		(head, separator, body) = received.partition(b'\r\n\r\n')
+		self.assertTrue(head.split(b'\r\n')[0].endswith(b' 200 OK'))
+		return int(body)
+
+
+	def concurrently(self, port, path, count):
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(self.request(port, path))) for i in range(count)]
+		started = time.time()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(results), count)
+		return (time.time() - started, results)
+
+
+	def test_threaded_server(self):
+		adapter = server.ThreadedServer(host='127.0.0.1', port=0, threads=4)
+		adapter.quiet = True
+		thread = threading.Thread(target=adapter.run, args=(PidApp,))
+		thread.daemon = True
+		thread.start()
+		while not hasattr(adapter, 'server'):
+			time.sleep(0.01)
+
+		try:
+			(elapsed, results) = self.concurrently(adapter.server.server_port, '/slow', 4)
+			# Four half second requests, answered side by side.
+			self.assertTrue(elapsed < 1.5)
+			self.assertEqual(set(results), set([os.getpid()]))
+		finally:
+			adapter.server.shutdown()
+			adapter.server.server_close()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
+
+
+	def test_prefork_server(self):
+		if not hasattr(os, 'fork'):
+			self.skipTest('fork is unavailable')
+
+		# The supervisor binds in its own process, so it has to be told a free port.
+		probe = socket.socket()
+		probe.bind(('127.0.0.1', 0))
+		port = probe.getsockname()[1]
+		probe.close()
+
+		(started_read, started_write) = os.pipe()
+		supervisor = os.fork()
+		if not supervisor:
+			try:
+				os.close(started_read)
+				adapter = server.PreforkServer(host='127.0.0.1', port=port, workers=2,
+					child_init=lambda: os.write(started_write, ('%d\n' % (os.getpid(),)).encode('ascii')))
+				adapter.quiet = True
+				adapter.restart_delay = 0.1
+				adapter.run(PidApp)
+			finally:
+				os._exit(0)
+
+		os.close(started_write)
+		started = os.fdopen(started_read, 'rb')
+		try:
+			workers = [int(started.readline()), int(started.readline())]
+
+			# A worker busy with one request can't accept another, so each gets one.
+			(elapsed, results) = self.concurrently(port, '/slow', 2)
+			self.assertEqual(sorted(results), sorted(workers))
+			self.assertTrue(elapsed < 0.9)
+
+			os.kill(workers[0], signal.SIGKILL)
+			replacement = int(started.readline())
+			self.assertTrue(replacement not in workers)
+
+			# With the other original worker gone too, only the replacement is left to answer.
+			os.kill(workers[1], signal.SIGKILL)
+			self.assertEqual(int(started.readline()) in workers, False)
+			self.assertTrue(self.request(port, '/') not in workers)
+		finally:
+			os.kill(supervisor, signal.SIGTERM)
+			os.waitpid(supervisor, 0)
+			started.close()
+
+		# Its workers went down with it.
+		time.sleep(0.2)
+		self.assertRaises(socket.error, socket.create_connection, ('127.0.0.1', port), 1)
+
+
+
+class ExportTests(unittest.TestCase):
+	def setUp(self):
+		global routes, export
+		import routes
+		import export
+
+		self.directory = tempfile.mkdtemp()
+		self.article_dir = os.path.join(self.directory, "articles")
+		self.staging_dir = os.path.join(self.directory, "staging")
+		self.outdir = os.path.join(self.directory, "out")
+
+		for directory in (self.article_dir, self.staging_dir, self.outdir):
+			os.makedirs(directory)
+
+		for (filename, body) in [("first", "<!--_title=First;_date=2015-01-05;_tags=one;-->First."), ("second", "<!--_title=Second;_date=2015-03-05;_category=Things;-->Second.")]:
+			self.writeArticle(self.article_dir, filename, body)
+		self.writeArticle(self.staging_dir, "draft", "<!--_title=Draft;-->Draft.")
+
+		self.blog_instance = routes.blog_instance
+		self.saved = (self.blog_instance.article_dir, self.blog_instance.staging_dir, self.blog_instance.gzip_min_size)
+		self.blog_instance.article_dir = self.article_dir
+		self.blog_instance.staging_dir = self.staging_dir
+		self.blog_instance.refresh()
+
+
+	def tearDown(self):
+		(self.blog_instance.article_dir, self.blog_instance.staging_dir, self.blog_instance.gzip_min_size) = self.saved
+		self.blog_instance.refresh()
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+
+	def writeArticle(self, directory, filename, body):
+		with open(os.path.join(directory, filename), "w") as f:
+			f.write(body)
+
+
+	def exportedFiles(self):
+		found = []
+		for (directory, directories, filenames) in os.walk(self.outdir):
+			for filename in filenames:
+				found.append(os.path.relpath(os.path.join(directory, filename), self.outdir).replace(os.sep, "/"))
+		return sorted(found)
+
+
+	def test_layout(self):
+		self.assertEqual(export.Export(self.outdir, workers=1), (12, 0, 0))
+		self.assertEqual(self.exportedFiles(), [".export_manifest"] + sorted(path + "index.html" for path in [
+			"", "2015/", "2015/1/", "2015/1/5/", "2015/3/", "2015/3/5/", "articles/First/", "articles/Second/",
+			"category/", "category/Things/", "tag/", "tag/one/"]))
+
+		with open(os.path.join(self.outdir, "articles", "First", "index.html")) as f:
+			self.assertTrue("First." in f.read())
+		# Staged articles aren't public.
+		for path in self.exportedFiles():
+			with open(os.path.join(self.outdir, path)) as f:
+				self.assertTrue("Draft" not in f.read())
+
+
+	def test_only_changes_are_written(self):
+		export.Export(self.outdir, workers=1)
+		page = lambda *parts: os.path.join(self.outdir, *(parts + ("index.html",)))
+		first = os.stat(page("articles", "First")).st_ino
+		second = os.stat(page("articles", "Second")).st_ino
+
+		self.writeArticle(self.article_dir, "second", "<!--_title=Second;_date=2015-03-05;_category=Things;-->Second, edited.")
+		self.blog_instance.refresh()
+		(written, unchanged, deleted) = export.Export(self.outdir, workers=1)
+
+		self.assertTrue(0 < written < 12)
+		self.assertEqual((written + unchanged, deleted), (12, 0))
+		self.assertEqual(os.stat(page("articles", "First")).st_ino, first)
+		self.assertNotEqual(os.stat(page("articles", "Second")).st_ino, second)
+		with open(page("articles", "Second")) as f:
+			self.assertTrue("Second, edited." in f.read())
+
+
+	def test_removed_pages_are_deleted(self):
+		export.Export(self.outdir, workers=1)
+
+		os.remove(os.path.join(self.article_dir, "first"))
+		self.blog_instance.refresh()
+		self.assertEqual(export.Export(self.outdir, workers=1)[2], 4)
+
+		for directory in (("articles", "First"), ("tag", "one"), ("2015", "1")):
+			self.assertFalse(os.path.exists(os.path.join(self.outdir, *directory)))
+		self.assertTrue(os.path.exists(os.path.join(self.outdir, "articles", "Second", "index.html")))
+		self.assertEqual(export.Export(self.outdir, workers=1), (0, 8, 0))
+
+
+	def test_gzip_follows_the_option(self):
+		self.blog_instance.gzip_min_size = 0
+		(written, unchanged, deleted) = export.Export(self.outdir, workers=1, compress=True)
+		self.assertEqual(unchanged, 0)
+		self.assertTrue("articles/First/index.html.gz" in self.exportedFiles())
+
+		# Only the gzip option changed, so every page is rewritten, leaving no stale .gz behind.
+		self.assertEqual(export.Export(self.outdir, workers=1), (written, 0, 0))
+		self.assertEqual([path for path in self.exportedFiles() if path.endswith(".gz")], [])
+		self.assertEqual(export.Export(self.outdir, workers=1), (0, written, 0))
+
+
+
+class RouteTests(unittest.TestCase):
+	def setUp(self):
+		global routes
+		import routes
+
+		self.article_dir = tempfile.mkdtemp()
+		self.writeArticle("first", "<!--_title=First;_date=2015-01-05;-->First.")
+		self.writeArticle("second", "<!--_title=Second;_date=2015-03-05;-->Second.")
+
+		self.blog_instance = routes.blog_instance
+		self.saved = (self.blog_instance.article_dir, self.blog_instance.gzip_min_size)
+		self.blog_instance.article_dir = self.article_dir
+		self.blog_instance.refresh()
+		# As at startup: the files' own times are all that's known.
+		self.blog_instance.modified.clear()
+
+
+	def tearDown(self):
+		(self.blog_instance.article_dir, self.blog_instance.gzip_min_size) = self.saved
+		self.blog_instance.refresh()
+		shutil.rmtree(self.article_dir, ignore_errors=True)
+
+
+	def writeArticle(self, filename, body, modified = 1420070400):
+		path = os.path.join(self.article_dir, filename)
+		with open(path, "w") as f:
+			f.write(body)
+		os.utime(path, (modified, modified))
+
+
+	def get(self, path, **headers):
+		(path, _, query_string) = path.partition("?")
+		environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query_string}
+		for (name, value) in headers.items():
+			environ["HTTP_" + name.upper()] = value
+		setup_testing_defaults(environ)
+
+		started = []
+		body = b"".join(bottle.default_app()(environ, lambda status, headers, exc_info=None: started.append((status, dict(headers)))))
+		return (started[0][0], started[0][1], body)
+
+
+	def test_conditional_requests(self):
+		(status, headers, body) = self.get("/articles/First")
+		self.assertEqual(status, "200 OK")
+		self.assertTrue(b"First." in body)
+		self.assertEqual(headers["Last-Modified"], "Thu, 01 Jan 2015 00:00:00 GMT")
+
+		for conditions in ({"if_none_match": headers["Etag"]}, {"if_none_match": "W/" + headers["Etag"]}, {"if_modified_since": headers["Last-Modified"]}):
+			(status, not_modified_headers, body) = self.get("/articles/First", **conditions)
+			self.assertEqual((status, body), ("304 Not Modified", b""))
+			self.assertEqual(not_modified_headers["Etag"], headers["Etag"])
+
+		self.writeArticle("first", "<!--_title=First;_date=2015-01-05;-->First, edited.", 1420070400 + 60)
+		self.blog_instance.refresh()
+
+		for conditions in ({"if_none_match": headers["Etag"]}, {"if_modified_since": headers["Last-Modified"]}):
+			(status, changed_headers, body) = self.get("/articles/First", **conditions)
+			self.assertEqual(status, "200 OK")
+			self.assertTrue(b"First, edited." in body)
+			self.assertNotEqual(changed_headers["Etag"], headers["Etag"])
+
+		# The other article's page didn't change.
+		(status, headers, body) = self.get("/articles/Second")
+		self.assertEqual(self.get("/articles/Second", if_none_match=headers["Etag"])[0], "304 Not Modified")
+
+
+	def test_conditional_requests_dont_need_the_page(self):
+		(status, headers, body) = self.get("/articles/First")
+		routes.page_cache.clear()
+
+		for conditions in ({"if_none_match": headers["Etag"]}, {"if_modified_since": headers["Last-Modified"]}):
+			(status, not_modified_headers, body) = self.get("/articles/First", **conditions)
+			self.assertEqual((status, body), ("304 Not Modified", b""))
+			self.assertEqual(not_modified_headers["Etag"], headers["Etag"])
+		# Answered without rendering the page again.
+		self.assertEqual(routes.page_cache.get(("/articles/First", "")), None)
+
+		self.writeArticle("first", "<!--_title=First;_date=2015-01-05;-->First, edited.", 1420070400 + 60)
+		self.blog_instance.refresh()
+		routes.page_cache.clear()
+		(status, changed_headers, body) = self.get("/articles/First", if_none_match=headers["Etag"])
+		self.assertEqual(status, "200 OK")
+		self.assertTrue(b"First, edited." in body)
+
+
+	def test_gzip_negotiation(self):
+		self.blog_instance.gzip_min_size = 0
+		(status, plain_headers, plain) = self.get("/articles/First")
+		(status, headers, body) = self.get("/articles/First", accept_encoding="deflate, gzip")
+
+		self.assertEqual(headers["Content-Encoding"], "gzip")
+		self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), plain)
+		self.assertEqual(headers["Vary"], "Accept-Encoding")
+		self.assertEqual(plain_headers["Vary"], "Accept-Encoding")
+		self.assertTrue("Content-Encoding" not in plain_headers)
+		self.assertEqual(headers["Etag"], plain_headers["Etag"][:-1] + '-gzip"')
+
+		# Each representation only matches its own ETag.
+		self.assertEqual(self.get("/articles/First", accept_encoding="gzip", if_none_match=headers["Etag"])[0], "304 Not Modified")
+		self.assertEqual(self.get("/articles/First", if_none_match=headers["Etag"])[0], "200 OK")
+		self.assertEqual(self.get("/articles/First", accept_encoding="gzip", if_none_match=plain_headers["Etag"])[0], "200 OK")
+
+		for refused in ("gzip;q=0", "identity", "gzip; q=0.0, identity"):
+			(status, headers, body) = self.get("/articles/First", accept_encoding=refused)
+			self.assertTrue("Content-Encoding" not in headers)
+			self.assertEqual(body, plain)
+
+
+	def test_small_pages_are_not_gzipped(self):
+		self.blog_instance.gzip_min_size = 1 << 20
+		(status, headers, body) = self.get("/articles/Second", accept_encoding="gzip")
+
+		self.assertEqual(status, "200 OK")
+		self.assertTrue("Content-Encoding" not in headers)
+		self.assertTrue(b"Second." in body)
+		self.assertEqual(headers["Vary"], "Accept-Encoding")
+		self.assertFalse(headers["Etag"].endswith('-gzip"'))
+
+
+	def test_new_articles_keep_unrelated_pages_cached(self):
+		(status, headers, body) = self.get("/articles/First")
+		self.assertTrue(b"/tag/fresh" not in body)
+		self.get("/")
+		entry = routes.page_cache.get(("/articles/First", ""))
+		self.assertTrue(entry is not None)
+
+		# Changes the sidebar, but nothing the article's page itself shows.
+		self.writeArticle("third", "<!--_title=Third;_date=2015-04-05;_tags=fresh;-->Third.")
+		self.blog_instance.refresh()
+		self.assertTrue(routes.page_cache.get(("/articles/First", "")) is entry)
+		self.assertEqual(routes.page_cache.get(("/", "")), None)
+
+		(status, changed_headers, body) = self.get("/articles/First")
+		self.assertTrue(b"/tag/fresh" in body)
+		self.assertTrue(b"First." in body)
+		self.assertNotEqual(changed_headers["Etag"], headers["Etag"])
+		self.assertEqual(self.get("/articles/First", if_none_match=headers["Etag"])[0], "200 OK")
+		self.assertTrue(b"Third" in self.get("/")[2])
+
+
+	def test_malformed_queries_redirect_to_error(self):
+		for query in ("month=2015", "month=2015-03-01", "month=2015-xx", "year=last"):
+			(status, headers, body) = self.get("/query?" + query)
+			self.assertEqual(status, "303 See Other")
+			self.assertTrue(headers["Location"].endswith("/error"))
+
+		(status, headers, body) = self.get("/query?month=2015-03")
+		self.assertEqual(status, "200 OK")
+		self.assertTrue(b"Second." in body)
+
+
 
 def Main():
 	LoggingOff()
-	unittest.main()
+
+	try:
+		program = unittest.main(exit=False)
+	finally:
+		os.chdir(repository)
+		shutil.rmtree(scratch, ignore_errors=True)
+	sys.exit(not program.result.wasSuccessful())
 
 
 if __name__ == "__main__":
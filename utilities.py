@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import threading
+
 
 class _LoggingContext:
 	'''
@@ -57,3 +60,183 @@ def IsLoggingOn():
 		Is logging activated?
 	'''
 	return _LoggingContext.logging
+
+
+class LRUCache(object):
+	'''
+		A least-recently-used cache bounded by the total size of its values,
+		rather than by how many there are.  Safe to share between threads.
+	'''
+
+	def __init__(self, max_bytes):
+		'''
+			:param max_bytes: The most the values may add up to. (as measured by len() unless given)
+		'''
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key, default=None):
+		'''
+			Look up a value, marking it as most recently used.
+
+			:param key: The key to look up.
+			:param default: Returned if the key is not cached.
+		'''
+		with self.lock:
+			try:
+				value, size = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self.entries[key] = (value, size)
+			self.hits += 1
+			return value
+
+	def put(self, key, value, size=None):
+		'''
+			Store a value, evicting the least recently used ones to make room.
+			Values larger than the whole cache are not stored.
+
+			:param key: The key to store under.
+			:param value: The value to store.
+			:param size: The size of the value. (default = len(value))
+		'''
+		if size is None:
+			size = len(value)
+
+		with self.lock:
+			self.store(key, value, size)
+
+	def store(self, key, value, size):
+		'''
+			put, for callers already holding the lock.
+		'''
+		old = self.entries.pop(key, None)
+		if old:
+			self.bytes -= old[1]
+			self.dropped(key)
+		if size > self.max_bytes:
+			return
+		self.entries[key] = (value, size)
+		self.bytes += size
+		while self.bytes > self.max_bytes:
+			evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+			self.bytes -= evicted_size
+			self.evictions += 1
+			self.dropped(evicted_key)
+
+	def pop(self, key):
+		'''
+			Drop a value if it is cached.
+
+			:param key: The key to drop.
+		'''
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old:
+				self.bytes -= old[1]
+				self.dropped(key)
+
+	def dropped(self, key):
+		'''
+			Called, with the lock held, whenever a key is evicted or popped.
+
+			:param key: The key that is gone.
+		'''
+		pass
+
+	def clear(self):
+		'''
+			Drop every value.
+		'''
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+
+	def stats(self):
+		'''
+			Get the counters for the cache, as a dict.
+		'''
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'bytes': self.bytes,
+				'max_bytes': self.max_bytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'hit_rate': float(self.hits) / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+			}
+
+
+class DependencyCache(LRUCache):
+	'''
+		An LRUCache whose values each record what they were built from,
+		so that a change to one of those things drops only the values
+		that used it.
+	'''
+
+	def __init__(self, max_bytes):
+		LRUCache.__init__(self, max_bytes)
+		# dependency -> set of keys, and key -> its dependencies.
+		self.dependents = {}
+		self.dependencies = {}
+		self.invalidations = 0
+
+	def put(self, key, value, size=None, dependencies=(), generation=None):
+		'''
+			Store a value, remembering what it depends on.
+
+			:param key: The key to store under.
+			:param value: The value to store.
+			:param size: The size of the value. (default = len(value))
+			:param dependencies: Hashable names for whatever the value was built from.
+			:param generation: The invalidations count from before the value was built;
+				if anything has been invalidated since, the value may be stale and is not stored.
+		'''
+		if size is None:
+			size = len(value)
+
+		with self.lock:
+			if generation is not None and generation != self.invalidations:
+				return
+			self.store(key, value, size)
+			if key in self.entries:
+				self.dependencies[key] = tuple(dependencies)
+				for dependency in self.dependencies[key]:
+					self.dependents.setdefault(dependency, set()).add(key)
+
+	def invalidate(self, dependencies):
+		'''
+			Drop every value that depends on any of the given dependencies.
+
+			:param dependencies: The dependencies that have changed.
+		'''
+		with self.lock:
+			self.invalidations += 1
+			keys = set()
+			for dependency in dependencies:
+				keys.update(self.dependents.get(dependency, ()))
+			for key in keys:
+				(value, size) = self.entries.pop(key)
+				self.bytes -= size
+				self.dropped(key)
+
+	def dropped(self, key):
+		for dependency in self.dependencies.pop(key, ()):
+			keys = self.dependents[dependency]
+			keys.discard(key)
+			if not keys:
+				del self.dependents[dependency]
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+			self.dependents.clear()
+			self.dependencies.clear()
@@ -2,8 +2,12 @@
 
 {% block content %}
 
+{% if heading %}
+	<div class="contentHeader">{{heading}}</div>
+	<br>
+{% endif %}
 {% for article in article_list[:20]: %}
-{%	set body = article.body[:1000] %}
+{%	set body = article.excerpt %}
 	<div class="articleTitle"><span><a href={{article.web_path}}>{{article.title}}</a></span></div>
 		{{body}}
 	<br>
@@ -80,27 +80,10 @@
 		</style>
 	</head>
 	<body>
+		{% set index = snapshot() %}
 		<a class="title" href=/>{{blog.title}}</a>
 		<a class="subTitle" href=/>{{blog.sub_title}}</a>
-		<div class="index">
-			<a class="indexTitle" href=/>Recent</a> <br>
-			{% for article in blog.getRecentArticles(): %}
-				<a class="indexEntry" href={{article.web_path}}>{{article.title}}</a> <br>
-			{% endfor %}
-
-			<br>
-			<a class="indexTitle" href=/category>Categories</a> <br>
-			{% for category in blog.getCategories(): %}
-				<a class="indexEntry" href=/category/{{category}}>{{category}}</a> <br>
-			{% endfor %}
-
-			<br>
-			<a class="indexTitle" href=/tag>Tags</a> <br>
-			{% for tag in blog.getTags(): %}
-				<a class="indexEntry" href=/tag/{{tag}}>{{tag}}</a> <br>
-			{% endfor %}
-
-		</div>
+		{{sidebar(index)}}
 		<div class="content">
 			{% block content %}
 				{{content}}
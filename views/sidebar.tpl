@@ -0,0 +1,19 @@
+<div class="index">
+			<a class="indexTitle" href=/>Recent</a> <br>
+			{% for article in index.getRecentArticles(blog.sidebar_recent): %}
+				<a class="indexEntry" href={{article.web_path}}>{{article.title}}</a> <br>
+			{% endfor %}
+
+			<br>
+			<a class="indexTitle" href=/category>Categories</a> <br>
+			{% for category in index.getCategories(): %}
+				<a class="indexEntry" href=/category/{{category}}>{{category}}</a> <br>
+			{% endfor %}
+
+			<br>
+			<a class="indexTitle" href=/tag>Tags</a> <br>
+			{% for tag in index.getTags(): %}
+				<a class="indexEntry" href=/tag/{{tag}}>{{tag}}</a> <br>
+			{% endfor %}
+
+		</div>
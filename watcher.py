@@ -0,0 +1,273 @@
+import ctypes
+import ctypes.util
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+
+from blog import StatFile
+from utilities import Log
+
+
+# Event bits from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _encodePath(path):
+	'''
+		Paths go to libc as bytes; on python 2 they already are.
+	'''
+	if isinstance(path, bytes):
+		return path
+	return path.encode(sys.getfilesystemencoding())
+
+
+def _decodePath(path):
+	'''
+		Names come back from the kernel as bytes; keep them the same type os.walk gives us.
+	'''
+	if isinstance(path, str):
+		return path
+	return path.decode(sys.getfilesystemencoding())
+
+
+class Watcher(threading.Thread):
+	'''
+		Base class for the background threads that keep a Blog's
+		articles and staged articles in step with the filesystem.
+	'''
+
+	def __init__(self, blog_instance, interval = 1.0, jitter = 0.0):
+		'''
+			:param blog_instance: The Blog to keep up to date.
+			:param interval: The longest an edit should take to show up, in seconds.
+			:param jitter: Up to this many seconds are randomly added to each wait between rescans.
+		'''
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.blog = blog_instance
+		self.interval = interval
+		self.jitter = jitter
+		self.running = False
+
+	def start(self):
+		self.running = True
+		threading.Thread.start(self)
+
+	def stop(self):
+		'''
+			Ask the watcher to finish up; it exits within one interval.
+		'''
+		self.running = False
+
+	def rescan(self):
+		'''
+			Incrementally rescan both the article and staging directories.
+		'''
+		self.blog.refresh()
+
+
+class PollingWatcher(Watcher):
+	'''
+		Portable watcher; runs a stat-only rescan every interval, plus up to jitter.
+	'''
+
+	def run(self):
+		while self.running:
+			time.sleep(self.interval + random.uniform(0, self.jitter))
+			if not self.running:
+				# Stopped while asleep; the blog may already be gone.
+				break
+			try:
+				self.rescan()
+			except Exception as e:
+				Log('Failure polling for article changes.')
+				Log(traceback.format_exc())
+
+
+class InotifyWatcher(Watcher):
+	'''
+		Linux watcher; subscribes to inotify events for every directory
+		under article_dir and staging_dir and feeds the changed files
+		straight into the Blog.
+
+		Raises OSError on construction if inotify is not available.
+	'''
+
+	# How long to wait for a burst of events on one file to finish before acting on it.
+	settle_time = 0.1
+
+	def __init__(self, blog_instance, interval = 1.0, jitter = 0.0):
+		Watcher.__init__(self, blog_instance, interval, jitter)
+		libc_name = ctypes.util.find_library('c')
+		if not libc_name:
+			raise OSError('libc not found')
+		self.libc = ctypes.CDLL(libc_name, use_errno=True)
+		if not hasattr(self.libc, 'inotify_init'):
+			raise OSError('inotify not supported')
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+		# watch descriptor -> (directory, is_staging)
+		self.watches = {}
+		for root, is_staging in ((self.blog.article_dir, False), (self.blog.staging_dir, True)):
+			# A directory created later would go unnoticed, so leave that case to polling.
+			if not os.path.isdir(root):
+				os.close(self.fd)
+				raise OSError('cannot watch missing directory: ' + root)
+			self.watchTree(root, is_staging)
+
+	def watchTree(self, directory, is_staging):
+		'''
+			Add a watch on a directory and everything below it.
+
+			:param directory: The directory to watch.
+			:param is_staging: Whether the directory holds staged articles.
+		'''
+		for dirpath, dirnames, filenames in os.walk(directory):
+			wd = self.libc.inotify_add_watch(self.fd, ctypes.c_char_p(_encodePath(dirpath)), WATCH_MASK)
+			if wd < 0:
+				Log('Unable to watch directory: ' + dirpath)
+				continue
+			self.watches[wd] = (dirpath, is_staging)
+
+	def run(self):
+		pending = {}
+		first_pending = None
+		try:
+			while self.running:
+				timeout = self.settle_time if pending else self.interval
+				readable, writable, errored = select.select([self.fd], [], [], timeout)
+				if readable:
+					self.readEvents(pending)
+					if pending and first_pending is None:
+						first_pending = time.time()
+					# Keep collecting while events are arriving, but never past the interval.
+					if pending and time.time() - first_pending < self.interval:
+						continue
+
+				if pending:
+					try:
+						self.dispatch(pending)
+					except Exception as e:
+						Log('Failure applying article changes.')
+						Log(traceback.format_exc())
+					pending = {}
+					first_pending = None
+		finally:
+			os.close(self.fd)
+
+	def readEvents(self, pending):
+		'''
+			Drain the inotify descriptor, recording what needs doing.
+
+			:param pending: dict of path -> is_staging, or None -> None for a full rescan.
+		'''
+		data = os.read(self.fd, 64 * 1024)
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = _decodePath(data[offset:offset + length].rstrip(b'\0'))
+			offset += length
+
+			if mask & IN_Q_OVERFLOW:
+				pending[None] = None
+				continue
+			if mask & IN_IGNORED:
+				self.watches.pop(wd, None)
+				continue
+			if wd not in self.watches:
+				continue
+
+			directory, is_staging = self.watches[wd]
+			if mask & IN_ISDIR or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+				# Whole trees appearing or disappearing are easiest to reconcile with a rescan.
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					self.watchTree(os.path.join(directory, name), is_staging)
+				pending[None] = None
+				continue
+
+			pending[os.path.join(directory, name)] = is_staging
+
+	def dispatch(self, pending):
+		'''
+			Push the collected changes into the Blog, published together.
+
+			:param pending: dict of path -> is_staging, as built by readEvents.
+		'''
+		if None in pending:
+			self.rescan()
+			return
+
+		with self.blog.changes():
+			for path, is_staging in sorted(pending.items()):
+				if is_staging:
+					manifest, parse, remove = self.blog.staged_manifest, self.blog.parseStagedArticle, self.blog.removeStagedArticle
+				else:
+					manifest, parse, remove = self.blog.manifest, self.blog.parseArticle, self.blog.removeArticle
+
+				try:
+					signature = StatFile(path)
+				except OSError as e:
+					remove(path)
+					continue
+
+				if path in manifest and manifest[path][:3] == signature:
+					continue
+				try:
+					parse(path)
+				except Exception as e:
+					Log('Failure parsing article: ' + path)
+					Log(traceback.format_exc())
+
+			self.blog.date_ledger.flush()
+			self.blog.last_refresh = time.time()
+
+
+def StartWatcher(blog_instance, mode = 'auto', interval = 1.0, jitter = 0.0):
+	'''
+		Start the best available watcher for a blog.
+
+		:param blog_instance: The Blog to keep up to date.
+		:param mode: 'inotify', 'poll', 'auto' (inotify, falling back to polling) or 'off'.
+		:param interval: The longest an edit should take to show up, in seconds.
+		:param jitter: Up to this many seconds randomly added to each polling interval.
+		:return: The running watcher, or None if watching is off.
+	'''
+	if mode == 'off':
+		return None
+
+	watcher = None
+	if mode in ('auto', 'inotify'):
+		try:
+			watcher = InotifyWatcher(blog_instance, interval, jitter)
+		except (OSError, AttributeError) as e:
+			Log('inotify unavailable, falling back to polling: ', e)
+
+	if not watcher:
+		watcher = PollingWatcher(blog_instance, interval, jitter)
+
+	Log('Starting watcher: ', watcher.__class__.__name__)
+	watcher.start()
+	return watcher